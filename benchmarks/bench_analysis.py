@@ -0,0 +1,231 @@
+""" Micro-benchmarks of the analysis functions on synthetic activity frames
+Each function is timed on its own at each size, on inputs prepared by the functions before it, as the best of several runs.
+Peak memory is the most memory the function allocates through Python, measured by tracemalloc in a separate run so it does
+not slow the timed ones. Results can be saved as a baseline and later runs compared against it, exiting with status 1
+when a function is slower or uses more memory than the baseline by more than the threshold.
+
+    python3 benchmarks/bench_analysis.py --sizes 1000 10000 100000 1000000 --json baseline.json
+    python3 benchmarks/bench_analysis.py --sizes 1000 10000 100000 1000000 --baseline baseline.json
+
+Contains the following functions:
+    prepare_inputs()
+        make_activities() - imported
+    time_function()
+    peak_allocated()
+    run_benchmarks()
+    compare_results()
+    main()
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+import warnings
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt  # noqa: E402
+import numpy as np  # noqa: E402
+import pandas as pd  # noqa: E402
+
+from synthetic import make_activities  # noqa: E402
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from stravatracker import analysis  # noqa: E402
+
+__author__ = "rakeshrgill"
+__email__ = "rakeshrgill@gmail.com"
+
+# Functions benchmarked, in pipeline order, each a function of the prepared inputs (see prepare_inputs())
+BENCHMARKS = {
+    'excel_clean': lambda inputs: analysis.excel_clean(inputs['df'], inputs['rules']),
+    'pandas_df_converter': lambda inputs: analysis.pandas_df_converter(inputs['excel_df']),
+    'return_table_ls': lambda inputs: analysis.return_table_ls(inputs['pandas_df'], ["Y", "M"]),
+    'create_table': lambda inputs: analysis.create_table(inputs['pandas_df'], "W"),
+    'daily_matrix': lambda inputs: analysis.daily_matrix(analysis.daily_totals(inputs['pandas_df'])),
+    'graph_plots': lambda inputs: draw_graphs(inputs['pandas_df'], inputs['matrix']),
+}
+
+
+def draw_graphs(pandas_df, matrix):
+    """Runs graph_plots() with the Agg backend and closes its figures"""
+    with warnings.catch_warnings():
+        # plt.show() warns that Agg cannot show figures
+        warnings.simplefilter('ignore', UserWarning)
+        analysis.graph_plots(pandas_df, matrix)
+    plt.close('all')
+
+
+def prepare_inputs(num_activities, history_days, seed):
+    """Builds a synthetic frame and the inputs each benchmarked function takes, with the default activity rules
+    so rules in a local data folder do not change the results
+
+    Parameters
+    ----------
+    num_activities : int
+    history_days : float
+    seed : int
+        see make_activities()
+
+    Returns
+    -------
+    dict
+        df, rules, excel_df, pandas_df, matrix
+    """
+    df = make_activities(num_activities, history_days, seed)
+    rules = {activity_type: dict(rule) for activity_type, rule in analysis.ACTIVITY_RULES.items()}
+    excel_df = analysis.excel_clean(df, rules)
+    pandas_df = analysis.pandas_df_converter(excel_df)
+    matrix = analysis.daily_matrix(analysis.daily_totals(pandas_df))
+    return {'df': df, 'rules': rules, 'excel_df': excel_df, 'pandas_df': pandas_df, 'matrix': matrix}
+
+
+def time_function(func, inputs, repeat, min_seconds=0.5):
+    """Returns the shortest wall time in seconds of func(inputs), run repeat times and
+    until min_seconds have passed in total, so fast functions are timed over enough runs to settle.
+    The garbage collector is off while timing, as in timeit, so a collection does not land in one function's time"""
+    best = None
+    total = 0.0
+    runs = 0
+    gc.collect()
+    gc.disable()
+    try:
+        while runs < repeat or total < min_seconds:
+            start = time.perf_counter()
+            func(inputs)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+            total += elapsed
+            runs += 1
+    finally:
+        gc.enable()
+    return best
+
+
+def peak_allocated(func, inputs):
+    """Returns the peak bytes allocated through Python by one run of func(inputs), numpy and pandas buffers included"""
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        func(inputs)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run_benchmarks(sizes, names=None, repeat=3, history_days=3650.0, seed=0):
+    """Times every function at every size
+
+    Parameters
+    ----------
+    sizes : list
+        numbers of activities
+    names : list or None
+        keys of BENCHMARKS, None runs them all
+    repeat : int
+        timed runs of each function, the best is kept
+    history_days : float
+    seed : int
+        see make_activities()
+
+    Returns
+    -------
+    list
+        of dict, function, activities, seconds, peak_memory_bytes
+    """
+    names = list(BENCHMARKS) if names is None else names
+    results = []
+    for size in sizes:
+        inputs = prepare_inputs(size, history_days, seed)
+        for name in names:
+            func = BENCHMARKS[name]
+            # A first run warms caches and lazy imports, e.g. matplotlib's fonts
+            func(inputs)
+            results.append({
+                'function': name,
+                'activities': size,
+                'seconds': round(time_function(func, inputs, repeat), 6),
+                'peak_memory_bytes': peak_allocated(func, inputs),
+            })
+    return results
+
+
+def compare_results(results, baseline, threshold, min_difference=0.005):
+    """Adds the ratio to the baseline of each result and flags regressions. Results missing from the baseline are not compared.
+    A time is only a regression if it is also min_difference seconds slower, as the fastest functions vary by more than the threshold
+
+    Parameters
+    ----------
+    results : list
+        see run_benchmarks()
+    baseline : list
+        results of an earlier run
+    threshold : float
+        largest ratio of the time or memory to the baseline accepted, e.g. 1.25
+    min_difference : float
+        seconds a time must exceed the baseline by to be a regression
+
+    Returns
+    -------
+    list
+        of str, descriptions of the regressions
+    """
+    baseline_dict = {(item['function'], item['activities']): item for item in baseline}
+    regressions = []
+    for result in results:
+        base = baseline_dict.get((result['function'], result['activities']))
+        if base is None:
+            continue
+        for field in ('seconds', 'peak_memory_bytes'):
+            ratio = result[field] / base[field] if base[field] else None
+            result[field + '_ratio'] = None if ratio is None else round(ratio, 3)
+            if field == 'seconds' and result[field] - base[field] < min_difference:
+                continue
+            if ratio is not None and ratio > threshold:
+                regressions.append("{} at {} activities: {} {} vs {} in the baseline ({:.2f}x)".format(
+                    result['function'], result['activities'], field, result[field], base[field], ratio))
+    return regressions
+
+
+def main():
+    """Parses arguments, runs the benchmarks, prints the results and compares them to the baseline"""
+    parser = argparse.ArgumentParser(description="Times the analysis functions on synthetic activity frames")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help="numbers of activities to benchmark")
+    parser.add_argument('--functions', nargs='+', choices=list(BENCHMARKS), default=None, help="functions to benchmark, all by default")
+    parser.add_argument('--repeat', type=int, default=3, help="timed runs of each function, the best is kept")
+    parser.add_argument('--history-days', type=float, default=3650.0, help="days between the oldest and the newest activity")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', dest='json_path', default=None, help="also write the results to this file, e.g. to use as a baseline")
+    parser.add_argument('--baseline', default=None, help="results of an earlier run to compare against")
+    parser.add_argument('--threshold', type=float, default=1.25, help="ratio to the baseline above which a result is a regression")
+    parser.add_argument('--min-difference', type=float, default=0.005, help="seconds a time must exceed the baseline by to be a regression")
+    args = parser.parse_args()
+    results = run_benchmarks(args.sizes, args.functions, args.repeat, args.history_days, args.seed)
+    regressions = []
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as jsonfile:
+            regressions = compare_results(results, json.load(jsonfile)['results'], args.threshold, args.min_difference)
+    print("{:>20} {:>10} {:>10} {:>12} {:>8} {:>8}".format("function", "activities", "seconds", "peak MiB", "time x", "mem x"))
+    for result in results:
+        print("{:>20} {:>10} {:>10.4f} {:>12.1f} {:>8} {:>8}".format(
+            result['function'], result['activities'], result['seconds'], result['peak_memory_bytes'] / 2 ** 20,
+            result.get('seconds_ratio', '-'), result.get('peak_memory_bytes_ratio', '-')))
+    if args.json_path is not None:
+        # The versions are kept so a baseline is only compared with runs on the same stack
+        environment = {'python': platform.python_version(), 'pandas': pd.__version__, 'numpy': np.__version__,
+                       'matplotlib': matplotlib.__version__, 'machine': platform.machine()}
+        with open(args.json_path, 'w') as jsonfile:
+            json.dump({'environment': environment, 'results': results}, jsonfile, indent=2)
+    if regressions != []:
+        print("Regressions above {}x the baseline:".format(args.threshold))
+        for regression in regressions:
+            print("    " + regression)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+""" End-to-end sync benchmark against the offline mock Strava API
+Times a full strava_update() from an empty database for each athlete size and prints a summary table.
+
+    python3 benchmarks/bench_sync.py --sizes 1000 10000 50000
+
+Contains the following functions:
+    run_sync()
+    main()
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+
+from mock_strava import MockStrava
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from stravatracker import update  # noqa: E402
+from stravatracker.first_run import new_config  # noqa: E402
+
+__author__ = "rakeshrgill"
+__email__ = "rakeshrgill@gmail.com"
+
+
+def run_sync(num_activities, page_latency=0.0, detail_latency=0.0, error_rate=0.0, ingest_mode='detail', fetch_streams=False, verbose=False):
+    """Runs one strava_update() from an empty database against a fresh mock server
+
+    Parameters
+    ----------
+    num_activities : int
+        athlete size
+    page_latency : float
+        see MockStrava
+    detail_latency : float
+        see MockStrava
+    error_rate : float
+        see MockStrava
+    ingest_mode : str
+        config['ingest_mode'], 'detail' or 'summary'
+    fetch_streams : bool
+        config['fetch_streams'], also fetch the streams of every activity
+    verbose : bool
+        show the output of strava_update()
+
+    Returns
+    -------
+    dict
+        timings and request counts for the run
+    """
+    config = new_config('1', 'secret', 'refresh')
+    config.update(ingest_mode=ingest_mode, fetch_streams=fetch_streams)
+    # Limits are lifted so the whole athlete is fetched in one run
+    mock = MockStrava(num_activities=num_activities, page_latency=page_latency, detail_latency=detail_latency,
+                      limit_15min=10 ** 9, limit_daily=10 ** 9, error_rate=error_rate)
+    cwd = os.getcwd()
+    with mock, tempfile.TemporaryDirectory() as tmp_dir:
+        os.chdir(tmp_dir)
+        os.mkdir('data')
+        update.API_URL = mock.url + '/api/v3'
+        update.TOKEN_URL = mock.url + '/oauth/token'
+        update.rate_limiter = update.RateLimiter()
+        output = None if verbose else io.StringIO()
+        try:
+            with contextlib.redirect_stdout(output) if output is not None else contextlib.nullcontext():
+                start = time.perf_counter()
+                config, df = update.strava_update(config, None)
+                elapsed = time.perf_counter() - start
+        finally:
+            os.chdir(cwd)
+    fetched = 0 if df is None else df.shape[0]
+    return {
+        'activities': num_activities,
+        'fetched': fetched,
+        'seconds': round(elapsed, 3),
+        'activities_per_second': round(fetched / elapsed, 1) if elapsed > 0 else None,
+        'requests': dict(mock.requests_served),
+        'remaining_updates': config['remaining_updates'],
+    }
+
+
+def main():
+    """Parses arguments, runs the benchmark for each size and prints the results"""
+    parser = argparse.ArgumentParser(description="Times a full strava_update() against the mock Strava API")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 50000], help="athlete sizes to benchmark")
+    parser.add_argument('--page-latency', type=float, default=0.0, help="seconds added to each activity list page")
+    parser.add_argument('--detail-latency', type=float, default=0.0, help="seconds added to each activity detail")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of requests answered with a 429")
+    parser.add_argument('--mode', choices=['detail', 'summary'], default='detail', help="ingest mode of the update")
+    parser.add_argument('--streams', action='store_true', help="also fetch the streams of every activity")
+    parser.add_argument('--json', dest='json_path', default=None, help="also write the results to this file")
+    parser.add_argument('--verbose', action='store_true', help="show the output of strava_update()")
+    args = parser.parse_args()
+    results = []
+    print("{:>10} {:>10} {:>10} {:>12} {:>10}".format("activities", "fetched", "seconds", "activities/s", "requests"))
+    for size in args.sizes:
+        result = run_sync(size, args.page_latency, args.detail_latency, args.error_rate, args.mode, args.streams, args.verbose)
+        results.append(result)
+        print("{:>10} {:>10} {:>10.2f} {:>12} {:>10}".format(result['activities'], result['fetched'], result['seconds'],
+                                                             result['activities_per_second'], sum(result['requests'].values())))
+    if args.json_path is not None:
+        with open(args.json_path, 'w') as jsonfile:
+            json.dump(results, jsonfile, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,510 @@
+""" Offline stand-in for the Strava API, used to benchmark and regression test syncing
+Serves synthetic responses for:
+    POST /oauth/token
+    GET  /api/v3/athlete/activities
+    GET  /api/v3/activities/{id}
+    GET  /api/v3/activities/{id}/streams
+
+Contains the following classes:
+    MockStrava
+    MockStravaHandler(BaseHTTPRequestHandler)
+
+Contains the following functions:
+    make_summary()
+    make_detail()
+    make_streams()
+    main()
+"""
+import argparse
+import datetime as dt
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+__author__ = "rakeshrgill"
+__email__ = "rakeshrgill@gmail.com"
+
+# Oldest synthetic activity starts here, newer ones are spread forwards in time
+START_DATE = dt.datetime(2012, 10, 1, 6, 0, 0, tzinfo=dt.timezone.utc)
+FIRST_ID = 5000000000
+ATHLETE_ID = 1234567
+# type, share of activities, average speed (m/s), has power, has heartrate
+ACTIVITY_TYPES = [
+    ('Run', 0.35, 3.0, False, True),
+    ('Ride', 0.25, 8.0, True, True),
+    ('VirtualRide', 0.10, 9.0, True, True),
+    ('Swim', 0.10, 0.8, False, False),
+    ('WeightTraining', 0.08, 0.0, False, True),
+    ('Workout', 0.04, 0.0, False, True),
+    ('Yoga', 0.03, 0.0, False, False),
+    ('Hike', 0.03, 1.2, False, True),
+    ('RockClimbing', 0.02, 0.0, False, False),
+]
+
+
+def make_summary(number, spacing_days, seed=0):
+    """Builds the list-endpoint (resource_state 2) payload for one synthetic activity
+
+    Parameters
+    ----------
+    number : int
+        0 is the oldest activity, ids and start dates increase with the number
+    spacing_days : float
+        days between consecutive activities
+    seed : int
+        seed for the generator, the same number and seed always give the same activity
+
+    Returns
+    -------
+    dict
+        activity summary in the Strava format
+    """
+    rng = random.Random(seed * 1000003 + number)
+    weights = [item[1] for item in ACTIVITY_TYPES]
+    activity_type, _, speed, has_power, has_hr = rng.choices(ACTIVITY_TYPES, weights)[0]
+    # Jitter stays within half the spacing so that start dates keep the order of the numbers
+    start_date = START_DATE + dt.timedelta(days=spacing_days * (number + rng.uniform(0, 0.5)))
+    start_date = start_date.replace(microsecond=0)
+    moving_time = rng.randint(900, 7200)
+    elapsed_time = moving_time + rng.randint(0, 900)
+    average_speed = round(speed * rng.uniform(0.8, 1.2), 3)
+    summary = {
+        'resource_state': 2,
+        'athlete': {'id': ATHLETE_ID, 'resource_state': 1},
+        'name': '{} {}'.format(activity_type, number),
+        'distance': round(average_speed * moving_time, 1),
+        'moving_time': moving_time,
+        'elapsed_time': elapsed_time,
+        'total_elevation_gain': round(rng.uniform(0, 800), 1),
+        'type': activity_type,
+        'sport_type': activity_type,
+        'workout_type': None,
+        'id': FIRST_ID + number,
+        'start_date': start_date.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'start_date_local': (start_date + dt.timedelta(hours=8)).strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'timezone': '(GMT+08:00) Asia/Singapore',
+        'utc_offset': 28800.0,
+        'achievement_count': rng.randint(0, 5),
+        'kudos_count': rng.randint(0, 30),
+        'comment_count': rng.randint(0, 3),
+        'athlete_count': 1,
+        'photo_count': 0,
+        'map': {'id': 'a{}'.format(FIRST_ID + number), 'summary_polyline': 'abc' * rng.randint(10, 60), 'resource_state': 2},
+        'trainer': activity_type == 'VirtualRide',
+        'commute': False,
+        'manual': False,
+        'private': False,
+        'visibility': 'everyone',
+        'flagged': False,
+        'gear_id': None,
+        'average_speed': average_speed,
+        'max_speed': round(average_speed * 1.6, 3),
+        'has_heartrate': has_hr,
+        'heartrate_opt_out': False,
+        'display_hide_heartrate_option': has_hr,
+        'upload_id': 7000000000 + number,
+        'external_id': 'garmin_push_{}'.format(number),
+        'from_accepted_tag': False,
+        'pr_count': 0,
+        'total_photo_count': 0,
+        'has_kudoed': False,
+    }
+    if has_power:
+        summary['average_watts'] = round(rng.uniform(120, 260), 1)
+        summary['kilojoules'] = round(summary['average_watts'] * moving_time / 1000, 1)
+        summary['device_watts'] = True
+    if has_hr:
+        summary['average_heartrate'] = round(rng.uniform(110, 165), 1)
+        summary['max_heartrate'] = summary['average_heartrate'] + rng.randint(10, 30)
+    return summary
+
+
+def make_detail(number, spacing_days, seed=0):
+    """Builds the detail-endpoint (resource_state 3) payload for one synthetic activity
+
+    Parameters
+    ----------
+    number : int
+        see make_summary()
+    spacing_days : float
+        see make_summary()
+    seed : int
+        see make_summary()
+
+    Returns
+    -------
+    dict
+        detailed activity in the Strava format, including the nested segment, split, lap and best effort arrays
+    """
+    detail = make_summary(number, spacing_days, seed)
+    rng = random.Random(seed * 1000003 + number + 1)
+    detail['resource_state'] = 3
+    detail['description'] = None
+    detail['calories'] = round(detail['moving_time'] / 3600 * rng.uniform(400, 800), 1)
+    detail['device_name'] = 'Garmin Forerunner 945'
+    detail['embed_token'] = '{:040x}'.format(rng.getrandbits(160))
+    detail['map']['polyline'] = 'abcd' * rng.randint(50, 250)
+    detail['map']['resource_state'] = 3
+    detail['photos'] = {'primary': None, 'count': 0}
+    detail['gear'] = None
+    detail['splits_metric'] = []
+    detail['laps'] = []
+    detail['best_efforts'] = []
+    detail['segment_efforts'] = []
+    num_splits = max(1, int(detail['distance'] // 1000))
+    for split in range(min(num_splits, 50)):
+        detail['splits_metric'].append({
+            'distance': 1000.0,
+            'elapsed_time': rng.randint(200, 400),
+            'elevation_difference': round(rng.uniform(-10, 10), 1),
+            'moving_time': rng.randint(200, 400),
+            'split': split + 1,
+            'average_speed': round(detail['average_speed'] * rng.uniform(0.9, 1.1), 2),
+            'pace_zone': 0,
+        })
+    detail['splits_standard'] = detail['splits_metric']
+    for lap in range(rng.randint(1, 5)):
+        detail['laps'].append({
+            'id': (FIRST_ID + number) * 10 + lap,
+            'resource_state': 2,
+            'name': 'Lap {}'.format(lap + 1),
+            'elapsed_time': rng.randint(300, 1800),
+            'moving_time': rng.randint(300, 1800),
+            'distance': round(rng.uniform(500, 5000), 1),
+            'lap_index': lap + 1,
+        })
+    for segment in range(rng.randint(0, 10)):
+        detail['segment_efforts'].append({
+            'id': (FIRST_ID + number) * 100 + segment,
+            'resource_state': 2,
+            'name': 'Segment {}'.format(segment),
+            'elapsed_time': rng.randint(30, 900),
+            'moving_time': rng.randint(30, 900),
+            'distance': round(rng.uniform(200, 5000), 1),
+            'segment': {'id': rng.randint(1, 10 ** 7), 'name': 'Segment {}'.format(segment), 'distance': 1000.0},
+        })
+    return detail
+
+
+def make_streams(number, spacing_days, seed=0):
+    """Builds the streams payload (key_by_type=true) for one synthetic activity, one sample per second of moving time
+
+    Parameters
+    ----------
+    number : int
+        see make_summary()
+    spacing_days : float
+        see make_summary()
+    seed : int
+        see make_summary()
+
+    Returns
+    -------
+    dict
+        stream type: {'data', 'series_type', 'original_size', 'resolution'}
+    """
+    summary = make_summary(number, spacing_days, seed)
+    rng = random.Random(seed * 1000003 + number + 2)
+    size = summary['moving_time']
+    data = {'time': list(range(size)), 'moving': [True] * size}
+    altitude = rng.uniform(0, 500)
+    data['altitude'] = []
+    for _ in range(size):
+        altitude += rng.uniform(-0.5, 0.5)
+        data['altitude'].append(round(altitude, 1))
+    if summary['distance'] > 0:
+        speed = summary['average_speed']
+        data['velocity_smooth'] = [round(speed * rng.uniform(0.7, 1.3), 2) for _ in range(size)]
+        data['distance'] = [round(speed * second, 1) for second in range(size)]
+        lat, lng = 1.35 + rng.uniform(-0.1, 0.1), 103.8 + rng.uniform(-0.1, 0.1)
+        data['latlng'] = [[round(lat + second * 1e-5, 6), round(lng + second * 1e-5, 6)] for second in range(size)]
+        data['grade_smooth'] = [round(rng.uniform(-5, 5), 1) for _ in range(size)]
+    if summary['has_heartrate']:
+        heartrate = summary['average_heartrate']
+        data['heartrate'] = [int(heartrate + rng.uniform(-15, 15)) for _ in range(size)]
+    if 'average_watts' in summary:
+        watts = summary['average_watts']
+        data['watts'] = [max(0, int(watts * rng.uniform(0.2, 1.8))) for _ in range(size)]
+    if summary['type'] in ('Run', 'Ride', 'VirtualRide', 'Hike'):
+        data['cadence'] = [rng.randint(75, 95) for _ in range(size)]
+    return {key: {'data': values, 'series_type': 'distance', 'original_size': size, 'resolution': 'high'} for key, values in data.items()}
+
+
+class MockStrava:
+    """Local mock of the Strava API, run in a background thread
+
+    Parameters
+    ----------
+    num_activities : int
+        athlete size
+    history_days : float
+        days between the oldest and the newest activity, activities added later keep the same spacing
+    page_latency : float
+        seconds added to each /athlete/activities response
+    detail_latency : float
+        seconds added to each /activities/{id} and /activities/{id}/streams response
+    limit_15min : int
+        X-RateLimit-Limit for the 15 minute window
+    limit_daily : int
+        X-RateLimit-Limit for the daily window
+    error_rate : float
+        probability of answering an API request with an injected 429
+    seed : int
+        seed for the synthetic activities
+    port : int
+        0 picks a free port
+
+    Attributes
+    ----------
+    url : str
+        base url of the server, e.g. http://127.0.0.1:8000
+    requests_served : dict
+        number of responses per endpoint
+    requests_by_token : dict
+        number of API requests per access token, each refresh token is given its own access token
+    edits : dict
+        activity number: fields changed on strava (see edit_activity())
+    deleted : set
+        activity numbers deleted on strava
+    """
+
+    def __init__(self, num_activities=1000, history_days=3650.0, page_latency=0.0, detail_latency=0.0,
+                 limit_15min=100, limit_daily=1000, error_rate=0.0, seed=0, port=0):
+        self.num_activities = num_activities
+        self.spacing_days = history_days / max(num_activities, 1)
+        self.page_latency = page_latency
+        self.detail_latency = detail_latency
+        self.limit_15min = limit_15min
+        self.limit_daily = limit_daily
+        self.error_rate = error_rate
+        self.seed = seed
+        self.port = port
+        self.requests_served = {'token': 0, 'list': 0, 'detail': 0, 'streams': 0, '429': 0}
+        self.requests_by_token = {}
+        self.edits = {}
+        self.deleted = set()
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._window_15min = None
+        self._window_daily = None
+        self._usage_15min = 0
+        self._usage_daily = 0
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        """Starts serving in a daemon thread and returns self"""
+        handler = type('BoundHandler', (MockStravaHandler,), {'mock': self})
+        self._server = ThreadingHTTPServer(('127.0.0.1', self.port), handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stops the server"""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def add_activities(self, num_activities):
+        """Uploads new activities, newer than all the existing ones"""
+        self.num_activities += num_activities
+
+    def edit_activity(self, number, **fields):
+        """Edits an activity as the athlete would on strava, e.g. edit_activity(3, type='Run', moving_time=1200)"""
+        self.edits.setdefault(number, {}).update(fields)
+
+    def delete_activity(self, number):
+        """Deletes an activity, it is no longer listed and its detail and streams are not found"""
+        self.deleted.add(number)
+
+    def exists(self, number):
+        """Returns True if activity number has been uploaded and not deleted"""
+        return 0 <= number < self.num_activities and number not in self.deleted
+
+    def summary(self, number):
+        """Returns the list entry of activity number with its edits, see make_summary()"""
+        return dict(make_summary(number, self.spacing_days, self.seed), **self.edits.get(number, {}))
+
+    def detail(self, number):
+        """Returns the detail of activity number with its edits, see make_detail()"""
+        return dict(make_detail(number, self.spacing_days, self.seed), **self.edits.get(number, {}))
+
+    def start_timestamp(self, number):
+        """Start date of activity number as a unix timestamp"""
+        start_date = make_summary(number, self.spacing_days, self.seed)['start_date']
+        return dt.datetime.strptime(start_date, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=dt.timezone.utc).timestamp()
+
+    def count_request(self):
+        """Counts a request against the rate limit
+
+        Returns
+        -------
+        bool, dict
+            allowed?, rate limit headers
+        """
+        now = dt.datetime.utcnow()
+        window_15min = (now.year, now.month, now.day, now.hour, now.minute // 15)
+        window_daily = (now.year, now.month, now.day)
+        with self._lock:
+            if window_15min != self._window_15min:
+                self._window_15min = window_15min
+                self._usage_15min = 0
+            if window_daily != self._window_daily:
+                self._window_daily = window_daily
+                self._usage_daily = 0
+            self._usage_15min += 1
+            self._usage_daily += 1
+            allowed = self._usage_15min <= self.limit_15min and self._usage_daily <= self.limit_daily
+            if allowed and self.error_rate > 0 and self._rng.random() < self.error_rate:
+                # Injected transient throttle, the usage headers still show budget left
+                allowed = False
+            headers = {
+                'X-RateLimit-Limit': '{},{}'.format(self.limit_15min, self.limit_daily),
+                'X-RateLimit-Usage': '{},{}'.format(self._usage_15min, self._usage_daily),
+            }
+            if not allowed:
+                self.requests_served['429'] += 1
+        return allowed, headers
+
+
+class MockStravaHandler(BaseHTTPRequestHandler):
+    """Request handler, bound to a MockStrava instance through the mock class attribute"""
+    mock = None
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, obj, headers=None):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        form = parse_qs(self.rfile.read(length).decode('utf-8'))
+        if urlparse(self.path).path != '/oauth/token':
+            self.send_json(404, {'message': 'Record Not Found'})
+            return
+        self.mock.requests_served['token'] += 1
+        expires_at = int(time.time()) + 21600
+        # Refresh tokens are rotated as 'athlete.N', the access token stays per athlete
+        athlete, _, rotation = form.get('refresh_token', [''])[0].partition('.')
+        self.send_json(200, {
+            'token_type': 'Bearer',
+            'access_token': 'mock_access_token_' + athlete,
+            'expires_at': expires_at,
+            'expires_in': 21600,
+            'refresh_token': '{}.{}'.format(athlete, int(rotation or 0) + 1),
+        })
+
+    def do_GET(self):
+        mock = self.mock
+        parsed = urlparse(self.path)
+        query = parse_qs(parsed.query)
+        parts = parsed.path.strip('/').split('/')
+        if parts[:2] != ['api', 'v3']:
+            self.send_json(404, {'message': 'Record Not Found'})
+            return
+        allowed, headers = mock.count_request()
+        token = self.headers.get('Authorization', '')[len('Bearer '):]
+        with mock._lock:
+            mock.requests_by_token[token] = mock.requests_by_token.get(token, 0) + 1
+        if not allowed:
+            self.send_json(429, {'message': 'Rate Limit Exceeded', 'errors': [{'resource': 'Application', 'field': 'rate limit', 'code': 'exceeded'}]}, headers)
+            return
+        if parts[2:] == ['athlete', 'activities']:
+            time.sleep(mock.page_latency)
+            mock.requests_served['list'] += 1
+            self.send_json(200, self.list_page(query), headers)
+        elif len(parts) == 4 and parts[2] == 'activities' and parts[3].isdigit():
+            time.sleep(mock.detail_latency)
+            mock.requests_served['detail'] += 1
+            number = int(parts[3]) - FIRST_ID
+            if mock.exists(number):
+                self.send_json(200, mock.detail(number), headers)
+            else:
+                self.send_json(404, {'message': 'Record Not Found'}, headers)
+        elif len(parts) == 5 and parts[2] == 'activities' and parts[3].isdigit() and parts[4] == 'streams':
+            time.sleep(mock.detail_latency)
+            mock.requests_served['streams'] += 1
+            number = int(parts[3]) - FIRST_ID
+            if mock.exists(number):
+                self.send_json(200, make_streams(number, mock.spacing_days, mock.seed), headers)
+            else:
+                self.send_json(404, {'message': 'Record Not Found'}, headers)
+        else:
+            self.send_json(404, {'message': 'Record Not Found'}, headers)
+
+    def list_page(self, query):
+        """Returns one page of summaries, newest first, or oldest first when after is given (as strava does)"""
+        mock = self.mock
+        page = int(query.get('page', ['1'])[0])
+        per_page = min(int(query.get('per_page', ['30'])[0]), 200)
+        numbers = range(mock.num_activities - 1, -1, -1)
+        if 'after' in query:
+            after = float(query['after'][0])
+            # Start dates increase with the number, find the first activity after the timestamp
+            low, high = 0, mock.num_activities
+            while low < high:
+                mid = (low + high) // 2
+                if mock.start_timestamp(mid) > after:
+                    high = mid
+                else:
+                    low = mid + 1
+            numbers = range(low, mock.num_activities)
+        if mock.deleted:
+            numbers = [number for number in numbers if number not in mock.deleted]
+        start = (page - 1) * per_page
+        return [mock.summary(number) for number in numbers[start:start + per_page]]
+
+
+def main():
+    """Runs the mock server in the foreground"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--activities', type=int, default=1000)
+    parser.add_argument('--history-days', type=float, default=3650.0)
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--page-latency', type=float, default=0.0)
+    parser.add_argument('--detail-latency', type=float, default=0.0)
+    parser.add_argument('--limit-15min', type=int, default=100)
+    parser.add_argument('--limit-daily', type=int, default=1000)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    mock = MockStrava(num_activities=args.activities, history_days=args.history_days, page_latency=args.page_latency, detail_latency=args.detail_latency,
+                      limit_15min=args.limit_15min, limit_daily=args.limit_daily, error_rate=args.error_rate,
+                      seed=args.seed, port=args.port)
+    mock.start()
+    print("Mock Strava API serving on {}".format(mock.url))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        mock.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+""" Deterministic generator of synthetic activity frames, shaped like the frames read from the activity store
+Activities follow the mix of types, speeds, power meters and heart rate monitors of the mock Strava API (see ACTIVITY_TYPES),
+spread over a multi-year history. The whole frame is drawn at once with numpy, so a million activities take a few seconds,
+and the same size, history and seed always give the same frame.
+
+    python3 benchmarks/synthetic.py --activities 100000 --output activities.csv
+
+Contains the following functions:
+    make_activities()
+        compact_dtypes() - imported
+    main()
+"""
+import argparse
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from mock_strava import ACTIVITY_TYPES, START_DATE, FIRST_ID
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from stravatracker.store import compact_dtypes  # noqa: E402
+
+__author__ = "rakeshrgill"
+__email__ = "rakeshrgill@gmail.com"
+
+# Hours added to the utc start date to give the local one, as the mock athlete
+UTC_OFFSET_HOURS = 8
+
+
+def make_activities(num_activities, history_days=3650.0, seed=0):
+    """Builds a frame of synthetic detailed activities
+
+    Parameters
+    ----------
+    num_activities : int
+        number of activities
+    history_days : float
+        days between the oldest and the newest activity
+    seed : int
+        seed for the generator
+
+    Returns
+    -------
+    pandas.DataFrame
+        columns of store.LOAD_COLUMNS, newest first, converted by compact_dtypes() as load_activities() returns them
+    """
+    rng = np.random.default_rng(seed)
+    names = np.array([item[0] for item in ACTIVITY_TYPES])
+    shares = np.array([item[1] for item in ACTIVITY_TYPES])
+    speeds = np.array([item[2] for item in ACTIVITY_TYPES])
+    has_power = np.array([item[3] for item in ACTIVITY_TYPES])
+    has_hr = np.array([item[4] for item in ACTIVITY_TYPES])
+    type_idx = rng.choice(len(ACTIVITY_TYPES), size=num_activities, p=shares / shares.sum())
+    # Start dates increase with the id, as on strava
+    offsets = np.sort(rng.uniform(0, history_days * 86400, num_activities)).astype('int64')
+    start_date = pd.Timestamp(START_DATE).tz_localize(None) + pd.to_timedelta(offsets, unit='s')
+    moving_time = rng.integers(900, 7201, num_activities)
+    elapsed_time = moving_time + rng.integers(0, 901, num_activities)
+    average_speed = np.round(speeds[type_idx] * rng.uniform(0.8, 1.2, num_activities), 3)
+    average_watts = np.where(has_power[type_idx], np.round(rng.uniform(120, 260, num_activities), 1), np.nan)
+    average_heartrate = np.where(has_hr[type_idx], np.round(rng.uniform(110, 165, num_activities), 1), np.nan)
+    number = np.arange(num_activities)
+    activity_type = pd.Categorical.from_codes(type_idx, categories=names)
+    df = pd.DataFrame({
+        'id': FIRST_ID + number,
+        'resource_state': 3,
+        'name': pd.Series(names[type_idx]).str.cat(number.astype(str), sep=' '),
+        'type': activity_type,
+        'start_date': start_date,
+        'start_date_local': start_date + pd.Timedelta(hours=UTC_OFFSET_HOURS),
+        'moving_time': moving_time,
+        'elapsed_time': elapsed_time,
+        'distance': np.round(average_speed * moving_time, 1),
+        'average_speed': average_speed,
+        'average_watts': average_watts,
+        'average_heartrate': average_heartrate,
+        'calories': np.round(moving_time * rng.uniform(0.1, 0.25, num_activities), 1),
+    })
+    return compact_dtypes(df.iloc[::-1].reset_index(drop=True))
+
+
+def main():
+    """Writes a synthetic frame to a CSV file"""
+    parser = argparse.ArgumentParser(description="Writes a deterministic synthetic activity frame")
+    parser.add_argument('--activities', type=int, default=10000, help="number of activities")
+    parser.add_argument('--history-days', type=float, default=3650.0, help="days between the oldest and the newest activity")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='activities.csv', help="CSV file to write")
+    args = parser.parse_args()
+    df = make_activities(args.activities, args.history_days, args.seed)
+    df.to_csv(args.output, index=False)
+    print("{} activities written to {}".format(df.shape[0], args.output))
+
+
+if __name__ == '__main__':
+    main()
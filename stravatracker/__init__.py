@@ -1 +1,21 @@
-# __all__ = ["echo", "surround", "reverse"]
+""" Stravatracker, tracks strava workouts
+Run the program with
+
+    python3 -m stravatracker
+
+or use the library functions, which run without the menu:
+    sync() - downloads new activities into the database
+    load() - returns the activities as a pandas.DataFrame
+    analyze() - writes the tables and shows the graphs
+    sync_athletes() - syncs every athlete profile in athletes/ within the application's rate limits
+
+Importing the package does not run the program. pandas, matplotlib and PIL are imported by the functions which need them,
+so a scheduled sync starts quickly and checking whether an update is allowed does not load them.
+"""
+from .stravatracker import sync, load, analyze, program
+from .athletes import sync_athletes
+
+__author__ = "rakeshrgill"
+__email__ = "rakeshrgill@gmail.com"
+
+__all__ = ["sync", "load", "analyze", "program", "sync_athletes"]
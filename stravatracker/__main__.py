@@ -0,0 +1,8 @@
+""" Entry point, python3 -m stravatracker runs the program, see main() """
+from .stravatracker import main
+
+__author__ = "rakeshrgill"
+__email__ = "rakeshrgill@gmail.com"
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,313 @@
+""" Defines the aggregate store, the yearly and monthly tables kept up to date from the activities changed by each update
+Totals per day and type are stored in agg_daily. The yearly and monthly tables in agg_period are recomputed from agg_daily,
+only for the periods containing a changed day, so the cost of an update scales with the new activities rather than the history.
+Updates only touch the changed days, so they are applied on top of a full build: rebuild_aggregates() marks the aggregates
+as complete, and any aggregates without the mark (e.g. a database imported from a csv by an older version) are rebuilt first.
+The mark holds a hash of the activity rules (see rules_hash()), so editing the rules also rebuilds them.
+
+Contains the following functions:
+    connect()
+    new_version()
+    aggregates_model()
+        rules_hash() - imported
+    aggregates_current()
+    update_aggregates()
+        aggregates_current()
+        rebuild_aggregates()
+        activity_days()
+        write_aggregates()
+            daily_totals()
+                excel_clean() - imported
+                pandas_df_converter() - imported
+                daily_totals() - imported from analysis
+    rebuild_aggregates()
+        write_aggregates()
+    load_daily_matrix()
+        aggregates_version()
+        rules_hash() - imported
+        daily_matrix() - imported from analysis
+    load_table_ls()
+        load_period_table()
+"""
+import os
+import uuid
+import sqlite3
+import datetime as dt
+
+import pandas as pd
+
+from .store import STORE_PATH
+from .analysis import excel_clean, pandas_df_converter, rules_hash
+from .analysis import daily_totals as analysis_daily_totals
+from .analysis import daily_matrix
+
+__author__ = "rakeshrgill"
+__email__ = "rakeshrgill@gmail.com"
+
+# Version of the aggregate tables, aggregates built by another version are rebuilt
+AGGREGATES_VERSION = '1'
+# Length of the day string ('YYYY-MM-DD') which identifies each period
+PERIOD_KEYS = {"Y": 4, "M": 7}
+# Daily matrix of the graphs, cached with the version of agg_daily and the rules it was built from
+MATRIX_PATH = os.path.join('data', 'daily_matrix.pkl')
+
+
+def connect(path=STORE_PATH):
+    """Opens the store, creating the aggregate tables if needed"""
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS agg_daily (day TEXT, type TEXT, duration REAL, number_of_ex INTEGER, PRIMARY KEY (day, type))")
+    conn.execute("CREATE TABLE IF NOT EXISTS agg_period (freq TEXT, period TEXT, type TEXT, duration REAL, number_of_ex INTEGER, days_of_ex INTEGER, "
+                 "PRIMARY KEY (freq, period, type))")
+    conn.execute("CREATE TABLE IF NOT EXISTS agg_meta (key TEXT PRIMARY KEY, value TEXT)")
+    return conn
+
+
+def new_version(conn):
+    """Marks the aggregates as changed, invalidating the cached daily matrix (see load_daily_matrix()).
+    A random token is used so a rebuilt database never matches an old cache"""
+    conn.execute("INSERT OR REPLACE INTO agg_meta (key, value) VALUES ('version', ?)", (uuid.uuid4().hex,))
+
+
+def aggregates_version(conn):
+    """Returns the token written by new_version(), None if the aggregates have never been written"""
+    row = conn.execute("SELECT value FROM agg_meta WHERE key = 'version'").fetchone()
+    return None if row is None else row[0]
+
+
+def aggregates_model():
+    """Returns what the aggregates depend on as a string, the table version and the activity rules.
+    Written by rebuild_aggregates() once every day has been built"""
+    return '{}:{}'.format(AGGREGATES_VERSION, rules_hash())
+
+
+def aggregates_current(path=STORE_PATH):
+    """Returns True if the aggregates have been built in full with the current model, see rebuild_aggregates()"""
+    conn = connect(path)
+    try:
+        row = conn.execute("SELECT value FROM agg_meta WHERE key = 'model'").fetchone()
+    finally:
+        conn.close()
+    return row is not None and row[0] == aggregates_model()
+
+
+def activity_days(df):
+    """Returns the local start day of each activity as a 'YYYY-MM-DD' string series, activities without a date are left out"""
+    return pd.to_datetime(df['start_date_local']).dt.strftime('%Y-%m-%d').dropna()
+
+
+def daily_totals(df):
+    """Totals the duration and number of activities per day, by type and for type 'All'
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        contains activities downloaded from strava, with segments dropped (see get_new_activities())
+
+    Returns
+    -------
+    pandas.DataFrame
+        columns day, type, duration, number_of_ex
+    """
+    daily_df = analysis_daily_totals(pandas_df_converter(excel_clean(df)))
+    daily_df['day'] = daily_df['start_date_local'].dt.strftime('%Y-%m-%d')
+    return daily_df[['day', 'type', 'duration', 'number_of_ex']]
+
+
+def write_aggregates(conn, df, day_ls):
+    """Replaces the daily totals of the days in day_ls and recomputes the periods containing them
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        see connect()
+    df : pandas.DataFrame
+        contains at least every activity on the days in day_ls
+    day_ls : list
+        'YYYY-MM-DD' days to recompute
+    """
+    day_set = set(day_ls)
+    day_df = None
+    if df is not None and df.shape[0] > 0:
+        days = activity_days(df)
+        day_df = df.loc[days.index[days.isin(day_set)]]
+    with conn:
+        new_version(conn)
+        conn.executemany("DELETE FROM agg_daily WHERE day = ?", [(day,) for day in day_set])
+        if day_df is not None and day_df.shape[0] > 0:
+            daily_df = daily_totals(day_df)
+            conn.executemany("INSERT INTO agg_daily (day, type, duration, number_of_ex) VALUES (?, ?, ?, ?)",
+                             [(row[0], row[1], float(row[2]), int(row[3])) for row in daily_df.itertuples(index=False, name=None)])
+        for freq, key_len in PERIOD_KEYS.items():
+            period_set = {day[:key_len] for day in day_set}
+            conn.executemany("DELETE FROM agg_period WHERE freq = ? AND period = ?", [(freq, period) for period in period_set])
+            # Each agg_daily row is one day with at least one activity of the type
+            conn.executemany("INSERT INTO agg_period (freq, period, type, duration, number_of_ex, days_of_ex) "
+                             "SELECT ?, substr(day, 1, ?), type, SUM(duration), SUM(number_of_ex), COUNT(*) FROM agg_daily "
+                             "WHERE substr(day, 1, ?) = ? GROUP BY type",
+                             [(freq, key_len, key_len, period) for period in period_set])
+
+
+def update_aggregates(new_df, previous, changed_id_list, deleted_id_list, path=STORE_PATH):
+    """Updates the aggregates with the activities changed by an update (see save_activities()).
+    Aggregates which are not complete or were built with another model are rebuilt from new_df instead
+
+    Parameters
+    ----------
+    new_df : pandas.DataFrame
+        activities after the update
+    previous : pandas.DataFrame or None
+        activities before the update
+    changed_id_list : list
+        ids written to the store
+    deleted_id_list : list
+        ids removed from the store
+    path : pathname
+        location of the SQLite database
+    """
+    if not aggregates_current(path):
+        rebuild_aggregates(new_df, path)
+        return
+    day_set = set()
+    if changed_id_list != []:
+        day_set.update(activity_days(new_df[new_df['id'].isin(changed_id_list)]))
+    if previous is not None and previous.shape[0] > 0:
+        # An edit can move an activity to another day or type
+        day_set.update(activity_days(previous[previous['id'].isin(changed_id_list + deleted_id_list)]))
+    if day_set == set():
+        return
+    conn = connect(path)
+    try:
+        write_aggregates(conn, new_df, list(day_set))
+    finally:
+        conn.close()
+
+
+def rebuild_aggregates(df, path=STORE_PATH):
+    """Recomputes every aggregate from df and marks them as complete (see aggregates_current())
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        contains activities downloaded from strava, with segments dropped (see get_new_activities())
+    path : pathname
+        location of the SQLite database
+    """
+    conn = connect(path)
+    try:
+        with conn:
+            conn.execute("DELETE FROM agg_daily")
+            conn.execute("DELETE FROM agg_period")
+            conn.execute("DELETE FROM agg_meta WHERE key = 'model'")
+            new_version(conn)
+        if df is not None and df.shape[0] > 0:
+            write_aggregates(conn, df, activity_days(df).unique().tolist())
+        # Only marked once every day is written, an interrupted rebuild is started again
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO agg_meta (key, value) VALUES ('model', ?)", (aggregates_model(),))
+    finally:
+        conn.close()
+
+
+def load_daily_matrix(path=STORE_PATH, cache_path=MATRIX_PATH):
+    """Returns the daily matrix of the graphs (see daily_matrix()), built from agg_daily.
+    The matrix is cached on disk and only rebuilt after the aggregates or the activity rules have changed
+
+    Parameters
+    ----------
+    path : pathname
+        location of the SQLite database
+    cache_path : pathname
+        location of the cached matrix
+
+    Returns
+    -------
+    pandas.Dataframe
+        see daily_matrix()
+    """
+    conn = connect(path)
+    try:
+        version = aggregates_version(conn)
+        if version is None:
+            # Aggregates written before versions were kept
+            with conn:
+                new_version(conn)
+            version = aggregates_version(conn)
+        rules = rules_hash()
+        try:
+            cached = pd.read_pickle(cache_path)
+        except (FileNotFoundError, EOFError, ValueError):
+            cached = None
+        if cached is not None and cached['version'] == version and cached.get('rules') == rules:
+            return cached['matrix']
+        daily_df = pd.read_sql_query("SELECT day AS start_date_local, type, duration, number_of_ex FROM agg_daily", conn, parse_dates=['start_date_local'])
+    finally:
+        conn.close()
+    matrix = daily_matrix(daily_df)
+    pd.to_pickle({'version': version, 'rules': rules, 'matrix': matrix}, cache_path)
+    return matrix
+
+
+def load_period_table(period_df, freq_str):
+    """Formats aggregate rows like create_table(), indexed by the period end date and type
+
+    Parameters
+    ----------
+    period_df : pandas.DataFrame
+        columns period, type, duration, number_of_ex, days_of_ex
+    freq_str : str
+        "Y","M"
+
+    Returns
+    -------
+    pandas.Dataframe
+        for comparison, empty with the same index and columns if period_df is empty
+    """
+    if period_df.shape[0] == 0:
+        # e.g. the year to date table on the 1st of January, before the first activity of the year
+        empty_index = pd.MultiIndex.from_arrays([pd.DatetimeIndex([]), pd.Index([], dtype='object')], names=['start_date_local', 'type'])
+        return pd.DataFrame({'duration': pd.Series(dtype='float64'), 'number_of_ex': pd.Series(dtype='int64'),
+                             'days_of_ex': pd.Series(dtype='int64')}, index=empty_index)
+    period_index = pd.PeriodIndex(period_df['period'], freq=freq_str)
+    period_df = period_df.assign(start_date_local=period_index.to_timestamp(how='end').normalize())
+    table_df = period_df.set_index(['start_date_local', 'type'])[['duration', 'number_of_ex', 'days_of_ex']]
+    # As with create_table(), 'All' has a row for every period in the range, including periods without activities
+    all_range = pd.period_range(period_index.min(), period_index.max(), freq=freq_str).to_timestamp(how='end').normalize()
+    all_index = pd.MultiIndex.from_product([all_range, ['All']], names=['start_date_local', 'type'])
+    missing = all_index[~all_index.isin(table_df.index)]
+    empty_df = pd.DataFrame({'duration': 0.0, 'number_of_ex': 0, 'days_of_ex': 0}, index=missing)
+    return pd.concat([table_df, empty_df]).sort_index()
+
+
+def load_table_ls(freq_ls, path=STORE_PATH):
+    """Returns the same list of tables as return_table_ls(), read from the aggregates
+
+    Parameters
+    ----------
+    freq_ls : list
+        of Frequencies in the format of strings, "Y" or "M"
+    path : pathname
+        location of the SQLite database
+
+    Returns
+    -------
+    list
+        list of dataframes
+    """
+    day_of_year = int(dt.datetime.today().strftime("%j"))
+    cols = ['period', 'type', 'duration', 'number_of_ex', 'days_of_ex']
+    table_ls = []
+    conn = connect(path)
+    try:
+        for freq_str in freq_ls:
+            period_df = pd.read_sql_query("SELECT period, type, duration, number_of_ex, days_of_ex FROM agg_period WHERE freq = ?", conn, params=(freq_str,))
+            table_ls.append(load_period_table(period_df[cols], freq_str))
+            if freq_str == "Y":
+                # Compare progress to the current date
+                ytd_df = pd.read_sql_query("SELECT substr(day, 1, 4) AS period, type, SUM(duration) AS duration, SUM(number_of_ex) AS number_of_ex, "
+                                           "COUNT(*) AS days_of_ex FROM agg_daily WHERE CAST(strftime('%j', day) AS INTEGER) <= ? "
+                                           "GROUP BY period, type", conn, params=(day_of_year,))
+                table_ls.append(load_period_table(ytd_df[cols], freq_str))
+    finally:
+        conn.close()
+    return table_ls
@@ -1,72 +1,194 @@
 """ Defines functions for running analysis
 Contains the following functions:
     excel_clean()
+        load_rules()
+        compile_rules()
+    rules_hash()
+        load_rules()
     pandas_df_converter()
     return_table_ls()
-        create_table()
-            return_data_frame_all()
+        aggregate()
+            daily_totals()
+        long_to_table()
+    create_table()
+        aggregate()
+        long_to_table()
     graph_plots()
+        daily_totals()
+        daily_matrix()
+        graph_series()
+        graph_names()
+        plot_duration(), plot_days(), plot_duration_weekday(), plot_duration_weekday_year(), plot_days_weekday(), plot_days_weekday_year()
+            plot_cumulative()
+        plot_training_load()
+    save_graphs()
+        daily_totals()
+        daily_matrix()
+        graph_series()
+        graph_names()
+        render_graph()
 """
+import os
+import json
+import hashlib
 import datetime as dt
+from concurrent.futures import ProcessPoolExecutor
 
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
 
 __author__ = "rakeshrgill"
 __email__ = "rakeshrgill@gmail.com"
 
+RULES_PATH = os.path.join('data', 'activity_rules.json')
+# Metrics which are only kept for the activity types listing them
+RULE_METRICS = ['average_watts', 'average_pace_run', 'average_pace_swim', 'average_heartrate']
+# Rule used for types without one, and for the fields a rule leaves out. 'time' is 'moving_time' or 'elapsed_time'
+DEFAULT_RULE = {
+    'rename': None,
+    'time': 'moving_time',
+    'metrics': ['average_heartrate'],
+    'distance': True
+}
+# Activity type: rule. Renamed types take the rule of their new name.
+# Sports can be added or changed in data/activity_rules.json (see load_rules())
+ACTIVITY_RULES = {
+    'Ride': {'rename': 'Bike'},
+    'VirtualRide': {'rename': 'Bike'},
+    'WeightTraining': {'rename': 'Strength'},
+    'Workout': {'rename': 'Strength'},
+    'Bike': {'metrics': ['average_watts', 'average_heartrate']},
+    'Run': {'metrics': ['average_pace_run', 'average_heartrate']},
+    'Hike': {'metrics': ['average_pace_run', 'average_heartrate']},
+    'Swim': {'time': 'elapsed_time', 'metrics': ['average_pace_swim']},
+    'Strength': {'distance': False},
+    'Yoga': {'distance': False},
+    'RockClimbing': {'distance': False}
+}
 
-def excel_clean(df):
-    """Cleans data and converts it into an excel format
+
+def load_rules(path=RULES_PATH):
+    """Returns ACTIVITY_RULES updated with the rules in activity_rules.json, if the file exists.
+    The file has the same format as ACTIVITY_RULES, a rule given for a type replaces the listed fields of the default rule
+
+    Parameters
+    ----------
+    path : pathname
+        location of JSON file
+
+    Returns
+    -------
+    dict
+        activity type: rule
+    """
+    rules = {activity_type: dict(rule) for activity_type, rule in ACTIVITY_RULES.items()}
+    try:
+        with open(path, 'r') as jsonfile:
+            custom_rules = json.load(jsonfile)
+    except FileNotFoundError:
+        return rules
+    for activity_type, rule in custom_rules.items():
+        rules.setdefault(activity_type, {}).update(rule)
+    return rules
+
+
+def rules_hash(rules=None):
+    """Returns a hash of the rules as resolved against DEFAULT_RULE. It is stored with the aggregates, the training loads
+    and the daily matrix, which are rebuilt when it changes, e.g. after data/activity_rules.json is edited
+
+    Parameters
+    ----------
+    rules : dict or None
+        see load_rules(), None loads the rules from disk
+
+    Returns
+    -------
+    str
+    """
+    if rules is None:
+        rules = load_rules()
+    resolved = {activity_type: dict(DEFAULT_RULE, **rule) for activity_type, rule in rules.items()}
+    # Types without a rule take the default, so it is part of the hash
+    resolved_json = json.dumps({'default': DEFAULT_RULE, 'rules': resolved}, sort_keys=True)
+    return hashlib.sha256(resolved_json.encode('utf-8')).hexdigest()[:16]
+
+
+def compile_rules(rules, categories):
+    """Resolves the rule of every activity type once, as arrays indexed by the category codes of the type column.
+    The last element of each array holds the default rule, which is used for missing types (code -1)
+
+    Parameters
+    ----------
+    rules : dict
+        see load_rules()
+    categories : list
+        activity types after renaming
+
+    Returns
+    -------
+    dict
+        is_elapsed (bool array), has_distance (bool array), metrics (dict of metric: bool array)
+    """
+    resolved_ls = [dict(DEFAULT_RULE, **rules.get(activity_type, {})) for activity_type in categories] + [dict(DEFAULT_RULE)]
+    compiled = {
+        'is_elapsed': np.array([rule['time'] == 'elapsed_time' for rule in resolved_ls]),
+        'has_distance': np.array([bool(rule['distance']) for rule in resolved_ls]),
+        'metrics': {metric: np.array([metric in rule['metrics'] for rule in resolved_ls]) for metric in RULE_METRICS}
+    }
+    return compiled
+
+
+def excel_clean(df, rules=None):
+    """Cleans data and converts it into an excel format.
+    Activity types are renamed and their metrics filtered by the rules table (see ACTIVITY_RULES), df is not modified
 
     Parameters
     ----------
     df : pandas.DataFrame
         contains activities downloaded from strava, with segments dropped (see get_new_activities())
+    rules : dict or None
+        see load_rules(), None loads the rules from disk
 
     Returns
     -------
     pandas.Dataframe
         excel_df (Key columns in excel format)
     """
-    strava_df = df
+    if rules is None:
+        rules = load_rules()
+    # Rename Activity Types, on the categories rather than every row
+    type_cat = df['type'].astype('category')
+    renames = {activity_type: rules.get(activity_type, {}).get('rename') or activity_type for activity_type in type_cat.cat.categories}
+    type_cat = type_cat.map(renames).astype('category')
+    codes = type_cat.cat.codes.to_numpy()
+    compiled = compile_rules(rules, list(type_cat.cat.categories))
     # Break date into start time and date
-    strava_df['start_date_local'] = pd.to_datetime(strava_df['start_date_local'])
-    strava_df['start_time'] = strava_df['start_date_local'].dt.time
-    strava_df['start_date_local'] = strava_df['start_date_local'].dt.date
-    # Rename Activity Types
-    strava_df['type'] = strava_df['type'].replace({'VirtualRide': 'Bike', 'Ride': 'Bike', 'WeightTraining': 'Strength', 'Workout': 'Strength'})
-    strava_df['moving_time'] = strava_df['moving_time'] / 86400
-    strava_df['elapsed_time'] = strava_df['elapsed_time'] / 86400
-    strava_df['distance'] = strava_df['distance'] / 1000
-    strava_df['average_pace_run'] = (1 / strava_df['average_speed']) * (1000 / 86400)
-    strava_df['average_pace_swim'] = ((1 / strava_df['average_speed']) * (1000 / 86400)) / 10
-    # Swim
-    strava_df['excel_time'] = strava_df['moving_time']
-    strava_df.loc[strava_df['type'] == 'Swim', "excel_time"] = strava_df['elapsed_time']
-    # Core Sports
-    strava_df.loc[(strava_df['type'] != 'Run') & (strava_df['type'] != 'Hike'), "average_pace_run"] = np.NaN
-    strava_df.loc[strava_df['type'] != 'Swim', "average_pace_swim"] = np.NaN
-    strava_df.loc[strava_df['type'] != 'Bike', "average_watts"] = np.NaN
-    strava_df.loc[strava_df['type'] == 'Swim', "average_heartrate"] = np.NaN
-    # Non distance sports
-    strava_df.loc[strava_df['type'] == 'Strength', "distance"] = np.NaN
-    strava_df.loc[strava_df['type'] == 'Yoga', "distance"] = np.NaN
-    strava_df.loc[strava_df['type'] == 'RockClimbing', "distance"] = np.NaN
-    # Extract Columns
-    key_cols = ['start_date_local',
-                'type',
-                'excel_time',
-                'distance',
-                'average_watts',
-                'average_pace_run',
-                'average_pace_swim',
-                'calories',
-                'average_heartrate'
-                ]
-    excel_df = strava_df[key_cols]
+    start_date_local = pd.to_datetime(df['start_date_local'])
+    moving_time = df['moving_time'].to_numpy(dtype='float64') / 86400
+    elapsed_time = df['elapsed_time'].to_numpy(dtype='float64') / 86400
+    distance = df['distance'].to_numpy(dtype='float64') / 1000
+    average_speed = df['average_speed'].to_numpy(dtype='float64')
+    with np.errstate(divide='ignore'):
+        average_pace_run = (1 / average_speed) * (1000 / 86400)
+    metric_values = {
+        'average_watts': df['average_watts'].to_numpy(dtype='float64'),
+        'average_pace_run': average_pace_run,
+        'average_pace_swim': average_pace_run / 10,
+        'average_heartrate': df['average_heartrate'].to_numpy(dtype='float64')
+    }
+    # Every rule is a lookup by category code, applied in one pass over the rows
+    metric_cols = {metric: np.where(compiled['metrics'][metric][codes], values, np.NaN) for metric, values in metric_values.items()}
+    excel_df = pd.DataFrame({
+        'start_date_local': start_date_local.dt.date,
+        'type': type_cat,
+        'excel_time': np.where(compiled['is_elapsed'][codes], elapsed_time, moving_time),
+        'distance': np.where(compiled['has_distance'][codes], distance, np.NaN),
+        'average_watts': metric_cols['average_watts'],
+        'average_pace_run': metric_cols['average_pace_run'],
+        'average_pace_swim': metric_cols['average_pace_swim'],
+        'calories': df['calories'].to_numpy(dtype='float64'),
+        'average_heartrate': metric_cols['average_heartrate']
+    }, index=df.index)
     return excel_df
 
 
@@ -93,7 +215,9 @@ def pandas_df_converter(excel_df):
 
 
 def return_table_ls(df, freq_ls):
-    """Returns a list of tables to be saves to csv
+    """Returns a list of tables to be saves to csv.
+    Every frequency is computed from all of df, the year to date table is added after the yearly one.
+    Older versions computed the frequencies after "Y" from the year to date activities only
 
     Parameters
     ----------
@@ -108,16 +232,16 @@ def return_table_ls(df, freq_ls):
         list of dataframes
     """
     day_of_year = int(dt.datetime.today().strftime("%j"))
+    # Every frequency is computed in one pass, the year to date table needs a second pass over the filtered df
+    long_df = aggregate(df, freq_ls)
     table_ls = []
     for item in freq_ls:
         freq_str = item
+        table_ls.append(long_to_table(long_df, freq_str))
         if freq_str == "Y":
-            table_ls.append(create_table(df, freq_str))
             # Filter to compare progress to the current date
-            df = df[df['start_date_local'].dt.dayofyear <= day_of_year]
-            table_ls.append(create_table(df, freq_str))
-        else:
-            table_ls.append(create_table(df, freq_str))
+            ytd_df = df[df['start_date_local'].dt.dayofyear <= day_of_year]
+            table_ls.append(long_to_table(aggregate(ytd_df, [freq_str]), freq_str))
     return table_ls
 
 
@@ -129,107 +253,315 @@ def create_table(df, freq_str):
     df : pandas.Dataframe
         see pandas_df_converter
     freq_str : str
-        "Y","M"
+        "W", "M", "Q", "Y"
 
     Returns
     -------
     pandas.Dataframe
         for comparison
     """
-    duration_by_type = df.groupby([pd.Grouper(key='start_date_local', freq=freq_str), 'type'])['excel_time'].sum()
-    duration_by_type.name = "duration"
-    num_of_ex_by_type = df.groupby([pd.Grouper(key='start_date_local', freq=freq_str), 'type'])['excel_time'].count()
-    num_of_ex_by_type.name = "number_of_ex"
-    days_of_ex_by_type = df.groupby([pd.Grouper(key='start_date_local', freq=freq_str), 'type'])['start_date_local'].nunique()
-    days_of_ex_by_type.name = "days_of_ex"
-    # columns for all act
-    duration_all = df.groupby([pd.Grouper(key='start_date_local', freq=freq_str)])['excel_time'].sum()
-    duration_all.name = "duration"
-    num_of_ex_all = df.groupby([pd.Grouper(key='start_date_local', freq=freq_str)])['excel_time'].count()
-    num_of_ex_all.name = "number_of_ex"
-    days_of_ex_all = df.groupby([pd.Grouper(key='start_date_local', freq=freq_str)])['start_date_local'].nunique()
-    days_of_ex_all.name = "days_of_ex"
-    # create data frame
-    type_df = pd.concat([duration_by_type, num_of_ex_by_type, days_of_ex_by_type], axis=1, join="outer", ignore_index=False)
-    all_df = pd.concat([return_data_frame_all(duration_all), return_data_frame_all(num_of_ex_all), return_data_frame_all(days_of_ex_all)], axis=1, join="outer", ignore_index=False)
-    table_df = pd.concat([type_df, all_df], join='outer').sort_index()
-    return table_df
-
-
-def return_data_frame_all(series):
-    """A new dataframe with information for all types of activities"""
-    df = series.to_frame()
-    df['type'] = 'All'
-    return df.reset_index().set_index(['start_date_local', 'type'])
-
-
-def graph_plots(pandas_df):
-    """Plots 6 graphs for comparions
+    return long_to_table(aggregate(df, [freq_str]), freq_str)
+
+
+def daily_totals(df):
+    """Totals the duration and number of activities per day, by type and for type 'All'
 
     Parameters
     ----------
-    pandas_df : pandas.Dataframe
-        see pandas_df_converter()
+    df : pandas.Dataframe
+        see pandas_df_converter
+
+    Returns
+    -------
+    pandas.Dataframe
+        columns start_date_local (day), type, duration, number_of_ex
     """
-    fmt = mdates.DateFormatter('%b')
-    filter_df = pandas_df.copy()
-    start_year = min(filter_df['start_date_local']).year
-    end_year = max(filter_df['start_date_local']).year
-    year_array = list(range(start_year, end_year + 1, 1))
-    graph_df = filter_df.copy()
+    day = df['start_date_local'].dt.normalize()
+    by_type = df.groupby([day, 'type'], observed=True)['excel_time'].agg(['sum', 'count']).reset_index()
+    all_df = by_type.groupby('start_date_local')[['sum', 'count']].sum().reset_index()
+    all_df['type'] = 'All'
+    daily_df = pd.concat([by_type, all_df], ignore_index=True)
+    return daily_df.rename(columns={'sum': 'duration', 'count': 'number_of_ex'})
+
+
+def aggregate(df, freq_ls=("W", "M", "Q", "Y")):
+    """Computes duration, number of exercises and days of exercise for every frequency, by type and for 'All'.
+    The activities are totalled per day once, then the daily totals of every frequency are grouped together in a single pass
+
+    Parameters
+    ----------
+    df : pandas.Dataframe
+        see pandas_df_converter
+    freq_ls : list
+        of Frequencies in the format of strings, "W", "M", "Q", "Y"
+
+    Returns
+    -------
+    pandas.Dataframe
+        tidy table with columns freq, start_date_local (end of the period), type, duration, number_of_ex, days_of_ex.
+        'All' has a row for every period in the range, including periods without activities
+    """
+    daily_df = daily_totals(df)
+    day = daily_df['start_date_local']
+    # Stack the daily totals once per frequency, labelled with the end of their period
+    stacked_ls = []
+    for freq_str in freq_ls:
+        stacked_ls.append(daily_df.assign(freq=freq_str, start_date_local=day.dt.to_period(freq_str).dt.to_timestamp(how='end').dt.normalize()))
+    stacked_df = pd.concat(stacked_ls, ignore_index=True)
+    long_df = stacked_df.groupby(['freq', 'start_date_local', 'type'], sort=False).agg(
+        duration=('duration', 'sum'), number_of_ex=('number_of_ex', 'sum'), days_of_ex=('duration', 'size')).reset_index()
+    # Periods without activities
+    empty_ls = []
+    for freq_str in freq_ls:
+        if day.shape[0] == 0:
+            continue
+        period_range = pd.period_range(day.min(), day.max(), freq=freq_str).to_timestamp(how='end').normalize()
+        observed = long_df.loc[(long_df['freq'] == freq_str) & (long_df['type'] == 'All'), 'start_date_local']
+        missing = period_range[~period_range.isin(observed)]
+        empty_ls.append(pd.DataFrame({'freq': freq_str, 'start_date_local': missing, 'type': 'All',
+                                      'duration': 0.0, 'number_of_ex': 0, 'days_of_ex': 0}))
+    return pd.concat([long_df] + empty_ls, ignore_index=True)
+
+
+def long_to_table(long_df, freq_str):
+    """Selects one frequency of aggregate() in the create_table() format, indexed by period and type"""
+    table_df = long_df[long_df['freq'] == freq_str].drop(columns='freq')
+    return table_df.set_index(['start_date_local', 'type']).sort_index()
+
+
+def daily_matrix(daily_df):
+    """Returns the dense daily matrix the graphs are drawn from, with a row for every day from the 1st of January of the first year
+    to the 31st of December of the last
+
+    Parameters
+    ----------
+    daily_df : pandas.Dataframe
+        see daily_totals()
+
+    Returns
+    -------
+    pandas.Dataframe
+        columns ('duration', type) hours of exercise, ('exercised', type) 1 if exercised that day else 0, for each type and 'All'
+    """
+    start_year = daily_df['start_date_local'].min().year
+    end_year = daily_df['start_date_local'].max().year
     new_date_range = pd.date_range(start=(str(start_year) + "-01" + "-01"), end=(str(end_year) + "-12" + "-31"), freq="D")
-    graph_df.set_index(["start_date_local"], inplace=True)
-    # Graph 1: Duration
-    everyday_series = graph_df.groupby([pd.Grouper(level='start_date_local', freq="D")])['excel_time'].sum()
-    everyday_series = everyday_series.reindex(new_date_range, fill_value=0.00)
-    everyday_series = everyday_series.groupby([pd.Grouper(level=0, freq="Y"), pd.Grouper(level=0, freq="D")]).sum()
-    plt.figure("Figure 1")
-    axs = everyday_series.groupby(level=0).cumsum().groupby([pd.Grouper(level=0, freq="Y")]).plot(legend=True, use_index=True)
-    for ax in axs:
-        ax.xaxis.set_major_locator(mdates.MonthLocator())
-        ax.xaxis.set_major_formatter(fmt)
-        ax.set_title("Cumulative duration plot (by year)")
-        ax.set_ylabel("Hours")
-
-    # Graph 2: Days of ex
-    numdays_series = graph_df.reset_index().groupby([pd.Grouper(key="start_date_local", freq="D")])['start_date_local'].nunique()
-    numdays_series = numdays_series.reindex(new_date_range, fill_value=0.00)
-    numdays_series = numdays_series.groupby([pd.Grouper(level=0, freq="Y"), pd.Grouper(level=0, freq="D")]).sum()
-    plt.figure("Figure 2")
-    axs = numdays_series.groupby(level=0).cumsum().groupby([pd.Grouper(level=0, freq="Y")]).plot(legend=True, use_index=True)
+    pivot_df = daily_df.pivot_table(index='start_date_local', columns='type', values=['duration', 'number_of_ex'], aggfunc='sum', fill_value=0)
+    duration_df = pivot_df['duration'].astype('float64').reindex(new_date_range, fill_value=0.0)
+    exercised_df = (pivot_df['number_of_ex'] > 0).astype('int64').reindex(new_date_range, fill_value=0)
+    return pd.concat({'duration': duration_df, 'exercised': exercised_df}, axis=1)
+
+
+def graph_series(matrix, training=None):
+    """Returns the daily series plotted by the graphs
+
+    Parameters
+    ----------
+    matrix : pandas.Dataframe
+        see daily_matrix()
+    training : pandas.Dataframe or None
+        see load_training(), None leaves out the training load graph
+
+    Returns
+    -------
+    dict
+        everyday_series (hours of exercise per day), numdays_series (1 if exercised that day, else 0), year_array (list of years),
+        training
+    """
+    everyday_series = matrix[('duration', 'All')].rename('excel_time')
+    numdays_series = matrix[('exercised', 'All')].rename('start_date_local')
+    year_array = list(range(matrix.index[0].year, matrix.index[-1].year + 1, 1))
+    return {'everyday_series': everyday_series, 'numdays_series': numdays_series, 'year_array': year_array, 'training': training}
+
+
+def plot_cumulative(daily_series, title, ylabel):
+    """Plots the cumulative sum of a daily series for each year on one figure, used by graphs 1 and 2"""
+    import matplotlib.pyplot as plt
+    import matplotlib.dates as mdates
+
+    fmt = mdates.DateFormatter('%b')
+    daily_series = daily_series.groupby([pd.Grouper(level=0, freq="Y"), pd.Grouper(level=0, freq="D")]).sum()
+    fig = plt.figure()
+    axs = daily_series.groupby(level=0).cumsum().groupby([pd.Grouper(level=0, freq="Y")]).plot(legend=True, use_index=True)
     for ax in axs:
         ax.xaxis.set_major_locator(mdates.MonthLocator())
         ax.xaxis.set_major_formatter(fmt)
-        ax.set_title("Cumulative days of exercise (by year)")
-        ax.set_ylabel("Days")
+        ax.set_title(title)
+        ax.set_ylabel(ylabel)
+    return fig
 
-    # Graph 3: Duration mean of the week
-    everyday_series = graph_df.groupby([pd.Grouper(level='start_date_local', freq="D")])['excel_time'].sum()
-    everyday_series = everyday_series.reindex(new_date_range, fill_value=0.00)
-    plt.figure("Figure 3")
+
+def plot_duration(series):
+    """Graph 1: Duration"""
+    return plot_cumulative(series['everyday_series'], "Cumulative duration plot (by year)", "Hours")
+
+
+def plot_days(series):
+    """Graph 2: Days of ex"""
+    return plot_cumulative(series['numdays_series'], "Cumulative days of exercise (by year)", "Days")
+
+
+def plot_duration_weekday(series):
+    """Graph 3: Duration mean of the week"""
+    import matplotlib.pyplot as plt
+
+    everyday_series = series['everyday_series']
+    fig = plt.figure()
     ax = everyday_series.groupby([everyday_series.index.day_of_week]).mean().plot.bar(legend=False, use_index=True)
     ax.set_xticklabels(['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun'])
     ax.set_title("Average duration by day of the week")
     ax.set_ylabel("Hours")
+    return fig
 
-    # Graph 4:  Duration mean of the week,BY YEAR
+
+def plot_duration_weekday_year(series):
+    """Graph 4:  Duration mean of the week,BY YEAR"""
+    everyday_series = series['everyday_series']
     ax = everyday_series.groupby([pd.Grouper(level=0, freq="Y"), everyday_series.index.day_of_week]).mean().unstack().plot.bar(legend=False, use_index=True)
-    ax.set_xticklabels(year_array)
+    ax.set_xticklabels(series['year_array'])
     ax.set_title("Average duration by day of the week, by year")
     ax.set_ylabel("Hours")
+    return ax.figure
+
 
-    # Graph 5:  Days of ex of the week
-    numdays_series = graph_df.reset_index().groupby([pd.Grouper(key="start_date_local", freq="D")])['start_date_local'].nunique()
-    numdays_series = numdays_series.reindex(new_date_range, fill_value=0.00)
-    plt.figure("Figure 5")
-    ax = numdays_series.groupby(everyday_series.index.day_of_week).sum().plot.bar(legend=False, use_index=True)
+def plot_days_weekday(series):
+    """Graph 5:  Days of ex of the week"""
+    import matplotlib.pyplot as plt
+
+    numdays_series = series['numdays_series']
+    fig = plt.figure()
+    ax = numdays_series.groupby(numdays_series.index.day_of_week).sum().plot.bar(legend=False, use_index=True)
     ax.set_xticklabels(['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun'])
     ax.set_title("Days exercised by day of the week")
     ax.set_ylabel("Days exercised")
+    return fig
+
 
-    # Graph 6:  Days of ex of the week, by year
-    ax = numdays_series.groupby([pd.Grouper(level=0, freq="Y"), everyday_series.index.day_of_week]).sum().unstack().plot.bar(legend=False, use_index=True)
-    ax.set_xticklabels(year_array)
+def plot_days_weekday_year(series):
+    """Graph 6:  Days of ex of the week, by year"""
+    numdays_series = series['numdays_series']
+    ax = numdays_series.groupby([pd.Grouper(level=0, freq="Y"), numdays_series.index.day_of_week]).sum().unstack().plot.bar(legend=False, use_index=True)
+    ax.set_xticklabels(series['year_array'])
     ax.set_title("Days exercised by day of the week, by year")
     ax.set_ylabel("Hours")
+    return ax.figure
+
+
+def plot_training_load(series):
+    """Graph 7: Fitness, fatigue and form"""
+    import matplotlib.pyplot as plt
+
+    training_df = series['training']
+    fig = plt.figure()
+    ax = training_df[['atl', 'ctl', 'tsb']].rename(columns={'atl': 'Fatigue (ATL)', 'ctl': 'Fitness (CTL)', 'tsb': 'Form (TSB)'}).plot(ax=fig.gca(), legend=True)
+    ax.axhline(0, color='grey', linewidth=0.5)
+    ax.set_title("Training load")
+    ax.set_ylabel("Load per day")
+    return fig
+
+
+# Graphs in the order they are shown, name: function. The name is used for the file name by save_graphs()
+GRAPHS = {
+    'duration': plot_duration,
+    'days': plot_days,
+    'duration_weekday': plot_duration_weekday,
+    'duration_weekday_year': plot_duration_weekday_year,
+    'days_weekday': plot_days_weekday,
+    'days_weekday_year': plot_days_weekday_year,
+    'training_load': plot_training_load
+}
+
+
+def graph_names(series):
+    """Returns the names of the graphs which have data in series, see GRAPHS"""
+    return [name for name in GRAPHS if name != 'training_load' or (series['training'] is not None and not series['training'].empty)]
+
+
+def graph_plots(pandas_df, matrix=None, training=None):
+    """Plots 6 graphs for comparions, and the training load when given
+
+    Parameters
+    ----------
+    pandas_df : pandas.Dataframe
+        see pandas_df_converter()
+    matrix : pandas.Dataframe or None
+        see daily_matrix(), such as the cached matrix of load_daily_matrix(). None computes it from pandas_df
+    training : pandas.Dataframe or None
+        see load_training()
+    """
+    # matplotlib is only imported when plotting, see __init__
+    import matplotlib.pyplot as plt
+
+    if matrix is None:
+        matrix = daily_matrix(daily_totals(pandas_df))
+    series = graph_series(matrix, training)
+    for name in graph_names(series):
+        GRAPHS[name](series)
     plt.show()
+
+
+def render_graph(name, series, path, fmt):
+    """Draws one graph with the non-interactive Agg backend and saves it, runs in a worker process of save_graphs()
+
+    Parameters
+    ----------
+    name : str
+        key of GRAPHS
+    series : dict
+        see graph_series()
+    path : pathname
+        location of the image
+    fmt : str
+        image format, "png" or "svg"
+
+    Returns
+    -------
+    pathname
+        path
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    fig = GRAPHS[name](series)
+    fig.savefig(path, format=fmt, bbox_inches='tight')
+    plt.close(fig)
+    return path
+
+
+def save_graphs(pandas_df, output_dir, fmt='png', suffix='', workers=None, matrix=None, training=None):
+    """Saves the graphs to image files without a display, each graph is drawn in its own process
+
+    Parameters
+    ----------
+    pandas_df : pandas.Dataframe
+        see pandas_df_converter()
+    output_dir : pathname
+        folder for the images, created if needed
+    fmt : str
+        image format, "png" or "svg"
+    suffix : str
+        added to the name of each graph in the file name
+    workers : int or None
+        number of processes, None uses one per graph up to the number of CPUs
+    matrix : pandas.Dataframe or None
+        see graph_plots()
+    training : pandas.Dataframe or None
+        see graph_plots()
+
+    Returns
+    -------
+    list
+        paths of the saved images
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    if matrix is None:
+        matrix = daily_matrix(daily_totals(pandas_df))
+    series = graph_series(matrix, training)
+    name_ls = graph_names(series)
+    if workers is None:
+        workers = min(len(name_ls), os.cpu_count() or 1)
+    path_ls = [os.path.join(output_dir, '{}{}.{}'.format(name, suffix, fmt)) for name in name_ls]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(render_graph, name, series, path, fmt) for name, path in zip(name_ls, path_ls)]
+        return [future.result() for future in futures]
@@ -0,0 +1,292 @@
+""" Defines the athlete profiles and the scheduler which syncs them within the rate limits of one application
+Each athlete has a folder in athletes/ laid out like the folder the program is run from, with its own config (and refresh token)
+in data/config.json and its own database. Strava's limits apply to the application, so every athlete draws on one budget.
+The scheduler gives each athlete a share of the budget left in the window in turn, the athletes who have used the least first,
+and serves new activities for every athlete before completing summaries and fetching streams (see strava_update()).
+Each turn runs from the athlete's folder (see in_folder()) with update.rate_limiter swapped for the athlete's share, and is
+recorded as a metrics run. All three are process wide, so athletes are synced one after the other, and only one scheduler
+or athlete folder can be active in a process at a time. Overlapping use raises RuntimeError rather than mixing up athletes.
+
+Contains the following classes:
+Scheduler
+
+Contains the following functions:
+    athlete_dir()
+    list_athletes()
+    add_athlete()
+        read_json() - imported
+        new_config() - imported
+        write_json() - imported
+    in_folder()
+    sync_athletes()
+        Scheduler.run()
+            Scheduler.run_rounds()
+                Scheduler.run_round()
+                    Scheduler.run_turn()
+                        in_folder()
+"""
+import os
+import time
+import threading
+import contextlib
+
+from . import update, metrics
+from .update import backfill_id_list
+from .ratelimit import QuotaLimiter, seconds_until_reset, RESET_MARGIN
+from .first_run import new_config
+from .stravatracker import CONFIG_PATH, read_json, write_json, load_files, update_write
+
+__author__ = "rakeshrgill"
+__email__ = "rakeshrgill@gmail.com"
+
+ATHLETES_PATH = 'athletes'
+# Stages of strava_update() in order of priority
+STAGES = ['new', 'backfill']
+
+# Held while the process runs from an athlete's folder, and while a scheduler is running
+_folder_lock = threading.Lock()
+_scheduler_lock = threading.Lock()
+
+
+def athlete_dir(name, path=ATHLETES_PATH):
+    """Returns the folder of an athlete, the program is run from it for that athlete"""
+    return os.path.join(path, name)
+
+
+def list_athletes(path=ATHLETES_PATH):
+    """Returns the names of the athletes with a config file, sorted"""
+    if not os.path.isdir(path):
+        return []
+    return sorted(name for name in os.listdir(path) if os.path.isfile(os.path.join(athlete_dir(name, path), CONFIG_PATH)))
+
+
+def add_athlete(name, refresh_token, app_config_path=CONFIG_PATH, path=ATHLETES_PATH):
+    """Creates the profile of an athlete who has authorised the application
+
+    Parameters
+    ----------
+    name : str
+        folder name of the athlete
+    refresh_token : str
+        refresh token from the athlete's authorisation of the application (step 3 of setup())
+    app_config_path : pathname
+        config of the application owner, the client id and client secret are copied from it
+    path : pathname
+        folder holding the athlete folders
+
+    Returns
+    -------
+    dict
+        config of the athlete (see read_json())
+    """
+    app_config = read_json(app_config_path)
+    config = new_config(app_config['client_id'], app_config['client_secret'], refresh_token)
+    folder = athlete_dir(name, path)
+    os.makedirs(os.path.join(folder, os.path.dirname(CONFIG_PATH)), exist_ok=True)
+    write_json(config, os.path.join(folder, CONFIG_PATH))
+    return config
+
+
+@contextlib.contextmanager
+def in_folder(folder):
+    """Runs the enclosed code from folder, so the data paths of every module point at that athlete.
+    The working directory is shared by every thread, so only one block may run at a time
+
+    Raises
+    ------
+    RuntimeError
+        another thread, or an enclosing block, is running from an athlete's folder
+    """
+    if not _folder_lock.acquire(blocking=False):
+        raise RuntimeError("Already running from an athlete folder, athletes must be run one at a time")
+    try:
+        cwd = os.getcwd()
+        os.chdir(folder)
+        try:
+            yield
+        finally:
+            os.chdir(cwd)
+    finally:
+        _folder_lock.release()
+
+
+class Scheduler:
+    """Syncs several athletes through the rate limiter of one application
+
+    The budget is handed out in turns. For each stage (see STAGES) the athletes with work left are served in order of the
+    requests they have used so far, each getting an equal share of what is left in the 15 minute and daily windows.
+    Budget an athlete does not use is shared again by the athletes still waiting, and only reaches the next stage
+    once no athlete has work left in the current one. A turn which used its whole share without saving anything,
+    e.g. a first listing longer than the share, doubles the athlete's next share so it cannot be starved.
+    Rounds are repeated, waiting for the 15 minute window to reset when it is spent, until every athlete is up to date
+    or the daily budget is spent.
+    Athletes are run one at a time from their folder, with update.rate_limiter replaced for the turn, so a scheduler must
+    not run alongside another scheduler, sync() or analyze() in the same process. run() raises RuntimeError if it would.
+
+    Parameters
+    ----------
+    names : list or None
+        athletes to sync, None syncs every athlete in path
+    path : pathname
+        folder holding the athlete folders
+    limiter : RateLimiter or None
+        application wide limiter, None uses update.rate_limiter
+    max_wait : float
+        longest time in seconds to wait for a window to reset between rounds, 0 stops when the window is spent
+
+    Attributes
+    ----------
+    pending : dict
+        athlete: set of stages with work left
+    served : dict
+        athlete: requests made in this run
+    boost : dict
+        athlete: multiple of the equal share given in the next turn
+    """
+
+    def __init__(self, names=None, path=ATHLETES_PATH, limiter=None, max_wait=16 * 60):
+        self.path = path
+        self.names = list_athletes(path) if names is None else list(names)
+        self.limiter = update.rate_limiter if limiter is None else limiter
+        self.max_wait = max_wait
+        self.pending = {name: set(STAGES) for name in self.names}
+        self.served = {name: 0 for name in self.names}
+        self.boost = {name: 1 for name in self.names}
+
+    def quota(self, num_athletes):
+        """Returns an equal share of the budget left in both windows for num_athletes, at least one request while any is left"""
+        remaining = min(self.limiter.remaining())
+        if remaining < num_athletes:
+            return min(remaining, 1)
+        return remaining // num_athletes
+
+    def run_turn(self, name, stage, quota):
+        """Runs one stage of the update of an athlete with quota requests, from the athlete's folder
+
+        Parameters
+        ----------
+        name : str
+        stage : str
+            see strava_update()
+        quota : int
+
+        Returns
+        -------
+        int
+            requests used
+        """
+        share = QuotaLimiter(self.limiter, quota)
+        print("Syncing {} ({}, up to {} requests)".format(name, stage, quota))
+        with in_folder(athlete_dir(name, self.path)), metrics.run('sync'):
+            config = read_json(CONFIG_PATH)
+            try:
+                df = load_files(config)
+            except FileNotFoundError:
+                df = None
+            # Every request of the update is taken from the share
+            update.rate_limiter = share
+            try:
+                config, new_df = update_write(config, df, stage)
+            finally:
+                update.rate_limiter = self.limiter
+        self.served[name] += share.used
+        # Any activity saved gives a new frame, the same frame back means the share was spent on a listing that did not finish
+        if stage == 'new' and share.refused and new_df is df:
+            self.boost[name] *= 2
+        else:
+            self.boost[name] = 1
+        # A stage which ran out of budget has more to do, as does a summary backfill trimmed to the share
+        if not share.refused and not (stage == 'backfill' and new_df is not df and backfill_id_list(new_df) != []):
+            self.pending[name].discard(stage)
+        return share.used
+
+    def run_round(self):
+        """Serves every athlete with work left in each stage, sharing the budget again until the stage is done or spent
+
+        Returns
+        -------
+        int
+            requests used
+        """
+        used = 0
+        for stage in STAGES:
+            stage_used = None
+            while stage_used != 0:
+                # Backfill waits until the athlete's new activities are in
+                earlier = set(STAGES[:STAGES.index(stage)])
+                names = [name for name in self.names if stage in self.pending[name] and not self.pending[name] & earlier]
+                if names == []:
+                    break
+                names.sort(key=lambda name: self.served[name])
+                # The share is fixed for the pass, what is left over is shared again by the athletes still waiting
+                share = self.quota(len(names))
+                if share == 0:
+                    return used
+                stage_used = 0
+                for name in names:
+                    quota = min(share * self.boost[name], min(self.limiter.remaining()))
+                    if quota == 0:
+                        break
+                    stage_used += self.run_turn(name, stage, quota)
+                used += stage_used
+        return used
+
+    def run(self):
+        """Runs rounds until every athlete is up to date, the daily budget is spent or no progress is made
+
+        Returns
+        -------
+        dict
+            athlete: requests made
+
+        Raises
+        ------
+        RuntimeError
+            another scheduler is running in the process
+        """
+        if not _scheduler_lock.acquire(blocking=False):
+            raise RuntimeError("Another scheduler is running, athletes must be synced one scheduler at a time")
+        try:
+            return self.run_rounds()
+        finally:
+            _scheduler_lock.release()
+
+    def run_rounds(self):
+        """see run()"""
+        while any(self.pending.values()):
+            used = self.run_round()
+            if not any(self.pending.values()):
+                break
+            remaining_15min, remaining_daily = self.limiter.remaining()
+            if remaining_daily == 0:
+                print("Daily rate limit spent, {} athletes left for the next run".format(sum(1 for stages in self.pending.values() if stages)))
+                break
+            if remaining_15min > 0:
+                if used == 0:
+                    # Budget is left but nobody could use it, e.g. expired tokens
+                    break
+                continue
+            wait = seconds_until_reset("15min") + RESET_MARGIN
+            if wait > self.max_wait:
+                break
+            print("Rate limit reached, waiting {:.0f} minutes and {:.0f} seconds for the 15 minute window to reset".format(wait // 60, wait % 60))
+            time.sleep(wait)
+        return dict(self.served)
+
+
+def sync_athletes(names=None, path=ATHLETES_PATH):
+    """Syncs every athlete within the application's rate limits, see Scheduler
+
+    Parameters
+    ----------
+    names : list or None
+        athletes to sync, None syncs every athlete in path
+    path : pathname
+        folder holding the athlete folders
+
+    Returns
+    -------
+    dict
+        athlete: requests made
+    """
+    return Scheduler(names, path).run()
@@ -0,0 +1,312 @@
+""" Defines the best effort curves, the highest average power and speed held for each duration, computed from the streams
+The curve of each activity is computed once and cached in curve_activity, keyed by where its streams are stored.
+New curves are merged into curve_best, the best of every type per season (calendar year) and of all time, so an update
+only reads the streams of the activities it adds.
+
+Contains the following functions:
+    connect()
+    update_curves()
+        activity_curve()
+            per_second()
+            best_means()
+        merge_best()
+        rebuild_best()
+    refresh_best()
+        rebuild_best()
+    load_activity_curves()
+    load_curve_table()
+        load_rules() - imported
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+from .store import STORE_PATH, connect as store_connect
+from .streams import StreamStore, STREAMS_PATH
+from .analysis import load_rules, DEFAULT_RULE
+
+__author__ = "rakeshrgill"
+__email__ = "rakeshrgill@gmail.com"
+
+# Window of each best effort in seconds
+DURATIONS = {'5s': 5, '1min': 60, '5min': 300, '20min': 1200, '60min': 3600}
+# Longest gap between samples which holds the previous value, longer gaps are pauses and count as zero power
+MAX_GAP = 10
+# Curves shown for each metric of the rules table (see ACTIVITY_RULES), and the unit of their table rows
+CURVE_METRICS = {'average_watts': 'watts', 'average_pace_run': 'pace_run', 'average_pace_swim': 'pace_swim'}
+CURVE_UNITS = {'watts': 'W', 'pace_run': 's/km', 'pace_swim': 's/100m'}
+
+
+def connect(path=STORE_PATH):
+    """Opens the store, creating the curve tables if needed"""
+    conn = store_connect(path)
+    conn.execute("CREATE TABLE IF NOT EXISTS curve_activity (id INTEGER, metric TEXT, duration INTEGER, value REAL, PRIMARY KEY (id, metric, duration))")
+    conn.execute("CREATE TABLE IF NOT EXISTS curve_done (id INTEGER PRIMARY KEY, stream_offset INTEGER)")
+    conn.execute("CREATE TABLE IF NOT EXISTS curve_best (type TEXT, season TEXT, metric TEXT, duration INTEGER, value REAL, id INTEGER, "
+                 "PRIMARY KEY (type, season, metric, duration))")
+    return conn
+
+
+def per_second(time, values, max_gap=MAX_GAP):
+    """Resamples a stream to one value per second, each sample held until the next one.
+    A sample is held for at most max_gap seconds, longer gaps are pauses and filled with zeros
+
+    Parameters
+    ----------
+    time : numpy.ndarray
+        seconds from the start of the activity, increasing
+    values : numpy.ndarray
+        samples taken at time
+    max_gap : int
+
+    Returns
+    -------
+    numpy.ndarray
+        float64, one element per second from the first sample to the last
+    """
+    offsets = np.maximum.accumulate(time - time[0]).astype('int64')
+    seconds = np.arange(offsets[-1] + 1)
+    # Latest sample at or before each second
+    last = np.searchsorted(offsets, seconds, side='right') - 1
+    held = values[last].astype('float64')
+    held[seconds - offsets[last] >= max_gap] = 0
+    return held
+
+
+def best_means(cumulative, durations):
+    """Returns the highest mean over windows of each duration, from a cumulative sum sampled every second
+
+    Parameters
+    ----------
+    cumulative : numpy.ndarray
+        running total with a leading zero, cumulative[t] is the total of the first t seconds
+    durations : iterable of int
+        window lengths in seconds
+
+    Returns
+    -------
+    dict
+        duration: best mean, durations longer than the activity are left out
+    """
+    best = {}
+    for duration in durations:
+        if len(cumulative) > duration:
+            best[duration] = float((cumulative[duration:] - cumulative[:-duration]).max() / duration)
+    return best
+
+
+def activity_curve(streams, durations=DURATIONS.values()):
+    """Returns the best efforts of one activity, power from the watts stream and speed (m/s) from the distance stream
+
+    Parameters
+    ----------
+    streams : dict
+        column: numpy.ndarray (see StreamStore.get()), needs time
+    durations : iterable of int
+
+    Returns
+    -------
+    dict
+        metric ('watts', 'speed'): {duration: value}
+    """
+    curve = {}
+    time = streams.get('time')
+    if time is None or len(time) < 2:
+        return curve
+    if 'watts' in streams:
+        watts = per_second(time, streams['watts'])
+        curve['watts'] = best_means(np.concatenate([[0.0], np.cumsum(watts)]), durations)
+    if 'distance' in streams:
+        # Distance is already a running total, resampled to every second
+        offsets = np.maximum.accumulate(time - time[0])
+        distance = np.interp(np.arange(offsets[-1] + 1), offsets, np.fmax.accumulate(np.nan_to_num(streams['distance'].astype('float64'))))
+        curve['speed'] = best_means(distance - distance[0], durations)
+    return curve
+
+
+def update_curves(streams_path=STREAMS_PATH, path=STORE_PATH):
+    """Computes the curves of the activities whose streams are new or stored again, and merges them into the bests
+
+    Parameters
+    ----------
+    streams_path : pathname
+        folder of the stream store
+    path : pathname
+        location of the SQLite database
+
+    Returns
+    -------
+    int
+        number of activities computed
+    """
+    if not os.path.exists(streams_path):
+        return 0
+    conn = connect(path)
+    try:
+        done = dict(conn.execute("SELECT id, stream_offset FROM curve_done").fetchall())
+        with StreamStore(streams_path) as store:
+            index = store.index()
+            todo = [i for i, (activity_id, offset) in enumerate(zip(index['id'], index['offset'])) if done.get(int(activity_id)) != int(offset)]
+            if len(todo) == 0:
+                return 0
+            print("Computing best efforts of {} activities".format(len(todo)))
+            rows = []
+            for i in todo:
+                offset, length = index['offset'][i], index['length'][i]
+                streams = {col: store.column(col)[offset:offset + length] for col in index['columns'][i].split(',') if col != ''}
+                for metric, best in activity_curve(streams).items():
+                    rows += [(int(index['id'][i]), metric, duration, value) for duration, value in best.items()]
+        new_ids = [(int(index['id'][i]), int(index['offset'][i])) for i in todo]
+        # Streams stored again may have lowered a best, which is only found by merging every activity again
+        restored = any(activity_id in done for activity_id, _ in new_ids)
+        with conn:
+            conn.executemany("DELETE FROM curve_activity WHERE id = ?", [(activity_id,) for activity_id, _ in new_ids])
+            conn.executemany("INSERT INTO curve_activity (id, metric, duration, value) VALUES (?, ?, ?, ?)", rows)
+            conn.executemany("INSERT OR REPLACE INTO curve_done (id, stream_offset) VALUES (?, ?)", new_ids)
+            if restored:
+                rebuild_best(conn)
+            else:
+                merge_best(conn, [activity_id for activity_id, _ in new_ids])
+    finally:
+        conn.close()
+    return len(todo)
+
+
+def merge_best(conn, id_list):
+    """Raises the bests of each type, season and all time to the curves of the given activities
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+    id_list : list
+        of activity ids with curves in curve_activity
+    """
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS curve_new (id INTEGER PRIMARY KEY)")
+    conn.execute("DELETE FROM curve_new")
+    conn.executemany("INSERT OR IGNORE INTO curve_new (id) VALUES (?)", [(activity_id,) for activity_id in id_list])
+    for season in ("substr(a.start_date_local, 1, 4)", "'All'"):
+        conn.execute("INSERT INTO curve_best (type, season, metric, duration, value, id) "
+                     "SELECT a.type, {}, c.metric, c.duration, c.value, c.id FROM curve_activity c "
+                     "JOIN curve_new n ON n.id = c.id JOIN activities a ON a.id = c.id WHERE true "
+                     "ON CONFLICT (type, season, metric, duration) DO UPDATE SET value = excluded.value, id = excluded.id "
+                     "WHERE excluded.value > curve_best.value".format(season))
+
+
+def rebuild_best(conn):
+    """Recomputes every best from the cached activity curves
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+    """
+    conn.execute("DELETE FROM curve_best")
+    merge_best(conn, [row[0] for row in conn.execute("SELECT id FROM curve_done")])
+
+
+def refresh_best(changed_id_list, deleted_id_list, path=STORE_PATH):
+    """Removes the curves of deleted activities, and recomputes the bests if any activity with a curve was changed or deleted,
+    as an edited type or date moves its curve to another best
+
+    Parameters
+    ----------
+    changed_id_list : list
+        ids written to the store (see save_activities())
+    deleted_id_list : list
+        ids removed from the store
+
+    Returns
+    -------
+    bool
+        True if the bests were recomputed
+    """
+    if changed_id_list == [] and deleted_id_list == []:
+        return False
+    conn = connect(path)
+    try:
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS curve_changed (id INTEGER PRIMARY KEY)")
+        conn.execute("DELETE FROM curve_changed")
+        conn.executemany("INSERT OR IGNORE INTO curve_changed (id) VALUES (?)", [(int(num),) for num in changed_id_list + deleted_id_list])
+        affected = conn.execute("SELECT COUNT(*) FROM curve_done d JOIN curve_changed c ON c.id = d.id").fetchone()[0]
+        if affected == 0:
+            return False
+        with conn:
+            conn.executemany("DELETE FROM curve_activity WHERE id = ?", [(int(num),) for num in deleted_id_list])
+            conn.executemany("DELETE FROM curve_done WHERE id = ?", [(int(num),) for num in deleted_id_list])
+            rebuild_best(conn)
+    finally:
+        conn.close()
+    return True
+
+
+def load_activity_curves(path=STORE_PATH):
+    """Returns the best efforts of every activity
+
+    Parameters
+    ----------
+    path : pathname
+        location of the SQLite database
+
+    Returns
+    -------
+    pandas.DataFrame
+        indexed by id and metric ('watts' in W, 'speed' in m/s), one column per duration (see DURATIONS)
+    """
+    conn = connect(path)
+    try:
+        long_df = pd.read_sql_query("SELECT id, metric, duration, value FROM curve_activity", conn)
+    finally:
+        conn.close()
+    table = long_df.pivot(index=['id', 'metric'], columns='duration', values='value')
+    return table.reindex(columns=list(DURATIONS.values())).set_axis(list(DURATIONS), axis=1)
+
+
+def load_curve_table(path=STORE_PATH, rules=None):
+    """Returns the best efforts of each activity type, per season and of all time.
+    Types are renamed and given the curves of their metrics following the rules table, power in watts and speed as pace
+
+    Parameters
+    ----------
+    path : pathname
+        location of the SQLite database
+    rules : dict or None
+        see load_rules(), None loads the rules from disk
+
+    Returns
+    -------
+    pandas.DataFrame
+        indexed by type, metric (see CURVE_UNITS) and season ('All' then the years, latest first), one column per duration
+    """
+    if rules is None:
+        rules = load_rules()
+    conn = connect(path)
+    try:
+        best_df = pd.read_sql_query("SELECT type, season, metric, duration, value FROM curve_best", conn)
+    finally:
+        conn.close()
+    frame_ls = []
+    for activity_type, type_df in best_df.groupby('type'):
+        # Rules are looked up after renaming, as in excel_clean()
+        renamed = rules.get(activity_type, {}).get('rename') or activity_type
+        rule = dict(DEFAULT_RULE, **rules.get(renamed, {}))
+        for rule_metric, metric in CURVE_METRICS.items():
+            if rule_metric not in rule['metrics']:
+                continue
+            metric_df = type_df[type_df['metric'] == ('watts' if metric == 'watts' else 'speed')].copy()
+            metric_df['type'] = renamed
+            metric_df['metric'] = metric
+            frame_ls.append(metric_df)
+    columns = list(DURATIONS)
+    if len(frame_ls) == 0:
+        return pd.DataFrame(columns=columns, index=pd.MultiIndex.from_arrays([[], [], []], names=['type', 'metric', 'season']))
+    curve_df = pd.concat(frame_ls)
+    # Renamed types share the best of the types merged into them
+    curve_df = curve_df.groupby(['type', 'metric', 'season', 'duration'])['value'].max().reset_index()
+    speed = curve_df['metric'] != 'watts'
+    with np.errstate(divide='ignore'):
+        curve_df.loc[speed, 'value'] = np.where(curve_df['metric'][speed] == 'pace_swim', 100, 1000) / curve_df.loc[speed, 'value']
+    table = curve_df.pivot(index=['type', 'metric', 'season'], columns='duration', values='value')
+    table = table.reindex(columns=list(DURATIONS.values())).set_axis(columns, axis=1).round(1)
+    seasons = ['All'] + sorted(set(table.index.get_level_values('season')) - {'All'}, reverse=True)
+    order = sorted(table.index, key=lambda row: (row[0], row[1], seasons.index(row[2])))
+    return table.reindex(pd.MultiIndex.from_tuples(order, names=table.index.names))
@@ -0,0 +1,140 @@
+""" Defines the fetch queue, the activities listed by strava whose details still have to be fetched
+Ids are pushed as each page of the activity list arrives and removed once their details are safely in the raw cache and
+the journal, so an update stopped by a timeout resumes with the activities it did not reach, without listing them again.
+Activities are fetched highest priority first, the newest activities by default, or the activity types given in
+config['fetch_types'] before the others (see activity_priority()). Activities which fail are retried by later updates,
+up to MAX_ATTEMPTS times.
+
+Contains the following classes:
+FetchQueue
+
+Contains the following functions:
+    activity_priority()
+"""
+import os
+import sqlite3
+import datetime as dt
+
+__author__ = "rakeshrgill"
+__email__ = "rakeshrgill@gmail.com"
+
+QUEUE_PATH = os.path.join('data', 'queue.db')
+# Failed fetches of an activity before it is left out of the queue order
+MAX_ATTEMPTS = 5
+# Priority added per rank of an activity type, larger than any start time so the type decides first
+TYPE_PRIORITY_STEP = 1e11
+
+
+def activity_priority(json_obj, fetch_types=()):
+    """Returns the priority of an activity list entry. Activities of the types in fetch_types come first, in the order listed,
+    then the other activities. Within each the start time orders them, so the newest activities are fetched first.
+    Queued activities keep their priority until they are listed again, e.g. by the next full listing
+
+    Parameters
+    ----------
+    json_obj : dict
+        activity as returned by strava, needs start_date and type
+    fetch_types : list
+        activity types fetched before the others, see config['fetch_types']
+
+    Returns
+    -------
+    float
+    """
+    start = dt.datetime.strptime(json_obj['start_date'], '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=dt.timezone.utc)
+    fetch_types = list(fetch_types)
+    rank = len(fetch_types) - fetch_types.index(json_obj.get('type')) if json_obj.get('type') in fetch_types else 0
+    return rank * TYPE_PRIORITY_STEP + start.timestamp()
+
+
+class FetchQueue:
+    """Persistent priority queue of activity ids, with the failed attempts of each
+
+    Parameters
+    ----------
+    path : pathname
+        location of the SQLite database holding the queue
+    """
+
+    def __init__(self, path=QUEUE_PATH):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS queue (id INTEGER PRIMARY KEY, priority REAL, attempts INTEGER DEFAULT 0, last_error TEXT)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS queue_order ON queue (attempts, priority)")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Closes the database connection"""
+        self.conn.close()
+
+    def push(self, id_list, priority_ls):
+        """Adds activities to the queue. An activity already queued takes the new priority and keeps its attempts
+
+        Parameters
+        ----------
+        id_list : list
+            activity ids
+        priority_ls : list
+            priority of each id, see activity_priority()
+        """
+        with self.conn:
+            self.conn.executemany("INSERT INTO queue (id, priority) VALUES (?, ?) ON CONFLICT (id) DO UPDATE SET priority = excluded.priority",
+                                  [(int(num), float(priority)) for num, priority in zip(id_list, priority_ls)])
+
+    def ids(self, limit=None):
+        """Returns the queued ids in the order they should be fetched, highest priority first.
+        Activities which have failed MAX_ATTEMPTS times are left out
+
+        Parameters
+        ----------
+        limit : int or None
+            most ids returned, None returns every id
+
+        Returns
+        -------
+        list
+        """
+        sql = "SELECT id FROM queue WHERE attempts < ? ORDER BY priority DESC, id DESC"
+        params = (MAX_ATTEMPTS,)
+        if limit is not None:
+            sql += " LIMIT ?"
+            params += (int(limit),)
+        return [row[0] for row in self.conn.execute(sql, params)]
+
+    def done(self, id_list):
+        """Removes activities from the queue, once they have been fetched or are no longer needed
+
+        Parameters
+        ----------
+        id_list : list
+            activity ids
+        """
+        with self.conn:
+            self.conn.executemany("DELETE FROM queue WHERE id = ?", [(int(num),) for num in id_list])
+
+    def failed(self, activity_id, error):
+        """Counts a failed fetch of an activity, it stays queued for the next update
+
+        Parameters
+        ----------
+        activity_id : int
+        error : Exception or str
+            kept for inspection, see failures()
+        """
+        with self.conn:
+            self.conn.execute("UPDATE queue SET attempts = attempts + 1, last_error = ? WHERE id = ?", (str(error), int(activity_id)))
+
+    def failures(self):
+        """Returns the activities which have failed MAX_ATTEMPTS times, as a dict of id: last error"""
+        return dict(self.conn.execute("SELECT id, last_error FROM queue WHERE attempts >= ?", (MAX_ATTEMPTS,)).fetchall())
+
+    def __len__(self):
+        """Number of activities which will still be fetched"""
+        return self.conn.execute("SELECT COUNT(*) FROM queue WHERE attempts < ?", (MAX_ATTEMPTS,)).fetchone()[0]
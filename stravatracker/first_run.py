@@ -1,19 +1,64 @@
 """ Defines functions for initial setup
 Contains the following functions:
+    new_config()
     setup()
+        new_config()
 
 """
 import urllib3
 import webbrowser
 
 import requests
-from PIL import Image
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 __author__ = "rakeshrgill"
 __email__ = "rakeshrgill@gmail.com"
 
+# Config keys added after the first release, with the defaults used to upgrade older config files
+NEW_CONFIG_KEYS = {
+    'after_cursor': 0,
+    'last_full_sync': '2022_01_01_1200',
+    'full_sync_days': 7,
+    'ingest_mode': 'detail',
+    'fetch_streams': False,
+    'load_metric': 'duration',
+    'ftp': 0,
+    'threshold_hr': 0,
+    'access_token': '',
+    'expires_at': 0,
+    'fetch_types': []
+}
+
+
+def new_config(client_id='', client_secret='', refresh_token=''):
+    """Returns the config of an athlete who has not synced yet, the keys of the first release then NEW_CONFIG_KEYS
+
+    Parameters
+    ----------
+    client_id : str
+    client_secret : str
+    refresh_token : str
+        see setup()
+
+    Returns
+    -------
+    dict
+        config file
+    """
+    config = {
+        'first_run': True,
+        'last_update': '2022_01_01_1200',
+        'last_timeout_daily': '2022_01_01_1200',
+        'last_timeout_15min': '2022_01_01_1200',
+        'remaining_updates': False,
+        'client_id': client_id,
+        'client_secret': client_secret,
+        'refresh_token': refresh_token,
+    }
+    config.update(NEW_CONFIG_KEYS)
+    return config
+
 
 def setup():
     """Runs steps 0 to 4
@@ -32,17 +77,10 @@ def setup():
     # Step 0
     # Create config file
     print("Running initial database setup.")
-    config = {
-        'first_run': True,
-        'last_update': '2022_01_01_1200',
-        'last_timeout_daily': '2022_01_01_1200',
-        'last_timeout_15min': '2022_01_01_1200',
-        'remaining_updates': False,
-        'client_id': '',
-        'client_secret': '',
-        'refresh_token': ''
-    }
-    # Read the image
+    config = new_config()
+    # Read the image, PIL is only imported by the setup
+    from PIL import Image
+
     im1a = Image.open("setup/step1a.png")
     im1b = Image.open("setup/step1b.png")
     im2 = Image.open("setup/step2.png")
@@ -163,9 +201,12 @@ def setup():
             raise
         else:
             # if there is no error
-            refresh_token = response.json()['refresh_token']
-            print("Refresh Token = {}\n".format(refresh_token))
-            config['refresh_token'] = refresh_token
+            # The access token given with the refresh token is used by the first update
+            json_obj = response.json()
+            config['refresh_token'] = json_obj['refresh_token']
+            config['access_token'] = json_obj['access_token']
+            config['expires_at'] = json_obj['expires_at']
+            print("Refresh Token saved\n")
         answer = input("What would you like to do?\n1. Next Step and Exit \n2. Repeat\n")
         if answer == '1':
             ask_question = False
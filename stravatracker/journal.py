@@ -0,0 +1,89 @@
+""" Defines the append-only journal of fetched activities
+Every activity fetched from strava is written to the journal as soon as it arrives, one JSON object per line.
+If the program stops before the database is written, the journal is replayed on the next update so no activity is requested twice.
+Activities are cleared from the journal once the database has been written to disk.
+
+Contains the following functions:
+    append_journal()
+    read_journal()
+    clear_journal()
+"""
+import os
+import json
+
+__author__ = "rakeshrgill"
+__email__ = "rakeshrgill@gmail.com"
+
+JOURNAL_PATH = os.path.join('data', 'journal.jsonl')
+
+
+def append_journal(json_obj, path=JOURNAL_PATH):
+    """Appends one activity to the journal
+
+    Parameters
+    ----------
+    json_obj : dict
+        activity as returned by strava
+    path : pathname
+        location of the journal
+    """
+    line = (json.dumps(json_obj, separators=(',', ':')) + '\n').encode('utf-8')
+    with open(path, 'ab+') as journalfile:
+        # Start on a new line if the last write was cut short
+        if journalfile.seek(0, os.SEEK_END) > 0:
+            journalfile.seek(-1, os.SEEK_END)
+            if journalfile.read(1) != b'\n':
+                line = b'\n' + line
+        journalfile.write(line)
+
+
+def read_journal(path=JOURNAL_PATH):
+    """Reads all activities in the journal
+
+    Parameters
+    ----------
+    path : pathname
+        location of the journal
+
+    Returns
+    -------
+    list
+        activities, empty if there is no journal. A line cut short by a crash is skipped
+    """
+    json_obj_ls = []
+    try:
+        with open(path, 'r') as journalfile:
+            for line in journalfile:
+                try:
+                    json_obj_ls.append(json.loads(line))
+                except ValueError:
+                    print("Skipping incomplete journal entry")
+    except FileNotFoundError:
+        pass
+    return json_obj_ls
+
+
+def clear_journal(saved_ids, path=JOURNAL_PATH):
+    """Removes the activities which have been written to the database from the journal
+
+    Parameters
+    ----------
+    saved_ids : list
+        ids of the activities in the database
+    path : pathname
+        location of the journal
+    """
+    saved_ids = set(saved_ids)
+    remaining_ls = [json_obj for json_obj in read_journal(path) if json_obj.get('id') not in saved_ids]
+    if remaining_ls == []:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    else:
+        # Rewrite through a temporary file so the journal is never left half written
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as journalfile:
+            for json_obj in remaining_ls:
+                journalfile.write(json.dumps(json_obj, separators=(',', ':')) + '\n')
+        os.replace(tmp_path, path)
@@ -0,0 +1,358 @@
+""" Defines the run instrumentation, the time, rows, memory and API requests of each stage of a sync or an analysis
+A run is opened once by each entry point, sync(), analyze(), the menu of program() and each turn of the scheduler of
+several athletes, and the pipeline marks its stages with stage().
+Requests made by return_json() are counted against every open stage with their latency, status and the rate limit
+headroom left after them. When the run ends it is appended to data/metrics.jsonl, one JSON object per run, and written to
+data/stravatracker.prom in the Prometheus text format, for the textfile collector of the node exporter.
+Stages outside a run are not recorded, so library functions cost nothing extra when called on their own.
+The current run is process wide: the threads of a run (e.g. the fetch workers) count their requests against it, but a run
+started by another thread while one is open raises RuntimeError, as it would be recorded as part of the wrong run.
+
+Peak memory is the peak resident set size of the process during the stage. It is reset at the start of each stage on
+Linux, on other systems it is the peak of the process so far. Graphs drawn in other processes are not counted.
+
+Contains the following classes:
+Run
+
+Contains the following functions:
+    run()
+        Run.finish()
+            write_run()
+            write_prometheus()
+                prometheus_samples()
+    stage()
+        Run.open_stage()
+            peak_memory()
+            reset_peak_memory()
+        Run.close_stage()
+    record_request()
+"""
+import os
+import json
+import time
+import threading
+import contextlib
+import datetime as dt
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+__author__ = "rakeshrgill"
+__email__ = "rakeshrgill@gmail.com"
+
+METRICS_PATH = os.path.join('data', 'metrics.jsonl')
+PROM_PATH = os.path.join('data', 'stravatracker.prom')
+# Prometheus metric of each stage field, with its help text
+STAGE_METRICS = {
+    'seconds': ('stravatracker_stage_seconds', "Wall time of the stage in its last run"),
+    'rows': ('stravatracker_stage_rows', "Rows processed by the stage in its last run"),
+    'peak_memory_bytes': ('stravatracker_stage_peak_memory_bytes', "Peak resident memory during the stage in its last run"),
+    'requests': ('stravatracker_stage_requests', "API requests made by the stage in its last run"),
+    'request_seconds': ('stravatracker_stage_request_seconds', "Total latency of the API requests of the stage in its last run"),
+    'throttled': ('stravatracker_stage_throttled_requests', "Requests answered with 429 in the stage in its last run"),
+}
+# Prometheus metric of each run field, with its help text
+RUN_METRICS = {
+    'finished': ('stravatracker_run_timestamp_seconds', "Unix time the last run finished"),
+    'seconds': ('stravatracker_run_seconds', "Wall time of the last run"),
+    'peak_memory_bytes': ('stravatracker_run_peak_memory_bytes', "Peak resident memory of the last run"),
+    'requests': ('stravatracker_run_requests', "API requests made by the last run"),
+    'request_seconds': ('stravatracker_run_request_seconds', "Total latency of the API requests of the last run"),
+    'throttled': ('stravatracker_run_throttled_requests', "Requests answered with 429 in the last run"),
+    'failed': ('stravatracker_run_failed', "1 if the last run raised an exception"),
+}
+HEADROOM_METRIC = ('stravatracker_ratelimit_remaining', "Requests left in the rate limit window after the last request of the run")
+
+_current = None
+_lock = threading.Lock()
+
+
+def peak_memory():
+    """Returns the peak resident set size of the process in bytes since it was last reset, None if unknown"""
+    try:
+        with open('/proc/self/status', 'r') as statusfile:
+            for line in statusfile:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return maxrss if os.uname().sysname == 'Darwin' else maxrss * 1024
+
+
+def reset_peak_memory():
+    """Resets the peak resident set size to the current size, only possible on Linux. Returns True if it was reset"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as refsfile:
+            refsfile.write('5')
+    except OSError:
+        return False
+    return True
+
+
+def new_counters():
+    """Returns the fields counted by a stage and a run"""
+    return {'seconds': 0.0, 'rows': None, 'peak_memory_bytes': None, 'requests': 0, 'request_seconds': 0.0,
+            'max_request_seconds': 0.0, 'throttled': 0, 'status': {}, 'remaining_15min': None, 'remaining_daily': None,
+            'min_remaining_15min': None}
+
+
+class Run:
+    """Records the stages of one sync or analysis
+
+    Parameters
+    ----------
+    kind : str
+        name of the run, e.g. 'sync' or 'analysis'
+
+    Attributes
+    ----------
+    record : dict
+        fields of the run, see new_counters(), with its stages in the order they started
+    """
+
+    def __init__(self, kind):
+        self.record = dict(new_counters(), run=kind, started=dt.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'), stages=[])
+        self._open = []
+        self._thread = threading.get_ident()
+        self._start = time.perf_counter()
+        self._fold_peak()
+
+    def _fold_peak(self):
+        """Raises the peak memory of the run and the open stages to the peak since the last reset, then resets it"""
+        peak = peak_memory()
+        if peak is None:
+            return
+        for record in [self.record] + self._open:
+            record['peak_memory_bytes'] = max(record['peak_memory_bytes'] or 0, peak)
+        reset_peak_memory()
+
+    def open_stage(self, name):
+        """Starts a stage inside the stages already open, returns its record"""
+        record = dict(new_counters(), stage=name, parent=self._open[-1]['stage'] if self._open != [] else None)
+        with _lock:
+            self.record['stages'].append(record)
+            self._fold_peak()
+            self._open.append(record)
+        record['_start'] = time.perf_counter()
+        return record
+
+    def close_stage(self, record):
+        """Ends a stage started by open_stage()"""
+        record['seconds'] = round(time.perf_counter() - record.pop('_start'), 6)
+        with _lock:
+            self._fold_peak()
+            self._open.remove(record)
+
+    def add_request(self, seconds, status, remaining):
+        """Counts a request against the run and every open stage, see record_request()"""
+        with _lock:
+            for record in [self.record] + self._open:
+                record['requests'] += 1
+                record['request_seconds'] += seconds
+                record['max_request_seconds'] = max(record['max_request_seconds'], seconds)
+                record['status'][str(status)] = record['status'].get(str(status), 0) + 1
+                if status == 429:
+                    record['throttled'] += 1
+                if remaining is not None:
+                    record['remaining_15min'], record['remaining_daily'] = remaining
+                    if record['min_remaining_15min'] is None or remaining[0] < record['min_remaining_15min']:
+                        record['min_remaining_15min'] = remaining[0]
+
+    def finish(self, error=None, path=METRICS_PATH, prom_path=PROM_PATH):
+        """Ends the run and writes it, see write_run() and write_prometheus()
+
+        Parameters
+        ----------
+        error : Exception or None
+            exception which ended the run
+        path : pathname
+            JSON lines file of every run
+        prom_path : pathname
+            Prometheus text file of the last run of each kind
+
+        Returns
+        -------
+        dict
+            record
+        """
+        self._fold_peak()
+        record = self.record
+        record['seconds'] = round(time.perf_counter() - self._start, 6)
+        record['finished'] = round(time.time(), 3)
+        record['failed'] = int(error is not None)
+        record['error'] = None if error is None else type(error).__name__
+        for stage_record in [record] + record['stages']:
+            stage_record['request_seconds'] = round(stage_record['request_seconds'], 6)
+            stage_record['max_request_seconds'] = round(stage_record['max_request_seconds'], 6)
+        # The folder of the run, e.g. athletes/ann/data, may not exist before the first sync
+        if os.path.isdir(os.path.dirname(path) or '.'):
+            write_run(record, path)
+        if os.path.isdir(os.path.dirname(prom_path) or '.'):
+            write_prometheus(record, prom_path)
+        return record
+
+
+@contextlib.contextmanager
+def run(kind):
+    """Records a run while the block executes and writes it when the block exits, yields the Run.
+    A run opened inside another one in the same thread is part of it, rather than recorded on its own
+
+    Parameters
+    ----------
+    kind : str
+        name of the run, e.g. 'sync' or 'analysis'
+
+    Raises
+    ------
+    RuntimeError
+        a run is open in another thread
+    """
+    global _current
+    if _current is not None:
+        if _current._thread != threading.get_ident():
+            raise RuntimeError("The {!r} run is already open in another thread, runs must not overlap".format(_current.record['run']))
+        yield _current
+        return
+    _current = Run(kind)
+    try:
+        yield _current
+    except BaseException as e:
+        current, _current = _current, None
+        current.finish(e)
+        raise
+    current, _current = _current, None
+    current.finish()
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Records a stage of the current run while the block executes, yields its record so the block can set record['rows'].
+    Outside a run the record is discarded
+
+    Parameters
+    ----------
+    name : str
+        name of the stage, usually the function it times
+    """
+    current = _current
+    if current is None:
+        yield {}
+        return
+    record = current.open_stage(name)
+    try:
+        yield record
+    finally:
+        current.close_stage(record)
+
+
+def record_request(seconds, status, remaining=None):
+    """Counts an API request against the current run and its open stages, does nothing outside a run
+
+    Parameters
+    ----------
+    seconds : float
+        latency of the request
+    status : int
+        HTTP status code of the response
+    remaining : tuple or None
+        requests left in the (15 minute, daily) windows after the response, see RateLimiter.remaining()
+    """
+    current = _current
+    if current is not None:
+        current.add_request(seconds, status, remaining)
+
+
+def write_run(record, path=METRICS_PATH):
+    """Appends a run to the JSON lines file of every run
+
+    Parameters
+    ----------
+    record : dict
+        see Run.finish()
+    path : pathname
+    """
+    with open(path, 'a') as metricsfile:
+        metricsfile.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+
+def prometheus_samples(record):
+    """Returns the Prometheus samples of a run
+
+    Parameters
+    ----------
+    record : dict
+        see Run.finish()
+
+    Returns
+    -------
+    list
+        of (metric name, help text, labels, value), labels as a 'key="value",...' string
+    """
+    kind = record['run']
+    samples = []
+    for field, (name, help_text) in RUN_METRICS.items():
+        if record.get(field) is not None:
+            samples.append((name, help_text, 'run="{}"'.format(kind), record[field]))
+    for window in ('15min', 'daily'):
+        if record['remaining_' + window] is not None:
+            samples.append(HEADROOM_METRIC + ('run="{}",window="{}"'.format(kind, window), record['remaining_' + window]))
+    # A stage run more than once, e.g. a loop, is reported as the sum of its runs
+    totals = {}
+    for stage_record in record['stages']:
+        total = totals.setdefault(stage_record['stage'], {})
+        for field in STAGE_METRICS:
+            if stage_record[field] is None:
+                continue
+            if field == 'peak_memory_bytes':
+                total[field] = max(total.get(field, 0), stage_record[field])
+            else:
+                total[field] = total.get(field, 0) + stage_record[field]
+    for stage_name, total in totals.items():
+        for field, value in total.items():
+            name, help_text = STAGE_METRICS[field]
+            samples.append((name, help_text, 'run="{}",stage="{}"'.format(kind, stage_name), value))
+    return samples
+
+
+def write_prometheus(record, path=PROM_PATH):
+    """Writes the samples of a run to the Prometheus text file, replacing those of the previous run of the same kind.
+    The file is replaced in one step so the collector never reads it half written
+
+    Parameters
+    ----------
+    record : dict
+        see Run.finish()
+    path : pathname
+    """
+    kind_label = 'run="{}"'.format(record['run'])
+    help_texts = {}
+    lines = {}
+    try:
+        with open(path, 'r') as promfile:
+            for line in promfile:
+                line = line.rstrip('\n')
+                if line.startswith('# HELP '):
+                    name, _, help_text = line[len('# HELP '):].partition(' ')
+                    help_texts[name] = help_text
+                elif line != '' and not line.startswith('#') and kind_label not in line:
+                    lines.setdefault(line.split('{')[0].split(' ')[0], []).append(line)
+    except FileNotFoundError:
+        pass
+    for name, help_text, labels, value in prometheus_samples(record):
+        help_texts[name] = help_text
+        lines.setdefault(name, []).append('{}{{{}}} {}'.format(name, labels, value))
+    text = ''
+    for name in sorted(lines):
+        text += '# HELP {} {}\n# TYPE {} gauge\n'.format(name, help_texts.get(name, ''), name)
+        text += '\n'.join(lines[name]) + '\n'
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as promfile:
+        promfile.write(text)
+    os.replace(tmp_path, path)
@@ -0,0 +1,287 @@
+""" Defines the rate-limit scheduler shared by all Strava API requests
+Strava counts requests in fixed 15 minute windows (resetting at :00, :15, :30 and :45 UTC) and a daily window (resetting at midnight UTC).
+The limits and current usage are reported in the X-RateLimit-Limit and X-RateLimit-Usage headers of every response.
+
+Contains the following classes:
+TimeoutFifteen(Exception)
+TimeoutDaily(Exception)
+QuotaSpent(TimeoutFifteen)
+RateLimiter
+QuotaLimiter
+
+Contains the following functions:
+    seconds_until_reset()
+    window_keys()
+    parse_rate_headers()
+"""
+import datetime as dt
+import threading
+import time
+
+__author__ = "rakeshrgill"
+__email__ = "rakeshrgill@gmail.com"
+
+# Seconds added after a window resets to allow for clock differences with strava
+RESET_MARGIN = 2
+
+
+class TimeoutFifteen(Exception):
+    """Used to indicate a 15 minute timeout has occured"""
+    pass
+
+
+class TimeoutDaily(Exception):
+    """Used to indicate a daily timeout has occured"""
+    pass
+
+
+class QuotaSpent(TimeoutFifteen):
+    """Used to indicate the share of the budget given to one athlete has been used (see QuotaLimiter)"""
+    pass
+
+
+def seconds_until_reset(window, now=None):
+    """Returns the number of seconds until the rate limit window resets
+
+    Parameters
+    ----------
+    window : str
+        "15min" or "daily"
+    now : datetime.datetime
+        utc time, defaults to the current time
+
+    Returns
+    -------
+    float
+    """
+    if now is None:
+        now = dt.datetime.utcnow()
+    if window == "15min":
+        window_start = now.replace(minute=(now.minute // 15) * 15, second=0, microsecond=0)
+        reset = window_start + dt.timedelta(minutes=15)
+    else:
+        reset = now.replace(hour=0, minute=0, second=0, microsecond=0) + dt.timedelta(days=1)
+    return (reset - now).total_seconds()
+
+
+def window_keys(now=None):
+    """Returns hashable keys identifying the current 15 minute and daily windows"""
+    if now is None:
+        now = dt.datetime.utcnow()
+    return (now.year, now.month, now.day, now.hour, now.minute // 15), (now.year, now.month, now.day)
+
+
+def parse_rate_headers(headers):
+    """Reads the limits and usage from the headers of a strava response
+
+    The read limits (X-ReadRateLimit-*) are used when they are present and lower, as all requests made by the program are reads
+
+    Parameters
+    ----------
+    headers : dict
+        response headers
+
+    Returns
+    -------
+    tuple or None
+        (limit_15min, limit_daily, usage_15min, usage_daily), None if the headers are missing
+    """
+    parsed = None
+    for prefix in ['X-RateLimit', 'X-ReadRateLimit']:
+        try:
+            limit_15min, limit_daily = [int(num) for num in headers[prefix + '-Limit'].split(",")]
+            usage_15min, usage_daily = [int(num) for num in headers[prefix + '-Usage'].split(",")]
+        except (KeyError, ValueError):
+            continue
+        if parsed is None or (limit_15min - usage_15min, limit_daily - usage_daily) < (parsed[0] - parsed[2], parsed[1] - parsed[3]):
+            parsed = (limit_15min, limit_daily, usage_15min, usage_daily)
+    return parsed
+
+
+class RateLimiter:
+    """Keeps a token bucket for the 15 minute and daily windows and paces requests so the limits are never exceeded
+
+    The buckets refill when their window resets. Usage is counted locally as requests are made and corrected from the headers of every response,
+    so requests made by other programs using the same application are accounted for.
+    Thread safe, one instance can be shared by concurrent fetchers.
+
+    Parameters
+    ----------
+    limit_15min : int
+        requests per 15 minutes, until a response reports the actual limit
+    limit_daily : int
+        requests per day, until a response reports the actual limit
+    max_wait : float
+        longest time in seconds acquire() will sleep for a window to reset before raising a timeout.
+        The default waits out 15 minute windows and raises TimeoutDaily when the daily budget is spent
+    """
+
+    def __init__(self, limit_15min=100, limit_daily=1000, max_wait=16 * 60):
+        self.limit_15min = limit_15min
+        self.limit_daily = limit_daily
+        self.max_wait = max_wait
+        self.usage_15min = 0
+        self.usage_daily = 0
+        self._windows = window_keys()
+        self._lock = threading.Lock()
+
+    def _roll_windows(self):
+        """Empties the usage of windows which have reset, must be called with the lock held"""
+        key_15min, key_daily = window_keys()
+        if key_15min != self._windows[0]:
+            self.usage_15min = 0
+        if key_daily != self._windows[1]:
+            self.usage_daily = 0
+        self._windows = (key_15min, key_daily)
+
+    def remaining(self):
+        """Returns the requests left in the (15 minute, daily) windows"""
+        with self._lock:
+            self._roll_windows()
+            return max(self.limit_15min - self.usage_15min, 0), max(self.limit_daily - self.usage_daily, 0)
+
+    def acquire(self):
+        """Takes a token for one request, sleeping until a window resets if its budget is spent
+
+        Raises
+        ------
+        TimeoutDaily
+            Daily budget spent and the reset is further away than max_wait
+        TimeoutFifteen
+            15 minute budget spent and the reset is further away than max_wait
+        """
+        while True:
+            with self._lock:
+                self._roll_windows()
+                if self.usage_daily >= self.limit_daily:
+                    window = "daily"
+                elif self.usage_15min >= self.limit_15min:
+                    window = "15min"
+                else:
+                    self.usage_15min += 1
+                    self.usage_daily += 1
+                    return
+            wait = seconds_until_reset(window) + RESET_MARGIN
+            if wait > self.max_wait:
+                if window == "daily":
+                    raise TimeoutDaily
+                raise TimeoutFifteen
+            print("Rate limit reached, waiting {:.0f} minutes and {:.0f} seconds for the {} window to reset".format(wait // 60, wait % 60, window))
+            time.sleep(wait)
+
+    def update(self, headers):
+        """Corrects the limits and usage from the headers of a response
+
+        Parameters
+        ----------
+        headers : dict
+            response headers, ignored if they do not contain rate limit information
+        """
+        parsed = parse_rate_headers(headers)
+        if parsed is None:
+            return
+        limit_15min, limit_daily, usage_15min, usage_daily = parsed
+        with self._lock:
+            self._roll_windows()
+            self.limit_15min = limit_15min
+            self.limit_daily = limit_daily
+            # Local usage also counts requests still in flight, so keep the higher of the two
+            self.usage_15min = max(self.usage_15min, usage_15min)
+            self.usage_daily = max(self.usage_daily, usage_daily)
+
+    def throttled(self, headers):
+        """Marks the exhausted window as spent after a 429 response
+
+        Parameters
+        ----------
+        headers : dict
+            headers of the 429 response
+
+        Returns
+        -------
+        bool
+            True if a window is spent, False if the headers still show budget (a transient throttle)
+        """
+        parsed = parse_rate_headers(headers)
+        if parsed is None:
+            # No information, assume the 15 minute window is spent
+            with self._lock:
+                self.usage_15min = self.limit_15min
+            return True
+        self.update(headers)
+        limit_15min, limit_daily, usage_15min, usage_daily = parsed
+        with self._lock:
+            if usage_daily >= limit_daily:
+                self.usage_daily = self.limit_daily
+            elif usage_15min >= limit_15min:
+                self.usage_15min = self.limit_15min
+            else:
+                return False
+        return True
+
+
+class QuotaLimiter:
+    """Gives a share of a RateLimiter to one athlete, so several athletes can use the budget of one application.
+    Requests are counted against the quota and then against the shared limiter, whose limits and usage stay application wide.
+    Has the same methods as RateLimiter and can replace it in update.rate_limiter
+
+    Parameters
+    ----------
+    limiter : RateLimiter
+        shared by every athlete
+    quota : int
+        most requests which may be made through this limiter
+
+    Attributes
+    ----------
+    used : int
+        requests made
+    refused : bool
+        True once a request has been refused, by the quota or a timeout of the shared limiter
+    """
+
+    def __init__(self, limiter, quota):
+        self.limiter = limiter
+        self.quota = quota
+        self.used = 0
+        self.refused = False
+        self._lock = threading.Lock()
+
+    def remaining(self):
+        """Returns the requests left in the (15 minute, daily) windows, the 15 minute window limited to the quota"""
+        remaining_15min, remaining_daily = self.limiter.remaining()
+        with self._lock:
+            return min(remaining_15min, self.quota - self.used), remaining_daily
+
+    def acquire(self):
+        """Takes a token for one request from the quota and the shared limiter
+
+        Raises
+        ------
+        QuotaSpent
+            quota used
+        TimeoutDaily
+            see RateLimiter.acquire()
+        TimeoutFifteen
+            see RateLimiter.acquire()
+        """
+        with self._lock:
+            if self.used >= self.quota:
+                self.refused = True
+                raise QuotaSpent
+            self.used += 1
+        try:
+            self.limiter.acquire()
+        except (TimeoutFifteen, TimeoutDaily):
+            with self._lock:
+                self.used -= 1
+                self.refused = True
+            raise
+
+    def update(self, headers):
+        """see RateLimiter.update()"""
+        self.limiter.update(headers)
+
+    def throttled(self, headers):
+        """see RateLimiter.throttled()"""
+        return self.limiter.throttled(headers)
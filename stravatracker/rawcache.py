@@ -0,0 +1,125 @@
+""" Defines the cache of raw activity payloads returned by strava
+Every payload is stored exactly as received, including segment_efforts, compressed and addressed by the SHA-256 of its content,
+so fetching an unchanged activity again does not store it twice. An index maps each activity id to its payloads,
+which lets the activity table be rebuilt or normalized differently without using the network.
+
+Contains the following classes:
+RawCache
+"""
+import os
+import json
+import sqlite3
+import zlib
+import hashlib
+import datetime as dt
+
+__author__ = "rakeshrgill"
+__email__ = "rakeshrgill@gmail.com"
+
+CACHE_PATH = os.path.join('data', 'raw.db')
+
+
+class RawCache:
+    """Compressed, content-addressed store of activity payloads, indexed by activity id and updated_at
+
+    Parameters
+    ----------
+    path : pathname
+        location of the SQLite database holding the cache
+    """
+
+    def __init__(self, path=CACHE_PATH):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS objects (digest TEXT PRIMARY KEY, data BLOB)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS payloads (id INTEGER, updated_at TEXT, resource_state INTEGER, digest TEXT, PRIMARY KEY (id, digest))")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Closes the database connection"""
+        self.conn.close()
+
+    def put(self, json_obj):
+        """Stores one payload
+
+        Parameters
+        ----------
+        json_obj : dict
+            activity as returned by strava
+
+        Returns
+        -------
+        str
+            digest of the payload
+        """
+        data = json.dumps(json_obj, sort_keys=True, separators=(',', ':')).encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()
+        # Strava payloads have no updated_at, the time it was received is used instead
+        updated_at = json_obj.get('updated_at') or dt.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+        with self.conn:
+            self.conn.execute("INSERT OR IGNORE INTO objects (digest, data) VALUES (?, ?)", (digest, zlib.compress(data)))
+            self.conn.execute("INSERT OR IGNORE INTO payloads (id, updated_at, resource_state, digest) VALUES (?, ?, ?, ?)",
+                              (json_obj['id'], updated_at, json_obj.get('resource_state'), digest))
+        return digest
+
+    def get(self, activity_id):
+        """Returns the latest payload of an activity, detailed payloads are preferred over summaries
+
+        Parameters
+        ----------
+        activity_id : int
+
+        Returns
+        -------
+        dict or None
+            None if the activity is not in the cache
+        """
+        row = self.conn.execute("SELECT o.data FROM payloads p JOIN objects o ON p.digest = o.digest WHERE p.id = ? "
+                                "ORDER BY p.resource_state DESC, p.updated_at DESC LIMIT 1", (int(activity_id),)).fetchone()
+        if row is None:
+            return None
+        return json.loads(zlib.decompress(row[0]))
+
+    def discard(self, id_list):
+        """Removes every payload of the activities in id_list, for activities edited or deleted on strava
+
+        Parameters
+        ----------
+        id_list : list
+            activity ids
+        """
+        with self.conn:
+            self.conn.executemany("DELETE FROM payloads WHERE id = ?", [(int(num),) for num in id_list])
+            # Identical payloads may be shared, only the ones no activity points at are removed
+            self.conn.execute("DELETE FROM objects WHERE digest NOT IN (SELECT digest FROM payloads)")
+
+    def detailed_ids(self):
+        """Returns the set of activity ids with a detailed (resource_state 3) payload"""
+        return {row[0] for row in self.conn.execute("SELECT DISTINCT id FROM payloads WHERE resource_state >= 3")}
+
+    def iter_latest(self, id_list=None):
+        """Yields the latest payload of each activity, see get()
+
+        Parameters
+        ----------
+        id_list : list or None
+            activities to read, None reads every activity in the cache
+
+        Yields
+        ------
+        dict
+            activity as returned by strava
+        """
+        if id_list is None:
+            id_list = [row[0] for row in self.conn.execute("SELECT DISTINCT id FROM payloads ORDER BY id DESC")]
+        for activity_id in id_list:
+            json_obj = self.get(activity_id)
+            if json_obj is not None:
+                yield json_obj
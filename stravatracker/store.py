@@ -0,0 +1,345 @@
+""" Defines the activity store, an SQLite table of activities keyed on id
+Known columns are typed by SCHEMA, other flattened columns are added to the table as they first appear.
+Updates only write the rows which are new or changed, the rest of the history is left untouched.
+
+Contains the following functions:
+    compact_dtypes()
+    save_activities()
+        fingerprint()
+        connect()
+        add_columns()
+            table_columns()
+        to_sql_value()
+    load_activities()
+        connect()
+        table_columns()
+        compact_dtypes()
+    count_activities()
+    migrate_csv()
+        save_activities()
+        load_activities()
+        rebuild_aggregates() - imported
+"""
+import os
+import json
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+__author__ = "rakeshrgill"
+__email__ = "rakeshrgill@gmail.com"
+
+STORE_PATH = os.path.join('data', 'strava.db')
+TABLE = 'activities'
+# SQLite types of the columns used by the program, other columns take their type from the data
+SCHEMA = {
+    'id': 'INTEGER PRIMARY KEY',
+    'resource_state': 'INTEGER',
+    'name': 'TEXT',
+    'type': 'TEXT',
+    'sport_type': 'TEXT',
+    'start_date': 'TEXT',
+    'start_date_local': 'TEXT',
+    'timezone': 'TEXT',
+    'moving_time': 'INTEGER',
+    'elapsed_time': 'INTEGER',
+    'distance': 'REAL',
+    'total_elevation_gain': 'REAL',
+    'average_speed': 'REAL',
+    'max_speed': 'REAL',
+    'average_watts': 'REAL',
+    'average_heartrate': 'REAL',
+    'max_heartrate': 'REAL',
+    'calories': 'REAL',
+    'workout_type': 'INTEGER',
+    'trainer': 'BOOLEAN',
+    'commute': 'BOOLEAN',
+    'manual': 'BOOLEAN',
+    'private': 'BOOLEAN',
+}
+# Columns compared to find changed activities, every column of SCHEMA. Numeric columns are compared as floats
+FINGERPRINT_NUMERIC = [col for col, sql_type in SCHEMA.items() if sql_type in ('INTEGER', 'REAL', 'BOOLEAN')]
+FINGERPRINT_TEXT = [col for col, sql_type in SCHEMA.items() if sql_type == 'TEXT']
+# Fingerprint columns the activity list shares with the details and LOAD_COLUMNS, compared to find activities edited on strava
+LIST_FINGERPRINT_NUMERIC = ['moving_time', 'elapsed_time', 'distance', 'average_speed', 'average_heartrate', 'average_watts']
+LIST_FINGERPRINT_TEXT = ['name', 'type', 'start_date', 'start_date_local']
+# Columns read by the update and the analysis, a superset of the list fingerprint columns
+LOAD_COLUMNS = ['id', 'resource_state', 'name', 'type', 'start_date', 'start_date_local',
+                'moving_time', 'elapsed_time', 'distance', 'average_speed', 'average_watts', 'average_heartrate', 'calories']
+# In memory types of the columns used by the program, see compact_dtypes()
+DTYPES = {
+    'id': 'int64',
+    'resource_state': 'Int8',
+    'type': 'category',
+    'sport_type': 'category',
+    'start_date': 'datetime64[ns]',
+    'start_date_local': 'datetime64[ns]',
+    'moving_time': 'float32',
+    'elapsed_time': 'float32',
+    'distance': 'float32',
+    'total_elevation_gain': 'float32',
+    'average_speed': 'float32',
+    'max_speed': 'float32',
+    'average_watts': 'float32',
+    'average_heartrate': 'float32',
+    'max_heartrate': 'float32',
+    'calories': 'float32',
+}
+
+
+def connect(path=STORE_PATH):
+    """Opens the store, creating the activities table if needed
+
+    Parameters
+    ----------
+    path : pathname
+        location of the SQLite database
+
+    Returns
+    -------
+    sqlite3.Connection
+    """
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    cols = ", ".join('"{}" {}'.format(col, sql_type) for col, sql_type in SCHEMA.items())
+    conn.execute('CREATE TABLE IF NOT EXISTS {} ({})'.format(TABLE, cols))
+    return conn
+
+
+def table_columns(conn):
+    """Returns a dictionary of column name to declared type for the activities table"""
+    return {row[1]: row[2] for row in conn.execute('PRAGMA table_info({})'.format(TABLE))}
+
+
+def add_columns(conn, df):
+    """Adds the columns of df which are not yet in the activities table
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        see connect()
+    df : pandas.DataFrame
+        activities to be saved
+    """
+    existing = table_columns(conn)
+    for col in df.columns:
+        if col in existing:
+            continue
+        if pd.api.types.is_bool_dtype(df[col]):
+            sql_type = 'BOOLEAN'
+        elif pd.api.types.is_integer_dtype(df[col]):
+            sql_type = 'INTEGER'
+        elif pd.api.types.is_float_dtype(df[col]):
+            sql_type = 'REAL'
+        else:
+            sql_type = 'TEXT'
+        conn.execute('ALTER TABLE {} ADD COLUMN "{}" {}'.format(TABLE, col, sql_type))
+
+
+def to_sql_value(value):
+    """Converts one cell to a value SQLite can store, nested lists and dictionaries are stored as JSON"""
+    if isinstance(value, (list, dict)):
+        return json.dumps(value)
+    if value is None or (isinstance(value, float) and np.isnan(value)) or value is pd.NA or value is pd.NaT:
+        return None
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, pd.Timestamp):
+        # Same format as strava
+        return value.strftime('%Y-%m-%dT%H:%M:%SZ')
+    return value
+
+
+def compact_dtypes(df):
+    """Converts the columns in DTYPES to their compact types, without modifying df.
+    Dates are parsed to naive datetimes, start_date_local keeps the local time of the activity
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        activities
+
+    Returns
+    -------
+    pandas.DataFrame
+    """
+    converted = {}
+    for col, dtype in DTYPES.items():
+        if col not in df.columns or df[col].dtype == dtype:
+            continue
+        if dtype == 'datetime64[ns]':
+            converted[col] = pd.to_datetime(df[col], utc=True).dt.tz_localize(None)
+        elif dtype == 'category':
+            converted[col] = df[col].astype('category')
+        else:
+            converted[col] = pd.to_numeric(df[col], errors='coerce').astype(dtype)
+    if converted == {}:
+        return df
+    return df.assign(**converted)
+
+
+def fingerprint(df, numeric=FINGERPRINT_NUMERIC, text=FINGERPRINT_TEXT):
+    """Hashes the fields which change when an activity is edited or its details are fetched
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        activities
+    numeric : list
+        columns compared as floats
+    text : list
+        columns compared as strings
+
+    Returns
+    -------
+    numpy.ndarray
+        one uint64 hash per row
+    """
+    frame = pd.DataFrame(index=df.index)
+    for col in numeric:
+        if col in df.columns:
+            frame[col] = pd.to_numeric(df[col], errors='coerce').astype('float64')
+        else:
+            frame[col] = np.nan
+    for col in text:
+        if col in df.columns:
+            frame[col] = df[col].astype(object).where(df[col].notna(), '').astype(str)
+        else:
+            frame[col] = ''
+    return pd.util.hash_pandas_object(frame, index=False).values
+
+
+def save_activities(df, previous=None, path=STORE_PATH):
+    """Writes the new and changed activities in df to the store and removes the ones no longer in df
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        contains activities downloaded from strava, with segments dropped (see get_new_activities())
+    previous : pandas.DataFrame or None
+        the activities df was updated from (see load_activities()). When None every row of df is written
+    path : pathname
+        location of the SQLite database
+
+    Returns
+    -------
+    list, list
+        changed_id_list (written), deleted_id_list (removed)
+    """
+    if previous is None or previous.shape[0] == 0:
+        changed_df = df
+        deleted_id_list = []
+    else:
+        # Compare fingerprints of the activities in both, on the columns previous was loaded with
+        numeric = [col for col in FINGERPRINT_NUMERIC if col in previous.columns]
+        text = [col for col in FINGERPRINT_TEXT if col in previous.columns]
+        previous_fp = pd.Series(fingerprint(previous, numeric, text), index=previous['id'].values)
+        new_fp = pd.Series(fingerprint(df, numeric, text), index=df['id'].values)
+        common = new_fp.index.isin(previous_fp.index)
+        changed = ~common
+        changed[common] = new_fp.values[common] != previous_fp.reindex(new_fp.index[common]).values
+        # The other columns are only set on the activities fetched by the update, which are written in full
+        unloaded = [col for col in FINGERPRINT_NUMERIC + FINGERPRINT_TEXT if col in df.columns and col not in previous.columns]
+        if unloaded != []:
+            changed |= df[unloaded].notna().any(axis=1).values
+        changed_df = df[changed]
+        deleted_id_list = previous_fp.index[~previous_fp.index.isin(new_fp.index)].to_list()
+    conn = connect(path)
+    try:
+        with conn:
+            if changed_df.shape[0] > 0:
+                add_columns(conn, changed_df)
+                # float32 columns are written as their shortest decimal, not the float64 expansion of it
+                float32_cols = [col for col in changed_df.columns if changed_df[col].dtype == 'float32']
+                changed_df = changed_df.astype({col: str for col in float32_cols}).astype({col: 'float64' for col in float32_cols})
+                cols = list(changed_df.columns)
+                # Columns left out of df, when it was loaded with a projection, keep their stored values
+                sql = 'INSERT INTO {} ({}) VALUES ({}) ON CONFLICT (id) DO UPDATE SET {}'.format(
+                    TABLE, ", ".join('"{}"'.format(col) for col in cols), ", ".join("?" * len(cols)),
+                    ", ".join('"{0}" = excluded."{0}"'.format(col) for col in cols if col != 'id'))
+                rows = ([to_sql_value(value) for value in row] for row in changed_df.itertuples(index=False, name=None))
+                conn.executemany(sql, rows)
+            if deleted_id_list != []:
+                conn.executemany('DELETE FROM {} WHERE id = ?'.format(TABLE), [(int(num),) for num in deleted_id_list])
+    finally:
+        conn.close()
+    return changed_df['id'].to_list(), deleted_id_list
+
+
+def load_activities(columns=None, path=STORE_PATH):
+    """Reads activities from the store
+
+    Parameters
+    ----------
+    columns : list or None
+        columns to read, columns missing from the store are returned empty. None reads every column, see LOAD_COLUMNS
+    path : pathname
+        location of the SQLite database
+
+    Returns
+    -------
+    pandas.DataFrame
+        contains activities downloaded from strava, with segments dropped (see get_new_activities()), newest first.
+        Columns are converted by compact_dtypes()
+
+    Raises
+    ------
+    FileNotFoundError
+        Missing store
+    """
+    if not os.path.exists(path):
+        raise FileNotFoundError("Missing activity store")
+    conn = connect(path)
+    try:
+        existing = table_columns(conn)
+        if columns is None:
+            columns = list(existing)
+        selected = [col for col in columns if col in existing]
+        sql = 'SELECT {} FROM {} ORDER BY id DESC'.format(", ".join('"{}"'.format(col) for col in selected), TABLE)
+        df = pd.read_sql_query(sql, conn)
+    finally:
+        conn.close()
+    for col in selected:
+        if existing[col] == 'BOOLEAN':
+            df[col] = df[col].astype('boolean')
+    for col in columns:
+        if col not in existing:
+            df[col] = np.nan
+    return compact_dtypes(df[columns])
+
+
+def count_activities(path=STORE_PATH):
+    """Returns the number of activities in the store, 0 if there is no store"""
+    if not os.path.exists(path):
+        return 0
+    conn = connect(path)
+    try:
+        return conn.execute('SELECT COUNT(*) FROM {}'.format(TABLE)).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def migrate_csv(csv_path, path=STORE_PATH):
+    """Imports a strava_activities csv written by older versions into the store, and builds the aggregates of the imported activities
+
+    Parameters
+    ----------
+    csv_path : pathname
+        location of the csv
+    path : pathname
+        location of the SQLite database
+
+    Returns
+    -------
+    pandas.DataFrame
+        the imported activities
+    """
+    # aggregates reads the rules of analysis, which are only loaded when needed
+    from .aggregates import rebuild_aggregates
+
+    df = pd.read_csv(csv_path)
+    save_activities(df, None, path)
+    # Updates only recompute the days they change, so the history is aggregated here
+    rebuild_aggregates(load_activities(LOAD_COLUMNS, path), path)
+    return df
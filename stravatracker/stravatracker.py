@@ -11,32 +11,77 @@ main_menu()
     check_last_timeout() - imported
     update_write()
     analysis()
+    rebuild_write()
 
 analysis()
     excel_clean() - imported
     pandas_df_converter() - imported
+    aggregates_current() - imported
+    rebuild_aggregates() - imported
+    training_current() - imported
+    rebuild_training() - imported
     table_analysis()
+    load_daily_matrix() - imported
+    load_training() - imported
     graph_plots() - imported
+    save_graphs() - imported
 
 table_analysis()
+    load_table_ls() - imported
+    update_curves() - imported
+    load_curve_table() - imported
+    advance_training() - imported
+    load_training() - imported
+    training_table() - imported
 update_write()
     strava_update() - imported
+    save_activities() - imported
+    update_aggregates() - imported
+    update_training() - imported
+    advance_training() - imported
+    refresh_best() - imported
+    clear_journal() - imported
+    merge_tokens() - imported
     write_json()
+rebuild_write()
+    rebuild_activities() - imported
+    save_activities() - imported
+    rebuild_aggregates() - imported
+    rebuild_training() - imported
+    advance_training() - imported
 load_files()
+    count_activities() - imported
+    load_activities() - imported
+    migrate_csv() - imported
+sync()
+    read_json()
+    check_last_timeout() - imported
+    load_files()
+    update_write()
+load()
+    load_activities() - imported
+analyze()
+    read_json()
+    load_files()
+    analysis()
+main()
+    program()
+    sync()
+    analyze()
+    add_athlete() - imported
+    sync_athletes() - imported
 read_json()
 write_json()
 """
-# TODO: Build test for update.py
-# TODO: Build Test for stravatracker.py
-# TODO: Build integration test for stravatracker and update.py
 import os
 import json
+import argparse
 
-import pandas as pd
-
-from update import strava_update, check_last_timeout
-from first_run import setup
-from analysis import excel_clean, pandas_df_converter, graph_plots, return_table_ls
+from .update import strava_update, check_last_timeout, rebuild_activities
+from .journal import clear_journal
+from .first_run import setup, NEW_CONFIG_KEYS
+from .tokens import CONFIG_PATH, merge_tokens
+from . import metrics
 
 __author__ = "rakeshrgill"
 __email__ = "rakeshrgill@gmail.com"
@@ -59,7 +104,7 @@ def program():
         # Needs to reload config and df files each loop
         # Load config file
         try:
-            path = os.path.join('data', 'config.json')
+            path = CONFIG_PATH
             config = read_json(path)
         except (FileNotFoundError, ValueError):
             # First Run Trigger
@@ -75,11 +120,12 @@ def program():
                         print("Config file setup was quit. Program will exit")
                         raise SystemExit(0)
                     else:
-                        path = os.path.join('data', 'config.json')
+                        path = CONFIG_PATH
                         write_json(config, path)
                         df = None
                         print("Running initial database setup")
-                        update_write(config, df)
+                        with metrics.run('sync'):
+                            update_write(config, df)
                         print("Initial database update complete")
                 elif answer == '2':
                     ask_question = False
@@ -98,10 +144,11 @@ def program():
 
 
 def main_menu(config, df):
-    """ Main menu with 3 options: 1. Update Database, 2. Database Analysis, 3. Exit
+    """ Main menu with 4 options: 1. Update Database, 2. Database Analysis, 3. Exit, 4. Rebuild Database from Cache
     check_last_timeout() - imported
     update_write()
     analysis()
+    rebuild_write()
 
     Parameters
     ----------
@@ -125,7 +172,7 @@ def main_menu(config, df):
             print("You still have activites to update from the previous, please choose option 1 when prompted.")
         else:
             pass
-        answer = input("What would you like to do?\n1. Update Database\n2. Database Analysis\n3. Exit\n")
+        answer = input("What would you like to do?\n1. Update Database\n2. Database Analysis\n3. Exit\n4. Rebuild Database from Cache\n")
         # Check if the API has timed out
         can_update = check_last_timeout(config)
         if can_update:
@@ -135,29 +182,44 @@ def main_menu(config, df):
         # Process answer
         if answer == '1':
             if can_update:
-                update_write(config, df)
+                with metrics.run('sync'):
+                    update_write(config, df)
                 ask_question = False
                 return True
             else:
                 print("Option disabled")
         elif answer == '2':
-            analysis(config, df)
+            with metrics.run('analysis'):
+                analysis(config, df)
             ask_question = False
             return True
         elif answer == '3':
             print("Exit")
             ask_question = False
             return False
+        elif answer == '4':
+            with metrics.run('rebuild'):
+                rebuild_write(config, df)
+            ask_question = False
+            return True
         else:
             print("Invalid Answer")
 
 
-def analysis(config, df):
-    """Calls analysis functions, saves excel csv to disk
+def analysis(config, df, output_dir=None, fmt='png'):
+    """Calls analysis functions, saves excel csv to disk.
+    The stages are recorded in the metrics run opened by the caller, analyze() or the menu
     excel_clean() - imported
     pandas_df_converter() - imported
+    aggregates_current() - imported
+    rebuild_aggregates() - imported
+    training_current() - imported
+    rebuild_training() - imported
     table_analysis()
+    load_daily_matrix() - imported
+    load_training() - imported
     graph_plots() - imported
+    save_graphs() - imported
 
     Parameters
     ----------
@@ -165,43 +227,94 @@ def analysis(config, df):
         config variables (see read_json())
     df : pandas.DataFrame
         contains activities downloaded from strava, with segments dropped (see get_new_activities())
+    output_dir : pathname or None
+        folder to save the graphs to without a display, None shows them in a window
+    fmt : str
+        image format of the saved graphs, "png" or "svg"
     """
+    from .analysis import excel_clean, pandas_df_converter, graph_plots, save_graphs
+    from .aggregates import rebuild_aggregates, aggregates_current, load_daily_matrix
+    from .training import training_current, rebuild_training, load_training
+
     print("Running Analysis")
     # Output to Excel
-    excel_df = excel_clean(df)
+    with metrics.stage('excel_clean') as record:
+        excel_df = excel_clean(df)
+        record['rows'] = excel_df.shape[0]
     excel_df.to_csv('data' + '/' + r'excel_all_activities_{}.csv'.format(config['last_update']), index=False)
     # Pandas df conversion
-    pandas_df = pandas_df_converter(excel_df)
+    with metrics.stage('pandas_df_converter') as record:
+        pandas_df = pandas_df_converter(excel_df)
+        record['rows'] = pandas_df.shape[0]
     # Output to tables
-    table_analysis(config, pandas_df)
-    # Output to graphs
-    graph_plots(pandas_df)
+    if not aggregates_current():
+        with metrics.stage('rebuild_aggregates'):
+            rebuild_aggregates(df)
+    if not training_current(config):
+        with metrics.stage('rebuild_training'):
+            rebuild_training(df, config)
+    with metrics.stage('table_analysis'):
+        table_analysis(config)
+    # Output to graphs, drawn from the daily matrix cached with the aggregates
+    with metrics.stage('load_daily_matrix') as record:
+        matrix = load_daily_matrix()
+        record['rows'] = matrix.shape[0]
+    training_df = load_training()
+    if output_dir is None:
+        with metrics.stage('graph_plots'):
+            graph_plots(pandas_df, matrix, training_df)
+    else:
+        with metrics.stage('save_graphs') as record:
+            path_ls = save_graphs(pandas_df, output_dir, fmt, suffix='_{}'.format(config['last_update']), matrix=matrix, training=training_df)
+            record['rows'] = len(path_ls)
+        print("{} graphs saved to {}".format(len(path_ls), output_dir))
     print("Analysis Completed")
 
 
-def table_analysis(config, pandas_df):
-    """ Takes in database, runs conversion to tables, saves it as a CSV
+def table_analysis(config):
+    """ Reads the yearly and monthly tables from the aggregate store, saves them as a CSV.
+    The best efforts of the activities with streams and the training load are brought up to date and saved with them
+    update_curves() - imported
+    load_curve_table() - imported
+    advance_training() - imported
+    load_training() - imported
+    training_table() - imported
 
     Parameters
     ----------
     config : dict
         config variables (see read_json())
-    pandas_df : pandas.DataFrame
-        converted database (see pandas_df_converter())
     """
-    df = pandas_df.copy()
+    from .aggregates import load_table_ls
+    from .curves import update_curves, load_curve_table
+    from .training import advance_training, load_training, training_table
+
     # table making
     freq_ls = ["Y", "M"]
-    table_ls = return_table_ls(df, freq_ls)
+    with metrics.stage('load_table_ls'):
+        table_ls = load_table_ls(freq_ls)
     # table saving
     table_ls[0].to_csv('data' + '/' + r'yearlytable_{}.csv'.format(config['last_update']), index=True)
     table_ls[1].to_csv('data' + '/' + r'yearly_todate_table_{}.csv'.format(config['last_update']), index=True)
     table_ls[2].to_csv('data' + '/' + r'monthly_table_{}.csv'.format(config['last_update']), index=True)
     table_ls[2].reset_index().pivot(index='start_date_local', columns='type', values=['duration', 'number_of_ex', 'days_of_ex']).reorder_levels(axis=1, order=[1, 0]).sort_index(axis=1, level=[0, 1], ascending=True, inplace=False).to_csv('data' + '/' + r'monthly_table_pivot_{}.csv'.format(config['last_update']), index=True)
-
-
-def update_write(config, df):
+    # best effort table, only once streams have been downloaded (see get_streams())
+    with metrics.stage('update_curves') as record:
+        record['rows'] = update_curves()
+    curve_table = load_curve_table()
+    if not curve_table.empty:
+        curve_table.to_csv('data' + '/' + r'best_efforts_table_{}.csv'.format(config['last_update']), index=True)
+    # weekly fitness and fatigue, advanced from the last update to today
+    with metrics.stage('advance_training') as record:
+        record['rows'] = advance_training()
+    training_table(load_training()).to_csv('data' + '/' + r'training_load_table_{}.csv'.format(config['last_update']), index=True)
+
+
+def update_write(config, df, stage='all'):
     """Updates database and writes output to file
+    Only new and changed activities are written to the activity store, and the training series is advanced to today
+    so it is current for other programs reading the database between analyses.
+    The stages are recorded in the metrics run opened by the caller, sync(), the menu or the scheduler
 
     Parameters
     ----------
@@ -209,17 +322,80 @@ def update_write(config, df):
         config variables (see read_json())
     df : pandas.DataFrame
         contains activities downloaded from strava, with segments dropped (see get_new_activities())
+    stage : str
+        see strava_update()
+
+    Returns
+    -------
+    dict, pandas.DataFrame
+        config and activities after the update
     """
+    from .store import save_activities
+    from .aggregates import update_aggregates
+    from .training import update_training, advance_training
+    from .curves import refresh_best
+
     print("Updating database")
-    config, df = strava_update(config, df)
-    path = os.path.join('data', 'config.json')
+    with metrics.stage('strava_update') as record:
+        config, new_df = strava_update(config, df, stage)
+        record['rows'] = 0 if new_df is None else new_df.shape[0]
+    if new_df is not None:
+        with metrics.stage('save_activities') as record:
+            changed_id_list, deleted_id_list = save_activities(new_df, previous=df)
+            record['rows'] = len(changed_id_list) + len(deleted_id_list)
+        print("{} activities written, {} activities removed".format(len(changed_id_list), len(deleted_id_list)))
+        with metrics.stage('update_aggregates'):
+            update_aggregates(new_df, df, changed_id_list, deleted_id_list)
+        with metrics.stage('update_training'):
+            update_training(new_df, df, changed_id_list, deleted_id_list, config)
+        with metrics.stage('advance_training') as record:
+            record['rows'] = advance_training()
+        refresh_best(changed_id_list, deleted_id_list)
+        # Fetched activities are now safely in the store
+        clear_journal(new_df['id'].to_list())
+    path = CONFIG_PATH
+    # Another process may have rotated the refresh token during the update
+    merge_tokens(config, path)
     write_json(config, path)
-    df.to_csv('data' + '/' + r'strava_activities_{}.csv'.format(config['last_update']), index=False)
     print("Databse and config written to disk")
+    return config, new_df
+
+
+def rebuild_write(config, df):
+    """Rebuilds the database from the raw cache and writes every activity to the store.
+    The stages are recorded in the metrics run opened by the menu
+
+    Parameters
+    ----------
+    config : dict
+        config variables (see read_json())
+    df : pandas.DataFrame
+        contains activities downloaded from strava, with segments dropped (see get_new_activities())
+    """
+    from .store import save_activities
+    from .aggregates import rebuild_aggregates
+    from .training import rebuild_training, advance_training
+
+    with metrics.stage('rebuild_activities') as record:
+        new_df = rebuild_activities(df)
+        record['rows'] = 0 if new_df is None else new_df.shape[0]
+    if new_df is not None:
+        # Written in full, columns outside SCHEMA added by the rebuild do not change the fingerprints
+        with metrics.stage('save_activities') as record:
+            changed_id_list, deleted_id_list = save_activities(new_df)
+            record['rows'] = len(changed_id_list)
+        with metrics.stage('rebuild_aggregates'):
+            rebuild_aggregates(new_df)
+        with metrics.stage('rebuild_training'):
+            rebuild_training(new_df, config)
+        with metrics.stage('advance_training') as record:
+            record['rows'] = advance_training()
+        print("{} activities written".format(len(changed_id_list)))
 
 
 def load_files(config):
-    """Loads dataframe file from csv
+    """Loads dataframe from the activity store, only the columns used by the program are read (see LOAD_COLUMNS).
+    On the first load after upgrading, the strava_activities csv written by older versions is imported into the store
 
     Parameters
     ----------
@@ -234,11 +410,21 @@ def load_files(config):
     Raises
     ------
     FileNotFoundError
-        Missing csv file or directory
+        Missing store and csv file, or directory
     """
+    from .store import load_activities, count_activities, migrate_csv, LOAD_COLUMNS
+
     if os.path.exists('data'):
+        if count_activities() > 0:
+            with metrics.stage('load_files') as record:
+                df = load_activities(LOAD_COLUMNS)
+                record['rows'] = df.shape[0]
+            return df
+        csv_path = os.path.join('data', r'strava_activities_{}.csv'.format(config['last_update']))
         try:
-            df = pd.read_csv(os.path.join('data', r'strava_activities_{}.csv'.format(config['last_update'])))
+            migrate_csv(csv_path)
+            print("Imported {} into the activity store".format(csv_path))
+            df = load_activities(LOAD_COLUMNS)
             return df
         except FileNotFoundError:
             print("strava_activities missing")
@@ -250,6 +436,118 @@ def load_files(config):
         return df
 
 
+def sync(path=CONFIG_PATH):
+    """Runs one update without the main menu, for scheduled runs or use from another program
+
+    Parameters
+    ----------
+    path : pathname
+        location of JSON file (see read_json())
+
+    Returns
+    -------
+    dict
+        config variables after the update, config['remaining_updates'] is True if activities are left for the next run
+
+    Raises
+    ------
+    FileNotFoundError
+        Missing config file, run the program once to set it up
+    """
+    config = read_json(path)
+    if not check_last_timeout(config):
+        return config
+    with metrics.run('sync'):
+        try:
+            df = load_files(config)
+        except FileNotFoundError:
+            # Nothing downloaded yet
+            df = None
+        update_write(config, df)
+    return read_json(path)
+
+
+def load(columns=None):
+    """Returns the activities in the database
+
+    Parameters
+    ----------
+    columns : list or None
+        columns to read, None reads the columns used by the program (see store.LOAD_COLUMNS)
+
+    Returns
+    -------
+    pandas.DataFrame
+        contains activities downloaded from strava, with segments dropped (see get_new_activities())
+    """
+    from .store import load_activities, LOAD_COLUMNS
+
+    if columns is None:
+        columns = LOAD_COLUMNS
+    return load_activities(columns)
+
+
+def analyze(path=CONFIG_PATH, output_dir=None, fmt='png'):
+    """Runs the analysis without the main menu, see analysis()
+
+    Parameters
+    ----------
+    path : pathname
+        location of JSON file (see read_json())
+    output_dir : pathname or None
+        folder to save the graphs to without a display, None shows them in a window
+    fmt : str
+        image format of the saved graphs, "png" or "svg"
+    """
+    config = read_json(path)
+    with metrics.run('analysis'):
+        df = load_files(config)
+        analysis(config, df, output_dir, fmt)
+
+
+def main(argv=None):
+    """Command line entry point (see __main__). Without arguments the interactive program is run,
+    --output-dir runs the analysis without a display for scheduled jobs.
+    --athletes syncs every athlete profile in athletes/ (see sync_athletes()), and with --output-dir analyses each of them
+    add_athlete() - imported
+    sync_athletes() - imported
+    list_athletes() - imported
+    in_folder() - imported
+
+    Parameters
+    ----------
+    argv : list or None
+        command line arguments, None reads sys.argv
+    """
+    parser = argparse.ArgumentParser(prog='stravatracker', description="Tracks strava workouts")
+    parser.add_argument('--output-dir', help="save the graphs to this folder without a display, instead of running the menu")
+    parser.add_argument('--format', default='png', choices=['png', 'svg'], help="image format of the saved graphs")
+    parser.add_argument('--sync', action='store_true', help="download new activities before the analysis, with --output-dir")
+    parser.add_argument('--athletes', action='store_true', help="sync every athlete in the athletes folder within the application's rate limits")
+    parser.add_argument('--add-athlete', nargs=2, metavar=('NAME', 'REFRESH_TOKEN'), help="add an athlete who has authorised this application")
+    args = parser.parse_args(argv)
+    if args.add_athlete is not None or args.athletes:
+        from .athletes import add_athlete, sync_athletes, athlete_dir, list_athletes, in_folder
+
+        if args.add_athlete is not None:
+            add_athlete(*args.add_athlete)
+            print("Athlete {} added".format(args.add_athlete[0]))
+            return
+        sync_athletes()
+        if args.output_dir is not None:
+            output_dir = os.path.abspath(args.output_dir)
+            for name in list_athletes():
+                with in_folder(athlete_dir(name)):
+                    analyze(output_dir=os.path.join(output_dir, name), fmt=args.format)
+        return
+    if args.output_dir is None:
+        program()
+        return
+    if args.sync:
+        sync()
+    analyze(output_dir=args.output_dir, fmt=args.format)
+
+
 def read_json(path):
     """Reads the config.json file and returns a dictionary
 
@@ -269,7 +567,18 @@ def read_json(path):
             'remaining_updates' : False,
             'client_id': '',
             'client_secret': '',
-            'refresh_token': ''
+            'refresh_token': '',
+            'after_cursor': 1657800000,
+            'last_full_sync': '2022_07_10_0900',
+            'full_sync_days': 7,
+            'ingest_mode': 'detail',
+            'fetch_streams': False,
+            'load_metric': 'duration',
+            'ftp': 0,
+            'threshold_hr': 0,
+            'access_token': '',
+            'expires_at': 1657900000,
+            'fetch_types': ['Run']
         }
 
     Raises
@@ -279,12 +588,15 @@ def read_json(path):
     """
     ls_keys = ['first_run', 'last_update',
                'last_timeout_daily', 'last_timeout_15min', 'remaining_updates',
-               'client_id', 'client_secret', 'refresh_token']
+               'client_id', 'client_secret', 'refresh_token'] + list(NEW_CONFIG_KEYS)
     try:
         with open(path, 'r') as jsonfile:
             data = json.load(jsonfile)
             # print("Read successful")
             jsonfile.close()
+        # Upgrade config files written by older versions
+        for key, value in NEW_CONFIG_KEYS.items():
+            data.setdefault(key, value)
         # Check if all the fields are present
         if all(key in data for key in ls_keys) and all(key in ls_keys for key in data):
             return data
@@ -312,15 +624,14 @@ def write_json(config, path):
     """
     ls_keys = ['first_run', 'last_update',
                'last_timeout_daily', 'last_timeout_15min', 'remaining_updates',
-               'client_id', 'client_secret', 'refresh_token']
+               'client_id', 'client_secret', 'refresh_token'] + list(NEW_CONFIG_KEYS)
     if all(key in config for key in ls_keys) and all(key in ls_keys for key in config):
-        with open(path, 'w') as jsonfile:
+        # Written to a temporary file and swapped in, so other processes never read a partial file
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as jsonfile:
             json.dump(config, jsonfile)  # Writing to the file
             # print("Write successful")
         jsonfile.close()
+        os.replace(tmp_path, path)
     else:
         raise ValueError("Config dictionary is in invalid format")
-
-
-# TODO: Check for requirements
-program()
@@ -0,0 +1,255 @@
+""" Defines the stream store, the second by second data of each activity (see get_streams())
+Every stream is kept in its own file as a flat typed array, the samples of all activities one after another.
+The files are read through numpy.memmap, so scanning millions of samples only pages in the data which is used.
+An index maps each activity id to the offset and number of its samples, which are the same in every file.
+Samples of removed and replaced activities stay in the files until they outnumber the samples in use, then the files are
+rewritten without them (see StreamStore.compact()). The rewrite goes to a new generation of files, which the index switches to
+in one transaction, so a crash part way leaves the previous generation in use.
+
+Contains the following classes:
+StreamStore
+"""
+import os
+import sqlite3
+
+import numpy as np
+
+__author__ = "rakeshrgill"
+__email__ = "rakeshrgill@gmail.com"
+
+STREAMS_PATH = os.path.join('data', 'streams')
+# Streams requested from strava, latlng is stored as the lat and lng columns
+STREAM_KEYS = ['time', 'distance', 'latlng', 'altitude', 'velocity_smooth', 'heartrate', 'cadence', 'watts', 'temp', 'moving', 'grade_smooth']
+# Stored columns and their types
+STREAM_DTYPES = {
+    'time': 'int32',
+    'distance': 'float32',
+    'lat': 'float32',
+    'lng': 'float32',
+    'altitude': 'float32',
+    'velocity_smooth': 'float32',
+    'heartrate': 'int16',
+    'cadence': 'int16',
+    'watts': 'int16',
+    'temp': 'int8',
+    'moving': 'bool',
+    'grade_smooth': 'float32',
+}
+# Unused samples kept before the files are compacted, they are also compacted once they outnumber the samples in use
+COMPACT_MIN_SAMPLES = 100000
+
+
+class StreamStore:
+    """Columnar store of activity streams, memory mapped for reading and indexed by activity id.
+    An activity missing a stream has zeros in that column, the columns present are listed in the index
+
+    Parameters
+    ----------
+    path : pathname
+        folder holding one .bin file per column and the index database
+
+    Attributes
+    ----------
+    size : int
+        samples in each file
+    used : int
+        samples of the activities in the index, the rest are unused
+    generation : int
+        number of compactions, which names the files (see column_path())
+    """
+
+    def __init__(self, path=STREAMS_PATH):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(path, 'index.db'))
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS streams (id INTEGER PRIMARY KEY, offset INTEGER, length INTEGER, columns TEXT)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS stream_meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._maps = {}
+        row = self.conn.execute("SELECT value FROM stream_meta WHERE key = 'generation'").fetchone()
+        self.generation = 0 if row is None else int(row[0])
+        # Samples written by a put() which did not reach the index are cut off, so every column has the same length
+        self.size, self.used = self.conn.execute("SELECT COALESCE(MAX(offset + length), 0), COALESCE(SUM(length), 0) FROM streams").fetchone()
+        for col, dtype in STREAM_DTYPES.items():
+            col_path = self.column_path(col)
+            with open(col_path, 'ab') as colfile:
+                colfile.truncate(self.size * np.dtype(dtype).itemsize)
+        # Files of another generation were left by a compaction which did not finish, or could not be removed after it
+        current = {os.path.basename(self.column_path(col)) for col in STREAM_DTYPES}
+        for filename in os.listdir(path):
+            if filename.endswith('.bin') and filename.split('.')[0] in STREAM_DTYPES and filename not in current:
+                os.remove(os.path.join(path, filename))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Closes the index and releases the memory maps"""
+        self._maps = {}
+        self.conn.close()
+
+    def column_path(self, col, generation=None):
+        """Returns the location of the file holding a column, in the current generation unless another is given"""
+        if generation is None:
+            generation = self.generation
+        if generation == 0:
+            return os.path.join(self.path, '{}.bin'.format(col))
+        return os.path.join(self.path, '{}.{}.bin'.format(col, generation))
+
+    def put(self, activity_id, streams_json):
+        """Appends the streams of one activity, replacing any stored before
+
+        Parameters
+        ----------
+        activity_id : int
+        streams_json : dict or list
+            response of /activities/{id}/streams with key_by_type=true, an empty response stores an activity without samples
+        """
+        if isinstance(streams_json, list):
+            # Without key_by_type, or no streams at all
+            streams_json = {stream['type']: stream for stream in streams_json}
+        data = {key: stream['data'] for key, stream in streams_json.items() if key in STREAM_KEYS}
+        length = max([len(values) for values in data.values()], default=0)
+        present = []
+        for col, dtype in STREAM_DTYPES.items():
+            if col in ('lat', 'lng'):
+                values = data.get('latlng')
+                if values is not None:
+                    values = np.asarray(values, dtype='float64').reshape(-1, 2)[:, 0 if col == 'lat' else 1]
+            else:
+                values = data.get(col)
+            array = np.zeros(length, dtype=dtype)
+            if values is not None and len(values) == length:
+                if dtype == 'bool':
+                    array[:] = np.asarray(values, dtype='bool')
+                else:
+                    # Gaps in a stream are null, kept as NaN in float columns and 0 in integer ones
+                    values = np.asarray(values, dtype='float64')
+                    array[:] = values if array.dtype.kind == 'f' else np.nan_to_num(values)
+                present.append(col)
+            with open(self.column_path(col), 'ab') as colfile:
+                colfile.write(array.tobytes())
+        with self.conn:
+            replaced = self.conn.execute("SELECT length FROM streams WHERE id = ?", (int(activity_id),)).fetchone()
+            self.conn.execute("INSERT OR REPLACE INTO streams (id, offset, length, columns) VALUES (?, ?, ?, ?)",
+                              (int(activity_id), self.size, length, ','.join(present)))
+        self.size += length
+        self.used += length - (0 if replaced is None else replaced[0])
+        # The files have grown, maps are opened again when next read
+        self._maps = {}
+
+    def remove(self, id_list):
+        """Removes activities from the index, so their streams are fetched again. Their samples stay in the files unused,
+        like replaced ones, and the files are compacted once the unused samples outnumber those in use (see compact())
+
+        Parameters
+        ----------
+        id_list : list
+            activity ids
+        """
+        with self.conn:
+            self.conn.executemany("DELETE FROM streams WHERE id = ?", [(int(num),) for num in id_list])
+            self.used = self.conn.execute("SELECT COALESCE(SUM(length), 0) FROM streams").fetchone()[0]
+        if self.size - self.used >= max(self.used, COMPACT_MIN_SAMPLES):
+            self.compact()
+
+    def compact(self):
+        """Rewrites the files with only the samples of the activities in the index, keeping their order.
+        The samples are copied to the next generation of files, then the index is moved to it in one transaction.
+        Activities whose samples move have new offsets, so their best efforts are computed again (see update_curves())
+
+        Returns
+        -------
+        int
+            samples freed
+        """
+        rows = self.conn.execute("SELECT id, offset, length FROM streams ORDER BY offset").fetchall()
+        # Activities stored one after another are copied as one run
+        runs = []
+        for _, offset, length in rows:
+            if runs != [] and runs[-1][0] + runs[-1][1] == offset:
+                runs[-1][1] += length
+            elif length > 0:
+                runs.append([offset, length])
+        generation = self.generation + 1
+        for col in STREAM_DTYPES:
+            source = self.column(col)
+            with open(self.column_path(col, generation), 'wb') as colfile:
+                for offset, length in runs:
+                    colfile.write(source[offset:offset + length].tobytes())
+        new_offsets = np.concatenate([[0], np.cumsum([row[2] for row in rows])])[:-1]
+        with self.conn:
+            self.conn.executemany("UPDATE streams SET offset = ? WHERE id = ?", [(int(offset), row[0]) for offset, row in zip(new_offsets, rows)])
+            self.conn.execute("INSERT OR REPLACE INTO stream_meta (key, value) VALUES ('generation', ?)", (str(generation),))
+        self._maps = {}
+        old_paths = [self.column_path(col) for col in STREAM_DTYPES]
+        freed = self.size - self.used
+        self.generation = generation
+        self.size = self.used
+        for old_path in old_paths:
+            try:
+                os.remove(old_path)
+            except OSError:
+                # Still mapped by a reader, e.g. on Windows, removed when the store is next opened
+                pass
+        return freed
+
+    def column(self, col):
+        """Returns every sample of a column as a read-only memory map, see index() for the samples of each activity
+
+        Parameters
+        ----------
+        col : str
+            key of STREAM_DTYPES
+
+        Returns
+        -------
+        numpy.ndarray
+        """
+        if col not in self._maps:
+            if self.size == 0:
+                self._maps[col] = np.zeros(0, dtype=STREAM_DTYPES[col])
+            else:
+                self._maps[col] = np.memmap(self.column_path(col), dtype=STREAM_DTYPES[col], mode='r', shape=(self.size,))
+        return self._maps[col]
+
+    def get(self, activity_id):
+        """Returns the streams of an activity
+
+        Parameters
+        ----------
+        activity_id : int
+
+        Returns
+        -------
+        dict or None
+            column: numpy.ndarray view of the memory map, for the columns strava returned. None if the activity has not been stored
+        """
+        row = self.conn.execute("SELECT offset, length, columns FROM streams WHERE id = ?", (int(activity_id),)).fetchone()
+        if row is None:
+            return None
+        offset, length, columns = row
+        return {col: self.column(col)[offset:offset + length] for col in columns.split(',') if col != ''}
+
+    def ids(self):
+        """Returns the set of activity ids which have been stored"""
+        return {row[0] for row in self.conn.execute("SELECT id FROM streams")}
+
+    def index(self):
+        """Returns the index of every activity, to scan the columns without reading them per activity
+
+        Returns
+        -------
+        dict
+            id, offset, length (numpy.ndarray), columns (list of str), ordered by offset
+        """
+        rows = self.conn.execute("SELECT id, offset, length, columns FROM streams ORDER BY offset").fetchall()
+        return {
+            'id': np.array([row[0] for row in rows], dtype='int64'),
+            'offset': np.array([row[1] for row in rows], dtype='int64'),
+            'length': np.array([row[2] for row in rows], dtype='int64'),
+            'columns': [row[3] for row in rows],
+        }
@@ -0,0 +1,206 @@
+""" Defines the access token cache
+The access token, its expiry and the refresh token are kept in the config file, so every update, thread and process using
+the same config reuses one token until it is close to expiring. Strava may return a new refresh token with each refresh,
+which replaces the old one, so it is written to the config file straight away.
+Refreshes are serialised by a lock within the process and a lock file next to the config file between processes.
+
+Contains the following functions:
+    access_token()
+        file_lock()
+        read_tokens()
+        refresh_tokens()
+        save_tokens()
+    merge_tokens()
+        read_tokens()
+"""
+import os
+import json
+import time
+import threading
+import contextlib
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+__author__ = "rakeshrgill"
+__email__ = "rakeshrgill@gmail.com"
+
+CONFIG_PATH = os.path.join('data', 'config.json')
+# Config keys written by a refresh
+TOKEN_KEYS = ['access_token', 'expires_at', 'refresh_token']
+# Seconds before expiry at which the token is refreshed. Strava returns the same token until it is this close to expiring
+REFRESH_MARGIN = 3600
+
+_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """Holds an exclusive lock on path, created if needed, until the block exits. Blocks while another process holds it"""
+    with open(path, 'a') as lockfile:
+        if fcntl is not None:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+        else:
+            lockfile.seek(0)
+            msvcrt.locking(lockfile.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+            else:
+                lockfile.seek(0)
+                msvcrt.locking(lockfile.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def read_tokens(config, path):
+    """Returns the tokens saved in the config file if they are newer than those in config, for the same application
+
+    Parameters
+    ----------
+    config : dict
+        config variables (see read_json())
+    path : pathname
+        location of the config file
+
+    Returns
+    -------
+    dict or None
+        access_token, expires_at, refresh_token
+    """
+    try:
+        with open(path, 'r') as jsonfile:
+            stored = json.load(jsonfile)
+    except (FileNotFoundError, ValueError):
+        return None
+    if stored.get('client_id') != config['client_id'] or stored.get('expires_at', 0) <= config['expires_at']:
+        return None
+    return {key: stored[key] for key in TOKEN_KEYS}
+
+
+def save_tokens(config, path):
+    """Writes the tokens in config to the config file, leaving the other settings as they are on disk.
+    The file is replaced in one step so other processes never read it half written
+
+    Parameters
+    ----------
+    config : dict
+        config variables (see read_json())
+    path : pathname
+        location of the config file, nothing is written if it does not exist
+    """
+    try:
+        with open(path, 'r') as jsonfile:
+            stored = json.load(jsonfile)
+    except FileNotFoundError:
+        return
+    stored.update({key: config[key] for key in TOKEN_KEYS})
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as jsonfile:
+        json.dump(stored, jsonfile)
+    os.replace(tmp_path, path)
+
+
+def refresh_tokens(config, session, token_url):
+    """Exchanges the refresh token for an access token
+
+    Parameters
+    ----------
+    config : dict
+        config['client_id']
+        config['client_secret']
+        config['refresh_token']
+    session : requests.Session
+    token_url : str
+
+    Returns
+    -------
+    dict
+        access_token, expires_at, refresh_token
+
+    Raises
+    ------
+    requests.exceptions.HTTPError
+    """
+    payload = {
+        'client_id': config['client_id'],
+        'client_secret': config['client_secret'],
+        'refresh_token': config['refresh_token'],
+        'grant_type': 'refresh_token',
+        'f': 'json'
+    }
+    response = session.post(token_url, data=payload, verify=False)
+    response.raise_for_status()
+    json_obj = response.json()
+    return {
+        'access_token': json_obj['access_token'],
+        # Older responses only give the lifetime
+        'expires_at': int(json_obj.get('expires_at', time.time() + json_obj.get('expires_in', 0))),
+        'refresh_token': json_obj.get('refresh_token', config['refresh_token'])
+    }
+
+
+def access_token(config, session, token_url, path=CONFIG_PATH):
+    """Returns a valid access token, refreshing it only when it expires within REFRESH_MARGIN seconds.
+    A token refreshed by another process is read from the config file instead of refreshing again. Updates:
+        config['access_token']
+        config['expires_at']
+        config['refresh_token']
+
+    Parameters
+    ----------
+    config : dict
+        config variables (see read_json())
+    session : requests.Session
+        used for the refresh request
+    token_url : str
+        strava's token endpoint
+    path : pathname
+        location of the config file, the tokens are only kept in config if it does not exist
+
+    Returns
+    -------
+    str, bool
+        access token, True if it was refreshed
+
+    Raises
+    ------
+    requests.exceptions.HTTPError
+        refresh refused, e.g. the athlete revoked the application
+    """
+    lock_dir = os.path.dirname(path) or '.'
+    with _lock, (file_lock(path + '.lock') if os.path.isdir(lock_dir) else contextlib.nullcontext()):
+        stored = read_tokens(config, path)
+        if stored is not None:
+            config.update(stored)
+        if config['access_token'] != '' and config['expires_at'] - time.time() > REFRESH_MARGIN:
+            return config['access_token'], False
+        config.update(refresh_tokens(config, session, token_url))
+        save_tokens(config, path)
+        return config['access_token'], True
+
+
+def merge_tokens(config, path=CONFIG_PATH):
+    """Takes the tokens from the config file if another process has refreshed them since config was read,
+    so writing config back does not restore a refresh token which has been replaced
+
+    Parameters
+    ----------
+    config : dict
+        config variables (see read_json())
+    path : pathname
+        location of the config file
+
+    Returns
+    -------
+    dict
+        config
+    """
+    stored = read_tokens(config, path)
+    if stored is not None:
+        config.update(stored)
+    return config
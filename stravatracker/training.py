@@ -0,0 +1,290 @@
+""" Defines the training load model, the fitness (CTL), fatigue (ATL) and form (TSB) of each day
+The load of each day is kept in training_load and updated for the days changed by each update, like agg_daily.
+The exponentially weighted series are kept in training_daily, so each run only advances them from the earliest changed day
+to today, starting from the stored fitness and fatigue of the day before.
+
+Contains the following functions:
+    connect()
+    training_model()
+        rules_hash() - imported
+    training_current()
+    update_training()
+        write_loads()
+            daily_loads()
+                excel_clean() - imported
+    rebuild_training()
+        write_loads()
+    advance_training()
+    load_training()
+    training_table()
+"""
+import datetime as dt
+
+import numpy as np
+import pandas as pd
+
+from .store import STORE_PATH, connect as store_connect
+from .analysis import excel_clean, rules_hash
+from .aggregates import activity_days
+
+__author__ = "rakeshrgill"
+__email__ = "rakeshrgill@gmail.com"
+
+# Time constants in days of the fitness and fatigue averages
+CTL_DAYS = 42
+ATL_DAYS = 7
+# Intensity of activities without the metric of config['load_metric'], and of every activity for 'duration'
+DEFAULT_INTENSITY = 0.75
+LOAD_METRICS = ['duration', 'heartrate', 'power']
+
+
+def connect(path=STORE_PATH):
+    """Opens the store, creating the training tables if needed"""
+    conn = store_connect(path)
+    conn.execute("CREATE TABLE IF NOT EXISTS training_load (day TEXT PRIMARY KEY, load REAL)")
+    conn.execute("CREATE TABLE IF NOT EXISTS training_daily (day TEXT PRIMARY KEY, load REAL, ctl REAL, atl REAL)")
+    conn.execute("CREATE TABLE IF NOT EXISTS training_meta (key TEXT PRIMARY KEY, value TEXT)")
+    return conn
+
+
+def training_model(config):
+    """Returns the settings the loads depend on as a string, loads are recomputed when it changes.
+    The activity rules are part of it, as they choose the time and metrics of each activity (see daily_loads())
+
+    Parameters
+    ----------
+    config : dict
+        config variables (see read_json())
+
+    Returns
+    -------
+    str
+    """
+    if config['load_metric'] not in LOAD_METRICS:
+        raise ValueError("load_metric must be one of {}".format(LOAD_METRICS))
+    return '{}:{}:{}:{}'.format(config['load_metric'], config['ftp'], config['threshold_hr'], rules_hash())
+
+
+def training_current(config, path=STORE_PATH):
+    """Returns True if the loads have been computed with the current settings"""
+    conn = connect(path)
+    try:
+        row = conn.execute("SELECT value FROM training_meta WHERE key = 'model'").fetchone()
+    finally:
+        conn.close()
+    return row is not None and row[0] == training_model(config)
+
+
+def daily_loads(df, config):
+    """Returns the training load of each day, the sum over its activities of hours * intensity^2 * 100.
+    Intensity is average power over config['ftp'] or average heart rate over config['threshold_hr'],
+    following config['load_metric'], and DEFAULT_INTENSITY when the activity or the settings lack them
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        contains activities downloaded from strava, with segments dropped (see get_new_activities())
+    config : dict
+        config variables (see read_json())
+
+    Returns
+    -------
+    pandas.Series
+        load indexed by 'YYYY-MM-DD' day
+    """
+    # Time and metrics follow the rules of each activity type
+    excel_df = excel_clean(df)
+    hours = excel_df['excel_time'].to_numpy(dtype='float64') * 24
+    intensity = np.full(len(hours), DEFAULT_INTENSITY)
+    if config['load_metric'] in ('heartrate', 'power') and config['threshold_hr'] > 0:
+        heartrate = excel_df['average_heartrate'].to_numpy(dtype='float64')
+        intensity = np.where(np.isnan(heartrate), intensity, heartrate / config['threshold_hr'])
+    if config['load_metric'] == 'power' and config['ftp'] > 0:
+        # Power is preferred, heart rate covers the activities without it
+        watts = excel_df['average_watts'].to_numpy(dtype='float64')
+        intensity = np.where(np.isnan(watts), intensity, watts / config['ftp'])
+    load = pd.Series(np.nan_to_num(hours) * intensity ** 2 * 100, index=df.index)
+    days = activity_days(df)
+    return load.loc[days.index].groupby(days.to_numpy()).sum()
+
+
+def write_loads(conn, df, config, day_ls):
+    """Replaces the loads of the days in day_ls and marks the series as changed from the earliest of them
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        see connect()
+    df : pandas.DataFrame
+        contains at least every activity on the days in day_ls
+    config : dict
+        config variables (see read_json())
+    day_ls : list
+        'YYYY-MM-DD' days to recompute
+    """
+    day_set = set(day_ls)
+    load_series = None
+    if df is not None and df.shape[0] > 0:
+        days = activity_days(df)
+        day_df = df.loc[days.index[days.isin(day_set)]]
+        if day_df.shape[0] > 0:
+            load_series = daily_loads(day_df, config)
+    row = conn.execute("SELECT value FROM training_meta WHERE key = 'changed_from'").fetchone()
+    changed_from = min(day_set | ({row[0]} if row is not None else set()))
+    with conn:
+        conn.executemany("DELETE FROM training_load WHERE day = ?", [(day,) for day in day_set])
+        if load_series is not None:
+            conn.executemany("INSERT INTO training_load (day, load) VALUES (?, ?)", [(day, float(load)) for day, load in load_series.items()])
+        conn.execute("INSERT OR REPLACE INTO training_meta (key, value) VALUES ('changed_from', ?)", (changed_from,))
+
+
+def update_training(new_df, previous, changed_id_list, deleted_id_list, config, path=STORE_PATH):
+    """Updates the loads of the days changed by an update (see update_aggregates()).
+    The fitness series is advanced by advance_training(), loads computed with other settings are rebuilt
+
+    Parameters
+    ----------
+    new_df : pandas.DataFrame
+        activities after the update
+    previous : pandas.DataFrame or None
+        activities before the update
+    changed_id_list : list
+        ids written to the store
+    deleted_id_list : list
+        ids removed from the store
+    config : dict
+        config variables (see read_json())
+    path : pathname
+        location of the SQLite database
+    """
+    if not training_current(config, path):
+        rebuild_training(new_df, config, path)
+        return
+    day_set = set()
+    if changed_id_list != []:
+        day_set.update(activity_days(new_df[new_df['id'].isin(changed_id_list)]))
+    if previous is not None and previous.shape[0] > 0:
+        # An edit can move an activity to another day
+        day_set.update(activity_days(previous[previous['id'].isin(changed_id_list + deleted_id_list)]))
+    if day_set == set():
+        return
+    conn = connect(path)
+    try:
+        write_loads(conn, new_df, config, list(day_set))
+    finally:
+        conn.close()
+
+
+def rebuild_training(df, config, path=STORE_PATH):
+    """Recomputes every load from df, the series is then recomputed in full by advance_training()
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        contains activities downloaded from strava, with segments dropped (see get_new_activities())
+    config : dict
+        config variables (see read_json())
+    path : pathname
+        location of the SQLite database
+    """
+    conn = connect(path)
+    try:
+        with conn:
+            conn.execute("DELETE FROM training_load")
+            conn.execute("DELETE FROM training_daily")
+            conn.execute("DELETE FROM training_meta")
+        if df is not None and df.shape[0] > 0:
+            write_loads(conn, df, config, activity_days(df).unique().tolist())
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO training_meta (key, value) VALUES ('model', ?)", (training_model(config),))
+    finally:
+        conn.close()
+
+
+def advance_training(today=None, path=STORE_PATH):
+    """Extends the fitness and fatigue series to today, recomputing from the earliest day whose load has changed.
+    Each average continues from its value on the day before, so only the new days are computed
+
+    Parameters
+    ----------
+    today : datetime.date or None
+        last day of the series, None for the current date
+    path : pathname
+        location of the SQLite database
+
+    Returns
+    -------
+    int
+        number of days computed
+    """
+    if today is None:
+        today = dt.date.today()
+    conn = connect(path)
+    try:
+        row = conn.execute("SELECT value FROM training_meta WHERE key = 'changed_from'").fetchone()
+        last = conn.execute("SELECT MAX(day) FROM training_daily").fetchone()[0]
+        start_ls = [] if row is None else [row[0]]
+        if last is not None:
+            start_ls.append((dt.date.fromisoformat(last) + dt.timedelta(days=1)).isoformat())
+        if start_ls == []:
+            return 0
+        start = min(start_ls)
+        if start > today.isoformat():
+            return 0
+        state = conn.execute("SELECT ctl, atl FROM training_daily WHERE day < ? ORDER BY day DESC LIMIT 1", (start,)).fetchone()
+        day_index = pd.date_range(start, today, freq='D')
+        load_df = pd.read_sql_query("SELECT day, load FROM training_load WHERE day >= ?", conn, params=(start,))
+        load = load_df.set_index(pd.to_datetime(load_df['day']))['load'].reindex(day_index, fill_value=0.0)
+        # Seeding the average with the state of the day before continues it exactly
+        ctl_prev, atl_prev = state if state is not None else (0.0, 0.0)
+        ctl = pd.concat([pd.Series([ctl_prev]), pd.Series(load.to_numpy())]).ewm(alpha=1 / CTL_DAYS, adjust=False).mean().to_numpy()[1:]
+        atl = pd.concat([pd.Series([atl_prev]), pd.Series(load.to_numpy())]).ewm(alpha=1 / ATL_DAYS, adjust=False).mean().to_numpy()[1:]
+        with conn:
+            conn.execute("DELETE FROM training_daily WHERE day >= ?", (start,))
+            conn.executemany("INSERT INTO training_daily (day, load, ctl, atl) VALUES (?, ?, ?, ?)",
+                             zip(day_index.strftime('%Y-%m-%d'), load.to_numpy().tolist(), ctl.tolist(), atl.tolist()))
+            # The series starts with the first load, days before it are left when the first activity is deleted or moved later
+            conn.execute("DELETE FROM training_daily WHERE day < (SELECT MIN(day) FROM training_load)")
+            conn.execute("DELETE FROM training_meta WHERE key = 'changed_from'")
+    finally:
+        conn.close()
+    return len(day_index)
+
+
+def load_training(path=STORE_PATH):
+    """Returns the training series
+
+    Parameters
+    ----------
+    path : pathname
+        location of the SQLite database
+
+    Returns
+    -------
+    pandas.DataFrame
+        load, ctl (fitness), atl (fatigue) and tsb (form, fitness minus fatigue) indexed by day
+    """
+    conn = connect(path)
+    try:
+        training_df = pd.read_sql_query("SELECT day, load, ctl, atl FROM training_daily ORDER BY day", conn)
+    finally:
+        conn.close()
+    training_df = training_df.set_index(pd.to_datetime(training_df['day']).rename('start_date_local')).drop(columns='day')
+    training_df['tsb'] = training_df['ctl'] - training_df['atl']
+    return training_df
+
+
+def training_table(training_df):
+    """Returns the weekly training table, the total load of each week and the fitness, fatigue and form at its end
+
+    Parameters
+    ----------
+    training_df : pandas.DataFrame
+        see load_training()
+
+    Returns
+    -------
+    pandas.DataFrame
+    """
+    table = training_df.resample('W').agg({'load': 'sum', 'ctl': 'last', 'atl': 'last', 'tsb': 'last'})
+    return table.round(1)
@@ -1,37 +1,108 @@
 """ Defines functions to update the strava database file
 Contains the following classes:
-TimeoutFifteen(Exception)
-TimeoutDaily(Exception)
+TimeoutFifteen(Exception) - imported
+TimeoutDaily(Exception) - imported
+QuotaSpent(TimeoutFifteen) - imported
+FetchQueue - imported
 
 Contains the following functions:
     check_last_timeout()
     strava_update()
+        merge_activities()
+            normalize_chunk()
+            merge_frames()
+        backfill_id_list()
+        restore_cached()
         request_headers()
+            access_token() - imported
         create_id_list()
+            is_full_sync_due()
             return_json()
+            activity_priority() - imported
+            FetchQueue.push() - imported
+            list_fingerprints()
+                fingerprint() - imported
+            list_changes()
+                normalize_chunk()
+                fingerprint() - imported
+        forget_activities()
         get_new_activities()
-            return_json()
+            fetch_all()
+                return_json()
+            strip_activity()
+            normalize_chunk()
+                compact_dtypes() - imported
+            merge_frames()
+        stream_id_list()
+        get_streams()
+            fetch_all()
+    rebuild_activities()
+    create_session()
 """
+import os
 import datetime as dt
+import time
 import urllib3
+import itertools
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 import requests
-import pandas as pd
+
+from .ratelimit import RateLimiter, TimeoutFifteen, TimeoutDaily, QuotaSpent, seconds_until_reset
+from .journal import append_journal, read_journal
+from .rawcache import RawCache
+from .tokens import access_token
+from .fetchqueue import FetchQueue, QUEUE_PATH, activity_priority
+from . import metrics
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 __author__ = "rakeshrgill"
 __email__ = "rakeshrgill@gmail.com"
 
+# Base urls, overridden by the benchmarks to point at a local mock server
+API_URL = 'https://www.strava.com/api/v3'
+TOKEN_URL = 'https://www.strava.com/oauth/token'
+
+# Paces every request made by return_json() against the application's rate limits
+rate_limiter = RateLimiter()
+# Seconds to wait before retrying a 429 which did not spend a window
+RETRY_DELAY = 1
+# 429 responses retried for one request before the update stops, e.g. a proxy or an endpoint limit the headers do not show
+MAX_THROTTLE_RETRIES = 3
+# Number of requests fetch_all() keeps in flight
+MAX_WORKERS = 8
+# Columns the analysis needs which strava leaves out of some activities
+NULLABLE_COLUMNS = ['calories', 'average_watts', 'average_heartrate']
+# Nested arrays of the detailed payload, only kept in the raw cache
+HEAVY_FIELDS = ['segment_efforts', 'splits_metric', 'splits_standard', 'laps', 'best_efforts']
+# Activities normalized at a time, bounds the memory used by json_normalize
+NORMALIZE_CHUNK = 500
+# Days before the cursor listed again by an incremental update, activities are usually edited soon after they are uploaded
+EDIT_LOOKBACK_DAYS = 7
+
+
+def create_session(pool_size=MAX_WORKERS):
+    """Creates a requests session which keeps connections alive between requests
 
-class TimeoutFifteen(Exception):
-    """Used to indicate a 15 minute timeout has occured"""
-    pass
+    Parameters
+    ----------
+    pool_size : int
+        connections kept open per host, should be at least the number of concurrent workers
+
+    Returns
+    -------
+    requests.Session
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
 
 
-class TimeoutDaily(Exception):
-    """Used to indicate a daily timeout has occured"""
-    pass
+# Shared by every request so TLS connections are reused
+session = create_session()
 
 
 def check_last_timeout(config):
@@ -54,21 +125,33 @@ def check_last_timeout(config):
     timeout_15min = dt.datetime.strptime(config['last_timeout_15min'], '%Y_%m_%d_%H%M')
     # Check Daily
     if utc_time.year == timeout_daily.year and utc_time.month == timeout_daily.month and utc_time.day == timeout_daily.day:
-        print("Please wait for {} hours and {} minutes before updating again".format(23 - utc_time.hour, 60 - utc_time.minute))
+        wait = seconds_until_reset("daily", utc_time)
+        print("Please wait for {:.0f} hours and {:.0f} minutes before updating again".format(wait // 3600, (wait % 3600) // 60))
         return False
     else:
         pass
     # Check 15 Min
     if utc_time.year == timeout_15min.year and utc_time.month == timeout_15min.month and utc_time.day == timeout_15min.day and utc_time.hour == timeout_15min.hour and (timeout_15min.minute // 15) == (utc_time.minute // 15):
-        print("Please wait for {} minutes before updating again".format(15 - (utc_time.minute % 15)))
+        wait = seconds_until_reset("15min", utc_time)
+        print("Please wait for {:.0f} minutes and {:.0f} seconds before updating again".format(wait // 60, wait % 60))
         return False
     else:
         pass
     return True
 
 
-def strava_update(config, df):
+def strava_update(config, df, stage='all'):
     """Calls request_headers(), create_id_list() and get_new_activities()
+    Activities left in the journal by an interrupted update are merged into df first, so they are not requested again.
+    When config['fetch_streams'] is True, the streams of activities without them are fetched last (see get_streams()).
+    Otherwise the listed activities are queued (see FetchQueue) and fetched newest first, the types in config['fetch_types']
+    before the others, with the activities a timeout left in the queue by earlier updates.
+    When config['ingest_mode'] is 'summary', new activities are added straight from the activity list and their details
+    are backfilled with whatever is left of the current 15 minute budget, oldest summaries last.
+    Activities edited on strava are fetched again like new ones, and activities deleted on strava are dropped from df
+    (see forget_activities()), so the store and aggregates follow them when df is saved.
+    stage splits the update for the scheduler of several athletes (see Scheduler): 'new' only lists and fetches new activities,
+    'backfill' skips the listing and only completes summaries and fetches streams, 'all' does both.
     Handles errors and timeouts. Updates:
         config['last_timeout_daily']
         config['last_timeout_15min'
@@ -80,16 +163,33 @@ def strava_update(config, df):
         config variables (see read_json())
     df : pandas.DataFrame
         contains activities downloaded from strava, with segments dropped (see get_new_activities())
+    stage : str
+        'all', 'new' or 'backfill'
 
     Returns
     -------
     config, df
         dict, pandas.Dataframe
     """
+    # Recover activities fetched by an update which did not finish
+    json_obj_ls = read_journal()
+    if json_obj_ls != []:
+        print("Recovered {} activities from the journal".format(len(json_obj_ls)))
+        df = merge_activities(df, json_obj_ls)
+    queue = FetchQueue()
     # Attempt to get headers and id
     try:
         headers = request_headers(config)
-        id_list, config = create_id_list(headers, config, df)
+        if stage == 'backfill':
+            id_list, summary_ls = [], []
+        else:
+            with metrics.stage('create_id_list') as record:
+                id_list, config, summary_ls, edited_id_list, deleted_id_list = create_id_list(headers, config, df, queue)
+                record['rows'] = len(id_list)
+            if edited_id_list != [] or deleted_id_list != []:
+                df = forget_activities(df, edited_id_list, deleted_id_list, config)
+    except QuotaSpent:
+        print("Activity List cannot be fetched with the share of the rate limit left.")
     except TimeoutDaily:
         config['last_timeout_daily'] = dt.datetime.utcnow().strftime('%Y_%m_%d_%H%M')
         print("Activity List cannot be fetched.")
@@ -101,18 +201,54 @@ def strava_update(config, df):
         print("Headers cannot be fetched.")
     else:
         # no errors, let's try to update
+        if config['ingest_mode'] == 'summary':
+            if summary_ls != []:
+                with RawCache() as cache:
+                    for json_obj in summary_ls:
+                        cache.put(json_obj)
+                        append_journal(json_obj)
+                df = merge_activities(df, summary_ls)
+                config['last_update'] = dt.datetime.today().strftime("%Y_%m_%d_%H%M")
+                config['first_run'] = False
+                print("Added {} activities from the activity list".format(len(summary_ls)))
+            # Lazy detail backfill, limited to the budget left in this window
+            id_list = [] if stage == 'new' else backfill_id_list(df)[:rate_limiter.remaining()[0]]
+        else:
+            # The queue holds the activities listed now and those left by earlier updates, in the order they are fetched
+            id_list = [] if stage == 'backfill' else queue.ids()
+            if stage != 'new':
+                # Summaries left by the summary mode are completed after the new activities
+                new_ids = set(id_list)
+                id_list = id_list + [num for num in backfill_id_list(df) if num not in new_ids]
+        # Only activities never seen before use the network
+        df, fetch_id_list = restore_cached(df, id_list)
+        if len(fetch_id_list) < len(id_list):
+            queue.done(list(set(id_list) - set(fetch_id_list)))
+        id_list = fetch_id_list
         if id_list != []:
-            config, df = get_new_activities(headers, config, df, id_list)
+            with metrics.stage('get_new_activities') as record:
+                config, df = get_new_activities(headers, config, df, id_list, queue)
+                record['rows'] = len(id_list)
             # config and df are updated by function regardless
         else:
             print("No new activities")
+            config['remaining_updates'] = False
+        if config['ingest_mode'] == 'summary':
+            config['remaining_updates'] = backfill_id_list(df) != []
+        # Streams are only fetched once every activity is up to date
+        if stage != 'new' and config['fetch_streams'] and not config['remaining_updates'] and df is not None:
+            with metrics.stage('get_streams') as record:
+                stream_ids = stream_id_list(df)
+                config = get_streams(headers, config, stream_ids)
+                record['rows'] = len(stream_ids)
     finally:
+        queue.close()
         # always return config and df
         return config, df
 
 
 def request_headers(config):
-    """Requests and formats header for future API requests
+    """Formats the header for future API requests, with the cached access token or a refreshed one (see access_token())
 
     Parameters
     ---------
@@ -120,39 +256,36 @@ def request_headers(config):
         config['client_id']
         config['client_secret']
         config['refresh_token']
+        config['access_token']
+        config['expires_at']
 
     Returns
     ---------
     dict
         headers to be used to get data
     """
-    # Initialise Variables
-    payload = {
-        'client_id': config['client_id'],
-        'client_secret': config['client_secret'],
-        'refresh_token': config['refresh_token'],
-        'grant_type': 'refresh_token',
-        'f': 'json'
-    }
-    url = 'https://www.strava.com/oauth/token'
-    # Obtain Token for API
-    print("Requesting Token...\n")
-    response = requests.post(url, data=payload, verify=False)
     try:
-        response.raise_for_status()
+        token, refreshed = access_token(config, session, TOKEN_URL)
     except requests.exceptions.HTTPError:
         # Whoops it wasn't a 200
         print("Error in request_headers occured")
         raise
+    if refreshed:
+        print("Access token refreshed, valid until {}\n".format(dt.datetime.fromtimestamp(config['expires_at']).strftime('%Y_%m_%d_%H%M')))
     else:
-        access_token = response.json()['access_token']
-        print("Access Token = {}\n".format(access_token))
-        headers = {'Authorization': 'Bearer ' + access_token}
-        return headers
+        print("Using cached access token\n")
+    headers = {'Authorization': 'Bearer ' + token}
+    return headers
 
 
-def create_id_list(headers, config, df):
+def create_id_list(headers, config, df, queue=None):
     """Fetches list of ids to update
+    Runs incrementally when possible, only listing activities which started after config['after_cursor'], less EDIT_LOOKBACK_DAYS.
+    A full listing is used on the first run, when activities from a previous update are still missing,
+    and every config['full_sync_days'] days to pick up activities uploaded late and find deleted ones.
+    Listed activities which are already in df are compared with it (see list_changes()), so activities edited on strava are updated.
+    In detail mode the ids to fetch are pushed onto queue as each page arrives, so a listing cut short keeps the pages it read.
+    They are ordered by activity_priority() with config['fetch_types']
 
     Parameters
     ----------
@@ -162,21 +295,41 @@ def create_id_list(headers, config, df):
         config variables (see read_json())
     df : pandas.DataFrame
         contains activities downloaded from strava, with segments dropped (see get_new_activities())
+    queue : FetchQueue or None
+        queue of activities to fetch (see FetchQueue)
 
     Returns
     -------
-    list, dict
-        id_list, config
+    list, dict, list, list, list
+        id_list (new and edited), config, summary_ls (activity list entries of the ids in id_list, empty unless config['ingest_mode'] is 'summary'),
+        edited_id_list, deleted_id_list (only found by a full listing)
+        config['after_cursor']
+        config['last_full_sync']
     """
-    # Extract all activities from atheletes profile
-    print("Requesting id list from Strava")
-    url = 'https://www.strava.com/api/v3/athlete/activities'
+    full_sync = is_full_sync_due(config, df)
+    # Extract activities from atheletes profile
+    after = max(config['after_cursor'] - EDIT_LOOKBACK_DAYS * 86400, 0)
+    if full_sync:
+        print("Requesting full id list from Strava")
+    else:
+        print("Requesting id list from Strava for activities after {}".format(dt.datetime.utcfromtimestamp(after).strftime('%Y-%m-%d %H:%M')))
+    url = API_URL + '/athlete/activities'
+    per_page = 200
     page = 1
-    json_obj_ls = []
-    json_obj = 'blank'
-    while json_obj != []:
+    # Each page is reduced to what is needed as it arrives, only summaries of new and edited activities are kept, and only in summary mode
+    known_ids = set() if df is None else set(df['id'])
+    stored_fp = None
+    listed_id_list = []
+    id_list = []
+    edited_id_list = []
+    summary_ls = []
+    latest_start = ''
+    more_pages = True
+    while more_pages:
         try:
-            params = {'per_page': 200, 'page': page}
+            params = {'per_page': per_page, 'page': page}
+            if not full_sync:
+                params['after'] = after
             json_obj = return_json(url, headers, params)
         except TimeoutDaily:
             print("Error in create_id_list occured.")
@@ -185,33 +338,165 @@ def create_id_list(headers, config, df):
             print("Error in create_id_list occured.")
             raise
         else:
-            json_obj_ls.extend(json_obj)
+            known_ls = []
+            fetch_ls = []
+            for activity in json_obj:
+                listed_id_list.append(activity['id'])
+                # ISO 8601 dates in UTC sort as strings
+                latest_start = max(latest_start, activity['start_date'])
+                if activity['id'] not in known_ids:
+                    fetch_ls.append(activity)
+                else:
+                    known_ls.append(activity)
+            if known_ls != []:
+                if stored_fp is None:
+                    stored_fp = list_fingerprints(df)
+                edited_ls = list_changes(known_ls, stored_fp)
+                edited_id_list += [activity['id'] for activity in edited_ls]
+                fetch_ls += edited_ls
+            id_list += [activity['id'] for activity in fetch_ls]
+            if config['ingest_mode'] == 'summary':
+                summary_ls += fetch_ls
+            elif queue is not None and fetch_ls != []:
+                queue.push([activity['id'] for activity in fetch_ls], [activity_priority(activity, config['fetch_types']) for activity in fetch_ls])
             print("page number: {}".format(page))
             page += 1
-    print("total pages: {}".format(page))
-    # Convert the list of json into a pandas dataframe
-    df_allactivities = pd.json_normalize(json_obj_ls)
-    df_allactivities = df_allactivities.set_index('id')
+            # A short page is the last one
+            more_pages = len(json_obj) == per_page
+    print("total pages: {}".format(page - 1))
+    if listed_id_list == []:
+        if full_sync:
+            config['last_full_sync'] = dt.datetime.utcnow().strftime('%Y_%m_%d_%H%M')
+        return [], config, [], [], []
+    # Move the high-water mark to the latest activity listed
+    latest = dt.datetime.strptime(latest_start, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=dt.timezone.utc)
+    config['after_cursor'] = max(config['after_cursor'], int(latest.timestamp()))
     # Compare list of activities with saved activities to create list of activities to update
-    if config['first_run'] is False:
-        id_list = df_allactivities[~df_allactivities.index.isin(df['id'])].index.to_list()
-        print("Activites to update: {}".format(len(id_list)))
-        strava_id = df_allactivities.index.to_list()
-        database_id = df['id'].to_list()
-        extra_id_list = list(set(database_id) - set(strava_id))
-        if len(extra_id_list) > 0:
-            print("There are activities on local which do not exists in strava")
-            print(extra_id_list)
-        else:
-            print("All activities on local exist on strava")
-    else:
-        id_list = df_allactivities .index.to_list()
-    return id_list, config
+    deleted_id_list = []
+    if df is not None:
+        print("Activites to update: {} ({} edited on strava)".format(len(id_list), len(edited_id_list)))
+        if full_sync:
+            # Only a full listing shows which activities no longer exist on strava
+            deleted_id_list = list(known_ids - set(listed_id_list))
+            if len(deleted_id_list) > 0:
+                print("{} activities were deleted on strava and will be removed".format(len(deleted_id_list)))
+            else:
+                print("All activities on local exist on strava")
+    if full_sync:
+        config['last_full_sync'] = dt.datetime.utcnow().strftime('%Y_%m_%d_%H%M')
+    return id_list, config, summary_ls, edited_id_list, deleted_id_list
+
+
+def forget_activities(df, edited_id_list, deleted_id_list, config):
+    """Drops the cached payloads of activities edited on strava, so they are fetched again instead of restored,
+    and removes activities deleted on strava from df and the caches. The streams of deleted activities are dropped,
+    as are those of edited ones when config['fetch_streams'] is True so they are fetched again
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        contains activities downloaded from strava, with segments dropped (see get_new_activities())
+    edited_id_list : list
+        see create_id_list()
+    deleted_id_list : list
+        see create_id_list()
+    config : dict
+        config variables (see read_json())
+
+    Returns
+    -------
+    pandas.DataFrame
+        df without the deleted activities
+    """
+    from .streams import StreamStore, STREAMS_PATH
+
+    with RawCache() as cache:
+        cache.discard(edited_id_list + deleted_id_list)
+    if os.path.exists(STREAMS_PATH):
+        with StreamStore() as stream_store:
+            stream_store.remove((edited_id_list if config['fetch_streams'] else []) + deleted_id_list)
+    if deleted_id_list != []:
+        df = df[~df['id'].isin(deleted_id_list)].reset_index(drop=True)
+        print("Removed {} activities deleted on strava".format(len(deleted_id_list)))
+    return df
 
 
-def get_new_activities(headers, config, df, id_list):
+def list_fingerprints(df):
+    """Returns the fingerprint of the activity list fields of every activity in df (see fingerprint())
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        contains activities downloaded from strava, with segments dropped (see get_new_activities())
+
+    Returns
+    -------
+    dict
+        id: fingerprint
+    """
+    from .store import fingerprint, LIST_FINGERPRINT_NUMERIC, LIST_FINGERPRINT_TEXT
+
+    return dict(zip(df['id'].to_list(), fingerprint(df, LIST_FINGERPRINT_NUMERIC, LIST_FINGERPRINT_TEXT).tolist()))
+
+
+def list_changes(json_obj_ls, stored_fp):
+    """Returns the activity list entries whose fields differ from the stored activity, i.e. activities edited on strava.
+    The entries are normalized like fetched activities so both sides are compared with the same types
+
+    Parameters
+    ----------
+    json_obj_ls : list
+        activity list entries of activities already in df
+    stored_fp : dict
+        see list_fingerprints()
+
+    Returns
+    -------
+    list
+        edited entries
+    """
+    from .store import fingerprint, LIST_FINGERPRINT_NUMERIC, LIST_FINGERPRINT_TEXT
+
+    fields = ['id'] + LIST_FINGERPRINT_NUMERIC + LIST_FINGERPRINT_TEXT
+    listed_df = normalize_chunk([{key: json_obj[key] for key in fields if key in json_obj} for json_obj in json_obj_ls])
+    listed_fp = fingerprint(listed_df, LIST_FINGERPRINT_NUMERIC, LIST_FINGERPRINT_TEXT).tolist()
+    return [json_obj for json_obj, fp in zip(json_obj_ls, listed_fp) if stored_fp.get(json_obj['id']) != fp]
+
+
+def is_full_sync_due(config, df):
+    """Checks if create_id_list() should list every activity instead of only the ones after config['after_cursor']
+
+    Parameters
+    ----------
+    config : dict
+        config variables (see read_json())
+        config['after_cursor']
+        config['last_full_sync']
+        config['full_sync_days']
+        config['remaining_updates']
+        config['ingest_mode']
+    df : pandas.DataFrame
+        contains activities downloaded from strava, with segments dropped (see get_new_activities())
+
+    Returns
+    -------
+    bool
+        True if a full listing is needed
+    """
+    if df is None or config['after_cursor'] == 0:
+        return True
+    # Activities missed by an update from before the fetch queue may be older than the cursor, later ones are in the queue.
+    # In summary mode every listed activity is already in df, the remaining updates are only details
+    if config['remaining_updates'] is True and config['ingest_mode'] != 'summary' and not os.path.exists(QUEUE_PATH):
+        return True
+    last_full_sync = dt.datetime.strptime(config['last_full_sync'], '%Y_%m_%d_%H%M')
+    return dt.datetime.utcnow() - last_full_sync >= dt.timedelta(days=config['full_sync_days'])
+
+
+def get_new_activities(headers, config, df, id_list, queue=None):
     """Pulls data from strava based on id_list, updates df and config.
     Config and df must always be updated by the function.
+    Fetched activities are removed from queue, failed ones have their attempts counted and activities not found are removed
     Preconditions: Takes in non empty id_list
 
     Parameters
@@ -224,6 +509,8 @@ def get_new_activities(headers, config, df, id_list):
         Per format in function
     id_list : list
         see create_id_list()
+    queue : FetchQueue or None
+        queue holding the ids (see FetchQueue)
 
     Returns
     -------
@@ -235,49 +522,75 @@ def get_new_activities(headers, config, df, id_list):
         config['last_timeout_daily']
 
     """
-    activity_url = 'https://www.strava.com/api/v3/activities'
-    urls = []
+    activity_url = API_URL + '/activities'
+    url_ids = {}
     for num in id_list:
         activityid = str(num)
-        urls.append(activity_url + '/' + activityid)
+        url_ids[activity_url + '/' + activityid] = num
+    urls = list(url_ids)
     params = None
-    json_obj_ls = []
+    fetched_id_list = []
+    # Fetched ids are removed from the queue a chunk at a time, ids left in it after a crash are restored from the raw cache
+    done_id_list = []
+    # Activities are normalized in chunks as they arrive, without their nested arrays
+    chunk_ls = []
+    frame_ls = []
     # Update database
     print("Fetching new activities")
-    for url in urls:
-        # Update till a timeout occurs
-        try:
-            json_obj = return_json(url, headers, params)
-        except TimeoutDaily:
-            print("Timeout in get_new_activities occured(TimeoutDaily)")
-            config['last_timeout_daily'] = dt.datetime.utcnow().strftime('%Y_%m_%d_%H%M')
-            break
-        except TimeoutFifteen:
-            print("Timeout in get_new_activities occured(Timeout15)")
-            config['last_timeout_15min'] = dt.datetime.utcnow().strftime('%Y_%m_%d_%H%M')
-            break
+    cache = RawCache()
+
+    def on_error(url, error):
+        if queue is None:
+            return
+        if error.response is not None and error.response.status_code == 404:
+            # Deleted since it was listed
+            queue.done([url_ids[url]])
         else:
-            # if there is no error
-            json_obj_ls.append(json_obj)
+            queue.failed(url_ids[url], error)
+
+    # Update till a timeout occurs
+    try:
+        for url, json_obj in fetch_all(urls, headers, params, on_error=on_error):
+            # Written to disk straight away so the request is not wasted if the program stops
+            cache.put(json_obj)
+            json_obj = strip_activity(json_obj)
+            append_journal(json_obj)
+            fetched_id_list.append(json_obj['id'])
+            done_id_list.append(url_ids[url])
+            chunk_ls.append(json_obj)
+            if len(chunk_ls) == NORMALIZE_CHUNK:
+                frame_ls.append(normalize_chunk(chunk_ls))
+                chunk_ls = []
+                if queue is not None:
+                    queue.done(done_id_list)
+                    done_id_list = []
+    except QuotaSpent:
+        print("Share of the rate limit used in get_new_activities")
+    except TimeoutDaily:
+        print("Timeout in get_new_activities occured(TimeoutDaily)")
+        config['last_timeout_daily'] = dt.datetime.utcnow().strftime('%Y_%m_%d_%H%M')
+    except TimeoutFifteen:
+        print("Timeout in get_new_activities occured(Timeout15)")
+        config['last_timeout_15min'] = dt.datetime.utcnow().strftime('%Y_%m_%d_%H%M')
+    except KeyboardInterrupt:
+        # Keep what has been fetched so far, the rest is picked up by the next update
+        print("Update interrupted")
+    finally:
+        cache.close()
+        if queue is not None:
+            queue.done(done_id_list)
     config['last_update'] = dt.datetime.today().strftime("%Y_%m_%d_%H%M")
     config['first_run'] = False
-    if json_obj_ls == []:
+    if chunk_ls != []:
+        frame_ls.append(normalize_chunk(chunk_ls))
+    if fetched_id_list == []:
         # nothing happened, do not update the df file
         print("No updates fetched from id_list")
         return config, df
     else:
-        df_newactivities = pd.json_normalize(json_obj_ls)
-    # Combine with old df
-    if config['first_run'] is True:
-        df = df_newactivities
-    else:
-        df = pd.concat([df, df_newactivities], ignore_index=True)
-    # Sort and format
-    df.sort_values('id', ascending=False, inplace=True)
-    df = df.reset_index().drop(columns=['index', 'segment_efforts'])
+        df = merge_frames(df, frame_ls)
     # Check for remaining updates
-    new_id_list = df['id'].to_list()
-    remainder_id_list = list(set(id_list) - set(new_id_list))
+    remainder_id_list = list(set(id_list) - set(fetched_id_list))
     if remainder_id_list != []:
         config['remaining_updates'] = True
     else:
@@ -286,8 +599,308 @@ def get_new_activities(headers, config, df, id_list):
     return config, df
 
 
+def strip_activity(json_obj):
+    """Returns a copy of an activity without the nested arrays in HEAVY_FIELDS, the raw cache keeps the full payload"""
+    return {key: value for key, value in json_obj.items() if key not in HEAVY_FIELDS}
+
+
+def normalize_chunk(json_obj_ls):
+    """Flattens a chunk of activities into a compact dataframe (see compact_dtypes())
+
+    Parameters
+    ----------
+    json_obj_ls : list
+        at most NORMALIZE_CHUNK activities as returned by strava
+
+    Returns
+    -------
+    pandas.DataFrame
+    """
+    import pandas as pd
+
+    from .store import compact_dtypes
+
+    return compact_dtypes(pd.json_normalize([strip_activity(json_obj) for json_obj in json_obj_ls]))
+
+
+def stream_id_list(df):
+    """Returns the ids of activities whose streams have not been stored, newest first
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        contains activities downloaded from strava, with segments dropped (see get_new_activities())
+
+    Returns
+    -------
+    list
+    """
+    from .streams import StreamStore
+
+    with StreamStore() as stream_store:
+        stored_ids = stream_store.ids()
+    return [num for num in df['id'].sort_values(ascending=False).to_list() if num not in stored_ids]
+
+
+def get_streams(headers, config, id_list):
+    """Fetches the streams of the activities in id_list into the stream store (see StreamStore).
+    Shares the rate limiting of get_new_activities(), stops at a timeout and leaves the rest for the next update
+
+    Parameters
+    ----------
+    headers : dict
+        see request_headers()
+    config : dict
+        config variables (see read_json())
+    id_list : list
+        see stream_id_list()
+
+    Returns
+    -------
+    dict
+        config['last_timeout_15min']
+        config['last_timeout_daily']
+    """
+    from .streams import StreamStore, STREAM_KEYS
+
+    if id_list == []:
+        return config
+    url_ids = {API_URL + '/activities/{}/streams'.format(num): num for num in id_list}
+    params = {'keys': ','.join(STREAM_KEYS), 'key_by_type': 'true'}
+    print("Fetching streams of {} activities".format(len(id_list)))
+    stream_store = StreamStore()
+    fetched = 0
+
+    def on_error(url, error):
+        # Activities without streams, e.g. manual entries, are stored empty so they are not requested again
+        if error.response is not None and error.response.status_code == 404:
+            stream_store.put(url_ids[url], {})
+
+    try:
+        for url, json_obj in fetch_all(list(url_ids), headers, params, on_error=on_error):
+            stream_store.put(url_ids[url], json_obj)
+            fetched += 1
+    except QuotaSpent:
+        print("Share of the rate limit used in get_streams")
+    except TimeoutDaily:
+        print("Timeout in get_streams occured(TimeoutDaily)")
+        config['last_timeout_daily'] = dt.datetime.utcnow().strftime('%Y_%m_%d_%H%M')
+    except TimeoutFifteen:
+        print("Timeout in get_streams occured(Timeout15)")
+        config['last_timeout_15min'] = dt.datetime.utcnow().strftime('%Y_%m_%d_%H%M')
+    except KeyboardInterrupt:
+        print("Update interrupted")
+    finally:
+        stream_store.close()
+    print("Streams stored for {} activities".format(fetched))
+    return config
+
+
+def merge_activities(df, json_obj_ls):
+    """Normalizes activities fetched from strava and combines them with df.
+    Activities already in df are replaced by the fetched version
+
+    Parameters
+    ----------
+    df : pandas.DataFrame or None
+        contains activities downloaded from strava, with segments dropped (see get_new_activities())
+    json_obj_ls : iterable
+        activities as returned by strava, read NORMALIZE_CHUNK at a time so it may be a generator
+
+    Returns
+    -------
+    pandas.DataFrame
+        sorted by id, newest first, with segments dropped
+    """
+    frame_ls = []
+    chunk_ls = []
+    for json_obj in json_obj_ls:
+        chunk_ls.append(json_obj)
+        if len(chunk_ls) == NORMALIZE_CHUNK:
+            frame_ls.append(normalize_chunk(chunk_ls))
+            chunk_ls = []
+    if chunk_ls != []:
+        frame_ls.append(normalize_chunk(chunk_ls))
+    return merge_frames(df, frame_ls)
+
+
+def merge_frames(df, frame_ls):
+    """Combines normalized activities (see normalize_chunk()) with df, activities already in df are replaced
+
+    Parameters
+    ----------
+    df : pandas.DataFrame or None
+        contains activities downloaded from strava, with segments dropped (see get_new_activities())
+    frame_ls : list
+        of pandas.DataFrame, in the order the activities were fetched
+
+    Returns
+    -------
+    pandas.DataFrame
+        sorted by id, newest first, with segments dropped
+    """
+    import numpy as np
+    import pandas as pd
+
+    from .store import compact_dtypes
+
+    if frame_ls == []:
+        return df
+    # Combine with old df
+    df = pd.concat([df] + frame_ls, ignore_index=True)
+    df = df.drop_duplicates(subset='id', keep='last')
+    # Sort and format
+    df = df.sort_values('id', ascending=False)
+    df = df.reset_index(drop=True).drop(columns=HEAVY_FIELDS, errors='ignore')
+    # Used by the analysis but missing from summaries, or from every activity without a power meter or heart rate monitor
+    for col in NULLABLE_COLUMNS:
+        if col not in df.columns:
+            df[col] = np.nan
+    return compact_dtypes(df)
+
+
+def restore_cached(df, id_list):
+    """Merges the activities in id_list whose details are already in the raw cache into df
+
+    Parameters
+    ----------
+    df : pandas.DataFrame or None
+        contains activities downloaded from strava, with segments dropped (see get_new_activities())
+    id_list : list
+        ids to update
+
+    Returns
+    -------
+    pandas.DataFrame, list
+        df, ids which still have to be fetched
+    """
+    if id_list == []:
+        return df, id_list
+    with RawCache() as cache:
+        detailed_ids = cache.detailed_ids()
+        cached_id_list = [num for num in id_list if num in detailed_ids]
+        if cached_id_list != []:
+            df = merge_activities(df, cache.iter_latest(cached_id_list))
+            print("Restored {} activities from the raw cache".format(len(cached_id_list)))
+    return df, [num for num in id_list if num not in detailed_ids]
+
+
+def rebuild_activities(df):
+    """Normalizes every activity in the raw cache again, without using the network.
+    Activities missing from the cache are kept as they are in df
+
+    Parameters
+    ----------
+    df : pandas.DataFrame or None
+        contains activities downloaded from strava, with segments dropped (see get_new_activities())
+
+    Returns
+    -------
+    pandas.DataFrame
+        rebuilt df
+    """
+    with RawCache() as cache:
+        # Payloads are read from the cache one chunk at a time
+        new_df = merge_activities(df, cache.iter_latest())
+    print("Rebuilt {} activities from the raw cache".format(0 if new_df is None else new_df.shape[0]))
+    return new_df
+
+
+def backfill_id_list(df):
+    """Returns the ids of activities which only have their summary, newest first
+
+    Parameters
+    ----------
+    df : pandas.DataFrame or None
+        contains activities downloaded from strava, with segments dropped (see get_new_activities())
+
+    Returns
+    -------
+    list
+        ids whose details have not been fetched
+    """
+    if df is None or 'resource_state' not in df.columns:
+        return []
+    # Detailed activities have a resource_state of 3
+    return df.loc[(df['resource_state'] < 3).fillna(False), 'id'].sort_values(ascending=False).to_list()
+
+
+def fetch_all(urls, headers, params=None, workers=MAX_WORKERS, on_error=None):
+    """Fetches urls concurrently through the shared session and yields the results as they arrive.
+    Every request still goes through rate_limiter. On a timeout the queued requests are cancelled,
+    the requests in flight are finished and yielded, then the timeout is raised
+
+    Parameters
+    ----------
+    urls : iterable
+        urls to fetch
+    headers : dict
+        per requests library
+    params : dict
+        per requests library, used for every url
+    workers : int
+        number of requests in flight
+    on_error : callable or None
+        called with the url and the requests.exceptions.HTTPError of a failed request, which is otherwise only printed
+
+    Yields
+    ------
+    str, dict
+        url, json_obj
+
+    Raises
+    ------
+    TimeoutDaily
+        Daily timeout
+    TimeoutFifteen
+        Fifteen minute timeout
+    """
+    timeout = None
+    executor = ThreadPoolExecutor(max_workers=workers)
+    url_iter = iter(urls)
+    futures = {}
+    try:
+        # Only a window of requests is queued, finished results are released once yielded so memory stays bounded
+        for url in itertools.islice(url_iter, workers * 2):
+            futures[executor.submit(return_json, url, headers, params)] = url
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                url = futures.pop(future)
+                if future.cancelled():
+                    continue
+                try:
+                    json_obj = future.result()
+                except (TimeoutDaily, TimeoutFifteen) as e:
+                    # Keep the daily timeout if both occur
+                    if timeout is None or isinstance(e, TimeoutDaily):
+                        timeout = e
+                    for pending in futures:
+                        pending.cancel()
+                except requests.exceptions.HTTPError as e:
+                    # e.g. the activity was deleted after the id list was fetched
+                    print("Error fetching {}: {}".format(url, e))
+                    if on_error is not None:
+                        on_error(url, e)
+                else:
+                    yield url, json_obj
+                if timeout is None:
+                    for next_url in itertools.islice(url_iter, 1):
+                        futures[executor.submit(return_json, next_url, headers, params)] = next_url
+    finally:
+        # Also reached when the caller stops early, do not wait for the queued requests
+        for pending in futures:
+            pending.cancel()
+        executor.shutdown(wait=True)
+    if timeout is not None:
+        raise timeout
+
+
 def return_json(url, headers, params):
     """creates a request and returns json and config
+    Requests are paced by rate_limiter, which is updated from the headers of every response.
+    When a window's budget is spent the request waits for the window to reset, up to rate_limiter.max_wait.
+    A request answered with 429 is retried at most MAX_THROTTLE_RETRIES times
 
     Parameters
     ----------
@@ -308,26 +921,39 @@ def return_json(url, headers, params):
     TimeoutDaily
         Daily timeout
     TimeoutFifteen
-        Fifteen minute timeout
+        Fifteen minute timeout, or still throttled after MAX_THROTTLE_RETRIES retries
+    requests.exceptions.HTTPError
+        Error response other than a rate limit
     """
-    response = requests.get(url, headers=headers, params=params)
-    try:
-        response.raise_for_status()
-    except requests.exceptions.HTTPError as e:
-        # Whoops it wasn't a 200
-        limit_15min = int(response.headers['X-RateLimit-Limit'].split(",")[0])
-        limit_daily = int(response.headers['X-RateLimit-Limit'].split(",")[1])
-        usage_15min = int(response.headers['X-RateLimit-Usage'].split(",")[0])
-        usage_daily = int(response.headers['X-RateLimit-Usage'].split(",")[1])
-        print("Error: " + str(e))
-        # Check error and modify config last_timeout
-        if usage_daily >= limit_daily:
-            print("Daily Limit Hit")
-            raise TimeoutDaily
-        if usage_15min >= limit_15min:
-            print("15 Minute Limit Hit")
-            raise TimeoutFifteen
-    else:
-        # if there is no error
-        json_obj = response.json()
-        return json_obj
+    throttle_count = 0
+    while True:
+        rate_limiter.acquire()
+        start = time.perf_counter()
+        response = session.get(url, headers=headers, params=params)
+        latency = time.perf_counter() - start
+        # The limiter takes the headers first, so the headroom recorded is what strava reports after the request
+        if response.status_code == 429:
+            spent = rate_limiter.throttled(response.headers)
+        else:
+            rate_limiter.update(response.headers)
+        metrics.record_request(latency, response.status_code, rate_limiter.remaining())
+        try:
+            response.raise_for_status()
+        except requests.exceptions.HTTPError as e:
+            # Whoops it wasn't a 200
+            if response.status_code == 429:
+                print("Error: " + str(e))
+                throttle_count += 1
+                if throttle_count > MAX_THROTTLE_RETRIES:
+                    # Stopped like a spent window, the update resumes on the next run
+                    print("Still throttled after {} retries, stopping the update".format(MAX_THROTTLE_RETRIES))
+                    raise TimeoutFifteen from e
+                # Spent budget, acquire() waits for the reset or raises the timeout
+                if not spent:
+                    time.sleep(RETRY_DELAY)
+            else:
+                raise
+        else:
+            # if there is no error
+            json_obj = response.json()
+            return json_obj
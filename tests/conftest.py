@@ -0,0 +1,95 @@
+""" Shared fixtures of the regression tests
+Every test runs from an empty folder with a data directory, as the program does, and syncs against the offline mock
+Strava API of the benchmarks, so no network or real rate limit budget is used.
+
+    python3 -m pytest tests
+
+Contains the following functions:
+    new_config()
+        new_config() - imported
+    edited_history()
+        make_activities() - imported
+    workdir()
+    mock_strava()
+    sync()
+    force_full_sync()
+"""
+import io
+import os
+import sys
+import contextlib
+
+import pytest
+import pandas as pd
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from mock_strava import MockStrava  # noqa: E402
+from synthetic import make_activities  # noqa: E402
+from stravatracker import update, first_run, stravatracker as st  # noqa: E402
+
+__author__ = "rakeshrgill"
+__email__ = "rakeshrgill@gmail.com"
+
+
+def new_config(**fields):
+    """Returns the config of a freshly set up athlete, with fields changed"""
+    config = first_run.new_config('1', 'secret', 'refresh')
+    config.update(fields)
+    return config
+
+
+def edited_history():
+    """Returns the activities before an update, the activities after it, and the ids it changed and deleted.
+    The update adds 60 new activities, edits 6 older ones (moved to another day and type) and deletes 4"""
+    full = make_activities(400, history_days=1200, seed=1)
+    # Newest first, the first rows are the new activities
+    previous = full.iloc[60:].reset_index(drop=True)
+    new_df = full.copy()
+    edited = new_df['id'].iloc[[80, 120, 200, 250, 300, 390]].tolist()
+    rows = new_df['id'].isin(edited)
+    new_df.loc[rows, 'type'] = 'Run'
+    new_df.loc[rows, 'start_date_local'] += pd.Timedelta(days=40)
+    new_df.loc[rows, 'moving_time'] = 1800
+    deleted = new_df['id'].iloc[[70, 150, 151, 399]].tolist()
+    new_df = new_df[~new_df['id'].isin(deleted)].reset_index(drop=True)
+    changed = full['id'].iloc[:60].tolist() + edited
+    return previous, new_df, changed, deleted
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """Runs the test from an empty folder holding a data directory"""
+    monkeypatch.chdir(tmp_path)
+    os.mkdir('data')
+    return tmp_path
+
+
+@pytest.fixture
+def mock_strava(workdir, monkeypatch):
+    """Starts a mock server with 120 activities and points the update module at it, without rate limits or retry delays.
+    The test may change the athlete size and limits before syncing, see MockStrava"""
+    mock = MockStrava(num_activities=120, limit_15min=10 ** 6, limit_daily=10 ** 6).start()
+    monkeypatch.setattr(update, 'API_URL', mock.url + '/api/v3')
+    monkeypatch.setattr(update, 'TOKEN_URL', mock.url + '/oauth/token')
+    monkeypatch.setattr(update, 'rate_limiter', update.RateLimiter(max_wait=0))
+    monkeypatch.setattr(update, 'RETRY_DELAY', 0)
+    yield mock
+    mock.stop()
+
+
+def sync(config=None):
+    """Runs one sync() quietly, writing config first if given, and returns the config after it"""
+    if config is not None:
+        st.write_json(config, st.CONFIG_PATH)
+    with contextlib.redirect_stdout(io.StringIO()):
+        return st.sync()
+
+
+def force_full_sync():
+    """Makes the next sync list every activity, as it does every config['full_sync_days']"""
+    config = st.read_json(st.CONFIG_PATH)
+    config['last_full_sync'] = '2022_01_01_1200'
+    st.write_json(config, st.CONFIG_PATH)
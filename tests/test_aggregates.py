@@ -0,0 +1,78 @@
+""" Tests of the aggregate store, updated incrementally against rebuilt from scratch """
+import sqlite3
+import datetime as dt
+import types
+
+import pandas as pd
+
+from synthetic import make_activities
+from stravatracker import aggregates, store
+
+from conftest import edited_history
+
+FREQ_LS = ["Y", "M"]
+
+
+def daily_rows(path):
+    """Returns every row of agg_daily, sorted"""
+    conn = sqlite3.connect(path)
+    try:
+        return sorted(conn.execute("SELECT day, type, round(duration, 9), number_of_ex FROM agg_daily").fetchall())
+    finally:
+        conn.close()
+
+
+def assert_same_aggregates(path, reference_path):
+    assert daily_rows(path) == daily_rows(reference_path)
+    for table, reference in zip(aggregates.load_table_ls(FREQ_LS, path), aggregates.load_table_ls(FREQ_LS, reference_path)):
+        pd.testing.assert_frame_equal(table, reference)
+
+
+def test_update_matches_rebuild(workdir):
+    previous, new_df, changed, deleted = edited_history()
+    aggregates.rebuild_aggregates(previous, 'data/incremental.db')
+    aggregates.update_aggregates(new_df, previous, changed, deleted, 'data/incremental.db')
+    aggregates.rebuild_aggregates(new_df, 'data/rebuilt.db')
+    assert_same_aggregates('data/incremental.db', 'data/rebuilt.db')
+
+
+def test_incomplete_aggregates_are_rebuilt(workdir):
+    # Aggregates holding a few days without the complete mark, as left by a csv import before the mark existed
+    previous, new_df, changed, deleted = edited_history()
+    conn = aggregates.connect('data/incremental.db')
+    aggregates.write_aggregates(conn, previous, aggregates.activity_days(previous.iloc[:3]).tolist())
+    conn.close()
+    assert not aggregates.aggregates_current('data/incremental.db')
+    aggregates.update_aggregates(new_df, previous, changed, deleted, 'data/incremental.db')
+    assert aggregates.aggregates_current('data/incremental.db')
+    aggregates.rebuild_aggregates(new_df, 'data/rebuilt.db')
+    assert_same_aggregates('data/incremental.db', 'data/rebuilt.db')
+
+
+def test_migrate_csv_builds_aggregates(workdir):
+    df = make_activities(300, history_days=900, seed=2)
+    df.to_csv('data/strava_activities.csv', index=False)
+    store.migrate_csv('data/strava_activities.csv', 'data/strava.db')
+    assert aggregates.aggregates_current('data/strava.db')
+    aggregates.rebuild_aggregates(store.load_activities(store.LOAD_COLUMNS, 'data/strava.db'), 'data/rebuilt.db')
+    assert_same_aggregates('data/strava.db', 'data/rebuilt.db')
+    assert sum(row[3] for row in daily_rows('data/strava.db') if row[1] == 'All') == 300
+
+
+def test_year_to_date_without_activities(workdir, monkeypatch):
+    # On the 1st of January no activity of any year is on or before today's day of the year
+    df = make_activities(200, history_days=900, seed=3)
+    df = df[df['start_date_local'].dt.dayofyear > 1]
+    aggregates.rebuild_aggregates(df, 'data/strava.db')
+
+    class NewYear(dt.datetime):
+        @classmethod
+        def today(cls):
+            return cls(2030, 1, 1)
+
+    monkeypatch.setattr(aggregates, 'dt', types.SimpleNamespace(datetime=NewYear))
+    yearly, ytd, monthly = aggregates.load_table_ls(FREQ_LS, 'data/strava.db')
+    assert ytd.empty
+    assert ytd.index.names == yearly.index.names
+    assert list(ytd.columns) == list(yearly.columns)
+    assert not yearly.empty and not monthly.empty
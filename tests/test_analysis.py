@@ -0,0 +1,165 @@
+""" Tests of the rule-driven cleaning and the single pass tables, against the versions they replaced
+baseline_excel_clean() and baseline_create_table() are the earlier implementations, one .loc assignment per rule and one
+groupby per frequency, kept here as the reference the current ones must match.
+"""
+import json
+import types
+import sqlite3
+import datetime as dt
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from synthetic import make_activities
+from stravatracker import analysis, aggregates, training, stravatracker as st
+
+from conftest import new_config, sync
+
+FREQ_LS = ["Y", "M", "W", "Q"]
+
+
+def baseline_excel_clean(df):
+    """excel_clean() before the rules table, df is modified"""
+    strava_df = df
+    strava_df['start_date_local'] = pd.to_datetime(strava_df['start_date_local'])
+    strava_df['start_time'] = strava_df['start_date_local'].dt.time
+    strava_df['start_date_local'] = strava_df['start_date_local'].dt.date
+    strava_df['type'] = strava_df['type'].replace({'VirtualRide': 'Bike', 'Ride': 'Bike', 'WeightTraining': 'Strength', 'Workout': 'Strength'})
+    strava_df['moving_time'] = strava_df['moving_time'] / 86400
+    strava_df['elapsed_time'] = strava_df['elapsed_time'] / 86400
+    strava_df['distance'] = strava_df['distance'] / 1000
+    strava_df['average_pace_run'] = (1 / strava_df['average_speed']) * (1000 / 86400)
+    strava_df['average_pace_swim'] = ((1 / strava_df['average_speed']) * (1000 / 86400)) / 10
+    strava_df['excel_time'] = strava_df['moving_time']
+    strava_df.loc[strava_df['type'] == 'Swim', "excel_time"] = strava_df['elapsed_time']
+    strava_df.loc[(strava_df['type'] != 'Run') & (strava_df['type'] != 'Hike'), "average_pace_run"] = np.NaN
+    strava_df.loc[strava_df['type'] != 'Swim', "average_pace_swim"] = np.NaN
+    strava_df.loc[strava_df['type'] != 'Bike', "average_watts"] = np.NaN
+    strava_df.loc[strava_df['type'] == 'Swim', "average_heartrate"] = np.NaN
+    strava_df.loc[strava_df['type'] == 'Strength', "distance"] = np.NaN
+    strava_df.loc[strava_df['type'] == 'Yoga', "distance"] = np.NaN
+    strava_df.loc[strava_df['type'] == 'RockClimbing', "distance"] = np.NaN
+    key_cols = ['start_date_local', 'type', 'excel_time', 'distance', 'average_watts', 'average_pace_run', 'average_pace_swim',
+                'calories', 'average_heartrate']
+    return strava_df[key_cols]
+
+
+def baseline_create_table(df, freq_str):
+    """create_table() before the single grouped pass"""
+    grouper = pd.Grouper(key='start_date_local', freq=freq_str)
+    duration_by_type = df.groupby([grouper, 'type'])['excel_time'].sum().rename("duration")
+    num_of_ex_by_type = df.groupby([grouper, 'type'])['excel_time'].count().rename("number_of_ex")
+    days_of_ex_by_type = df.groupby([grouper, 'type'])['start_date_local'].nunique().rename("days_of_ex")
+    all_ls = []
+    for series in [df.groupby([grouper])['excel_time'].sum().rename("duration"),
+                   df.groupby([grouper])['excel_time'].count().rename("number_of_ex"),
+                   df.groupby([grouper])['start_date_local'].nunique().rename("days_of_ex")]:
+        all_df = series.to_frame()
+        all_df['type'] = 'All'
+        all_ls.append(all_df.reset_index().set_index(['start_date_local', 'type']))
+    type_df = pd.concat([duration_by_type, num_of_ex_by_type, days_of_ex_by_type], axis=1, join="outer")
+    return pd.concat([type_df, pd.concat(all_ls, axis=1, join="outer")], join='outer').sort_index()
+
+
+def assert_same_table(table, reference):
+    """Checks a table against the baseline one, which groups by the day and type of every activity"""
+    # The baseline also has a row for the periods between the first and last activity of a type without any, the single
+    # pass only keeps those for 'All'
+    reference = reference[(reference['number_of_ex'] > 0) | (reference.index.get_level_values('type') == 'All')]
+    table = table.reset_index()
+    table['type'] = table['type'].astype(str)
+    table = table.set_index(['start_date_local', 'type']).sort_index()
+    pd.testing.assert_frame_equal(table, reference)
+
+
+@pytest.fixture(scope='module')
+def activities():
+    """3000 synthetic activities over eight years, of every type of the mock athlete"""
+    return make_activities(3000, history_days=2900, seed=11)
+
+
+def test_excel_clean_matches_baseline(activities):
+    before = activities.copy()
+    excel_df = analysis.excel_clean(activities, analysis.ACTIVITY_RULES)
+    # The frame given is left as it was
+    pd.testing.assert_frame_equal(activities, before)
+    reference = baseline_excel_clean(activities.copy())
+    assert list(excel_df.columns) == list(reference.columns)
+    pd.testing.assert_frame_equal(excel_df.assign(type=excel_df['type'].astype(str)), reference.assign(type=reference['type'].astype(str)),
+                                  check_dtype=False)
+
+
+@pytest.mark.parametrize('freq_str', FREQ_LS)
+def test_tables_match_baseline(activities, freq_str):
+    pandas_df = analysis.pandas_df_converter(analysis.excel_clean(activities, analysis.ACTIVITY_RULES))
+    reference_df = analysis.pandas_df_converter(baseline_excel_clean(activities.copy()))
+    assert_same_table(analysis.create_table(pandas_df, freq_str), baseline_create_table(reference_df, freq_str))
+
+
+def test_single_pass_matches_baseline(activities):
+    pandas_df = analysis.pandas_df_converter(analysis.excel_clean(activities, analysis.ACTIVITY_RULES))
+    reference_df = analysis.pandas_df_converter(baseline_excel_clean(activities.copy()))
+    long_df = analysis.aggregate(pandas_df, FREQ_LS)
+    assert set(long_df['freq']) == set(FREQ_LS)
+    for freq_str in FREQ_LS:
+        assert_same_table(analysis.long_to_table(long_df, freq_str), baseline_create_table(reference_df, freq_str))
+
+
+def test_table_ls_uses_every_activity(activities, monkeypatch):
+    class MidYear(dt.datetime):
+        @classmethod
+        def today(cls):
+            return cls(2030, 6, 30)
+
+    monkeypatch.setattr(analysis, 'dt', types.SimpleNamespace(datetime=MidYear))
+    pandas_df = analysis.pandas_df_converter(analysis.excel_clean(activities, analysis.ACTIVITY_RULES))
+    reference_df = analysis.pandas_df_converter(baseline_excel_clean(activities.copy()))
+    ytd_df = reference_df[reference_df['start_date_local'].dt.dayofyear <= 181]
+    yearly, ytd, monthly = analysis.return_table_ls(pandas_df, ["Y", "M"])
+    assert_same_table(yearly, baseline_create_table(reference_df, "Y"))
+    assert_same_table(ytd, baseline_create_table(ytd_df, "Y"))
+    # The monthly table has every month, not only those up to today's day of the year as when it followed "Y"
+    assert_same_table(monthly, baseline_create_table(reference_df, "M"))
+    assert (monthly.index.get_level_values('start_date_local').month > 6).any()
+
+
+def test_custom_rules_change_the_hash(workdir):
+    default_hash = analysis.rules_hash()
+    assert analysis.rules_hash(analysis.ACTIVITY_RULES) == default_hash
+    with open(analysis.RULES_PATH, 'w') as jsonfile:
+        json.dump({'Hike': {'rename': 'Run'}}, jsonfile)
+    assert analysis.rules_hash() != default_hash
+    assert analysis.load_rules()['Hike'] == {'metrics': ['average_pace_run', 'average_heartrate'], 'rename': 'Run'}
+    # A rule which only repeats the defaults resolves to the same rules
+    with open(analysis.RULES_PATH, 'w') as jsonfile:
+        json.dump({'Yoga': {'distance': False, 'time': 'moving_time'}}, jsonfile)
+    assert analysis.rules_hash() == default_hash
+
+
+def stored_types(table, path='data/strava.db'):
+    """Returns the activity types in a table of the store"""
+    conn = sqlite3.connect(path)
+    try:
+        return {row[0] for row in conn.execute("SELECT DISTINCT type FROM {}".format(table))}
+    finally:
+        conn.close()
+
+
+def test_custom_rules_rebuild_the_caches(mock_strava, workdir, tmp_path):
+    config = sync(new_config())
+    df = st.load_files(config)
+    st.analysis(config, df, output_dir=str(tmp_path / 'graphs'))
+    assert 'Hike' in stored_types('agg_daily')
+    assert aggregates.aggregates_current() and training.training_current(config)
+    with open(analysis.RULES_PATH, 'w') as jsonfile:
+        json.dump({'Hike': {'rename': 'Run'}}, jsonfile)
+    assert not aggregates.aggregates_current() and not training.training_current(config)
+    st.analysis(config, df, output_dir=str(tmp_path / 'graphs'))
+    assert aggregates.aggregates_current() and training.training_current(config)
+    assert 'Hike' not in stored_types('agg_daily')
+    yearly = aggregates.load_table_ls(["Y"])[0]
+    assert 'Hike' not in set(yearly.index.get_level_values('type'))
+    # The rebuilt aggregates are those of the activities cleaned with the new rules
+    pandas_df = analysis.pandas_df_converter(analysis.excel_clean(df))
+    assert yearly.loc[(slice(None), 'Run'), 'number_of_ex'].sum() == (pandas_df['type'] == 'Run').sum()
@@ -0,0 +1,157 @@
+""" Tests of the scheduler syncing several athletes within the rate budget of one application """
+import os
+import threading
+
+import pytest
+
+from stravatracker import athletes, store, update, stravatracker as st
+from stravatracker.ratelimit import RateLimiter, QuotaLimiter
+
+from conftest import new_config
+
+
+class RecordingScheduler(athletes.Scheduler):
+    """Scheduler which records its turns, and checks no athlete is backfilled before its new activities are in
+
+    Attributes
+    ----------
+    turns : list
+        of tuple, (athlete, stage, quota, requests used)
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.turns = []
+
+    def run_turn(self, name, stage, quota):
+        assert stage != 'backfill' or 'new' not in self.pending[name]
+        used = super().run_turn(name, stage, quota)
+        self.turns.append((name, stage, quota, used))
+        return used
+
+
+def add_athletes(names, **fields):
+    """Adds athletes under the application config of the test, with config fields changed"""
+    st.write_json(new_config(), st.CONFIG_PATH)
+    for name in names:
+        config = athletes.add_athlete(name, name)
+        config.update(fields)
+        st.write_json(config, os.path.join(athletes.athlete_dir(name), st.CONFIG_PATH))
+
+
+def budget(requests):
+    """Returns an application limiter allowing requests, which raises instead of waiting for a reset"""
+    return QuotaLimiter(RateLimiter(max_wait=0), requests)
+
+
+def count_activities(name):
+    with athletes.in_folder(athletes.athlete_dir(name)):
+        return store.count_activities()
+
+
+def test_fair_share_by_requests_served(mock_strava):
+    add_athletes(['a', 'b', 'c'])
+    scheduler = RecordingScheduler(limiter=budget(90), max_wait=0)
+    scheduler.served = {'a': 40, 'b': 0, 'c': 20}
+    scheduler.run()
+    # Least served first, each with an equal share of the window
+    assert [turn[:3] for turn in scheduler.turns[:3]] == [('b', 'new', 30), ('c', 'new', 30), ('a', 'new', 30)]
+    assert scheduler.served == {'a': 70, 'b': 30, 'c': 50}
+    # Each athlete's requests were made with its own token
+    assert sorted(mock_strava.requests_by_token.values()) == [30, 30, 30]
+
+
+def test_unused_budget_is_shared_again(mock_strava):
+    add_athletes(['a', 'b', 'c'])
+    RecordingScheduler(['a'], limiter=budget(1000), max_wait=0).run()
+    assert count_activities('a') == 120
+    scheduler = RecordingScheduler(limiter=budget(90), max_wait=0)
+    scheduler.run()
+    first_pass, second_pass = scheduler.turns[:3], scheduler.turns[3:5]
+    # a is up to date and only lists, its share goes to the athletes still waiting
+    assert first_pass[0][:2] == ('a', 'new') and first_pass[0][3] == 1
+    left = 90 - sum(turn[3] for turn in first_pass)
+    assert [turn[:3] for turn in second_pass] == [('b', 'new', left // 2), ('c', 'new', left // 2)]
+    assert sum(scheduler.served.values()) == 90
+    assert 'new' not in scheduler.pending['a'] and 'new' in scheduler.pending['b']
+
+
+def test_backfill_waits_for_new_activities(mock_strava):
+    add_athletes(['a', 'b'], ingest_mode='summary')
+    scheduler = RecordingScheduler(limiter=budget(1000), max_wait=0)
+    scheduler.run()
+    stages = [turn[1] for turn in scheduler.turns]
+    assert stages == ['new', 'new', 'backfill', 'backfill']
+    assert scheduler.pending == {'a': set(), 'b': set()}
+    for name in ['a', 'b']:
+        with athletes.in_folder(athletes.athlete_dir(name)):
+            assert update.backfill_id_list(st.load()) == []
+
+
+def test_backfill_not_started_while_an_athlete_lists(mock_strava):
+    add_athletes(['a'], ingest_mode='summary')
+    add_athletes(['b'])
+    scheduler = RecordingScheduler(limiter=budget(100), max_wait=0)
+    scheduler.run()
+    # a's summaries are in after one request, b's details use the rest of the budget before any backfill
+    assert scheduler.turns[0][:2] == ('a', 'new') and scheduler.turns[0][3] == 1
+    assert all(turn[1] == 'new' for turn in scheduler.turns)
+    assert scheduler.served == {'a': 1, 'b': 99}
+    assert scheduler.pending['a'] == {'backfill'}
+
+
+def test_starved_listing_doubles_the_next_share(mock_strava):
+    # 720 activities are listed over 4 pages, more than a share of 2 requests
+    mock_strava.add_activities(600)
+    add_athletes(['a', 'b', 'c'])
+    scheduler = RecordingScheduler(limiter=budget(6), max_wait=0)
+    scheduler.run_round()
+    assert [turn[2:] for turn in scheduler.turns] == [(2, 2)] * 3
+    assert scheduler.boost == {'a': 2, 'b': 2, 'c': 2}
+    assert count_activities('a') == 0
+    scheduler.limiter = budget(60)
+    scheduler.run_round()
+    assert scheduler.turns[3][:3] == ('a', 'new', 40)
+    # A turn which saved activities resets the boost
+    assert count_activities('a') == 36
+    assert scheduler.boost['a'] == 1
+
+
+def test_nested_athlete_folders_are_refused(workdir):
+    os.makedirs('athletes/a')
+    os.makedirs('athletes/b')
+    with athletes.in_folder('athletes/a'):
+        with pytest.raises(RuntimeError):
+            with athletes.in_folder('athletes/b'):
+                pass
+        assert os.getcwd() == str(workdir / 'athletes' / 'a')
+        errors = []
+
+        def other_thread():
+            try:
+                with athletes.in_folder('athletes/b'):
+                    pass
+            except RuntimeError as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=other_thread)
+        thread.start()
+        thread.join()
+        assert len(errors) == 1
+    assert os.getcwd() == str(workdir)
+    # Released once the block ends
+    with athletes.in_folder('athletes/b'):
+        assert os.getcwd() == str(workdir / 'athletes' / 'b')
+
+
+def test_overlapping_schedulers_are_refused(mock_strava):
+    add_athletes(['a'])
+
+    class NestedScheduler(athletes.Scheduler):
+        def run_turn(self, name, stage, quota):
+            return athletes.Scheduler([name], limiter=self.limiter, max_wait=0).run()
+
+    with pytest.raises(RuntimeError):
+        NestedScheduler(limiter=budget(10), max_wait=0).run()
+    # Released once the scheduler stops, the next one may run
+    assert athletes.Scheduler(limiter=budget(10), max_wait=0).run() == {'a': 10}
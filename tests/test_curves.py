@@ -0,0 +1,129 @@
+""" Tests of the best effort curves, against a brute force search and against bests merged from scratch """
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from mock_strava import FIRST_ID
+from stravatracker import curves, store
+from stravatracker.streams import StreamStore
+
+from conftest import new_config, sync, force_full_sync
+
+
+def brute_per_second(time, values, max_gap):
+    """Holds each sample second by second until the next one, for at most max_gap seconds"""
+    held = []
+    for second in range(int(time[-1] - time[0]) + 1):
+        last = max(i for i in range(len(time)) if time[i] - time[0] <= second)
+        held.append(0.0 if second - (time[last] - time[0]) >= max_gap else float(values[last]))
+    return np.array(held)
+
+
+def brute_best(series, duration):
+    """Highest mean over every window of duration seconds"""
+    return max(sum(series[start:start + duration]) / duration for start in range(len(series) - duration + 1))
+
+
+def test_best_means_match_brute_force():
+    rng = np.random.default_rng(4)
+    # Recorded every 1 to 3 seconds, with two pauses longer than MAX_GAP
+    steps = rng.integers(1, 4, size=300)
+    steps[[80, 200]] = [25, 40]
+    time = np.concatenate([[5], 5 + np.cumsum(steps)]).astype('int32')
+    watts = rng.integers(0, 600, size=len(time)).astype('int16')
+    series = curves.per_second(time, watts)
+    np.testing.assert_array_equal(series, brute_per_second(time, watts, curves.MAX_GAP))
+    durations = [1, 5, 30, 60, 300, 10 ** 5]
+    best = curves.best_means(np.concatenate([[0.0], np.cumsum(series)]), durations)
+    # Durations longer than the activity are left out
+    assert sorted(best) == [1, 5, 30, 60, 300]
+    for duration, value in best.items():
+        assert abs(value - brute_best(series, duration)) < 1e-9
+
+
+def test_activity_curve_speed():
+    time = np.array([0, 1, 2, 4, 8, 9, 10], dtype='int32')
+    distance = np.array([0, 3, 6, 12, np.nan, 27, 30], dtype='float32')
+    curve = curves.activity_curve({'time': time, 'distance': distance}, durations=[1, 2, 5, 10])
+    # Distance is interpolated every second, the missing sample holds the distance reached
+    per_second = np.interp(np.arange(11), time, [0, 3, 6, 12, 12, 27, 30])
+    for duration in [1, 2, 5, 10]:
+        expected = max((per_second[start + duration] - per_second[start]) / duration for start in range(11 - duration))
+        assert abs(curve['speed'][duration] - expected) < 1e-6
+    assert 'watts' not in curve
+
+
+def best_rows(path='data/strava.db'):
+    """Returns every best as {(type, season, metric, duration): value}"""
+    conn = sqlite3.connect(path)
+    try:
+        return {row[:4]: row[4] for row in conn.execute("SELECT type, season, metric, duration, value FROM curve_best")}
+    finally:
+        conn.close()
+
+
+def expected_best_rows(path='data/strava.db'):
+    """Returns the bests found from the activity curves and the activities in the store, see best_rows()"""
+    conn = sqlite3.connect(path)
+    try:
+        long_df = pd.read_sql_query("SELECT a.type, substr(a.start_date_local, 1, 4) AS season, c.metric, c.duration, c.value "
+                                    "FROM curve_activity c JOIN activities a ON a.id = c.id", conn)
+    finally:
+        conn.close()
+    rows = {}
+    for season_df in [long_df, long_df.assign(season='All')]:
+        rows.update(season_df.groupby(['type', 'season', 'metric', 'duration'])['value'].max().to_dict())
+    return rows
+
+
+def sync_streams(mock_strava, num_activities):
+    """Syncs num_activities activities with their streams and computes their curves"""
+    mock_strava.num_activities = num_activities
+    sync(new_config(fetch_streams=True))
+    assert curves.update_curves() == num_activities
+    assert best_rows() == expected_best_rows()
+
+
+def test_new_activities_are_merged(mock_strava):
+    sync_streams(mock_strava, 30)
+    mock_strava.add_activities(10)
+    sync()
+    assert curves.update_curves() == 10
+    assert best_rows() == expected_best_rows()
+
+
+def test_deleted_activity_leaves_the_bests(mock_strava):
+    sync_streams(mock_strava, 30)
+    conn = sqlite3.connect('data/strava.db')
+    best_id = conn.execute("SELECT id FROM curve_best WHERE season = 'All' AND metric = 'watts' ORDER BY value DESC").fetchone()[0]
+    conn.close()
+    mock_strava.delete_activity(best_id - FIRST_ID)
+    force_full_sync()
+    sync()
+    conn = sqlite3.connect('data/strava.db')
+    try:
+        assert conn.execute("SELECT COUNT(*) FROM curve_best WHERE id = ?", (best_id,)).fetchone()[0] == 0
+        assert conn.execute("SELECT COUNT(*) FROM curve_activity WHERE id = ?", (best_id,)).fetchone()[0] == 0
+        assert conn.execute("SELECT COUNT(*) FROM curve_done WHERE id = ?", (best_id,)).fetchone()[0] == 0
+    finally:
+        conn.close()
+    assert best_rows() == expected_best_rows()
+    # Nothing is left to compute for the other activities
+    assert curves.update_curves() == 0
+    assert store.count_activities() == 29
+    # Compacting the streams moves the later activities, whose curves are computed again to the same bests
+    before = best_rows()
+    with StreamStore() as stream_store:
+        stream_store.compact()
+    assert curves.update_curves() > 0
+    assert best_rows() == before
+
+
+def test_edited_type_moves_its_efforts(mock_strava):
+    sync_streams(mock_strava, 30)
+    ride = store.load_activities().query("type == 'Ride'")['id'].iloc[0]
+    mock_strava.edit_activity(int(ride) - FIRST_ID, type='VirtualRide')
+    force_full_sync()
+    sync()
+    assert best_rows() == expected_best_rows()
@@ -0,0 +1,116 @@
+""" Tests of the concurrent fetch of activity details over the pooled session """
+import threading
+import time
+
+import pytest
+import requests
+
+from mock_strava import FIRST_ID
+from stravatracker import update
+from stravatracker.ratelimit import TimeoutFifteen, TimeoutDaily
+
+
+class FakeRequests:
+    """Stands in for return_json(), answering each url after a delay and recording the requests in flight
+
+    Parameters
+    ----------
+    errors : dict
+        url: exception raised instead of answering
+    delay : float
+        seconds each request takes
+    """
+
+    def __init__(self, errors=None, delay=0.01):
+        self.errors = {} if errors is None else errors
+        self.delay = delay
+        self.requested = []
+        self.in_flight = 0
+        self.most_in_flight = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, url, headers, params):
+        with self._lock:
+            self.requested.append(url)
+            self.in_flight += 1
+            self.most_in_flight = max(self.most_in_flight, self.in_flight)
+        try:
+            time.sleep(self.delay)
+            if url in self.errors:
+                raise self.errors[url]
+            return {'url': url}
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+
+def counted(urls, pulled):
+    """Yields urls, counting in pulled[0] how many have been taken"""
+    for url in urls:
+        pulled[0] += 1
+        yield url
+
+
+def test_every_url_is_fetched_once(monkeypatch):
+    fake = FakeRequests()
+    monkeypatch.setattr(update, 'return_json', fake)
+    urls = ['url{}'.format(number) for number in range(50)]
+    results = list(update.fetch_all(urls, {}, workers=4))
+    assert sorted(url for url, json_obj in results) == sorted(urls)
+    assert all(json_obj == {'url': url} for url, json_obj in results)
+    assert sorted(fake.requested) == sorted(urls)
+    assert 1 < fake.most_in_flight <= 4
+
+
+def test_one_worker_keeps_the_order(monkeypatch):
+    monkeypatch.setattr(update, 'return_json', FakeRequests(delay=0))
+    urls = ['url{}'.format(number) for number in range(20)]
+    assert [url for url, json_obj in update.fetch_all(urls, {}, workers=1)] == urls
+
+
+def test_only_a_window_of_urls_is_queued(monkeypatch):
+    monkeypatch.setattr(update, 'return_json', FakeRequests())
+    pulled = [0]
+    results = update.fetch_all(counted(['url{}'.format(number) for number in range(100)], pulled), {}, workers=3)
+    next(results)
+    assert pulled[0] <= 3 * 2 + 1
+    # Stopping early does not request the rest
+    results.close()
+    assert pulled[0] < 100
+
+
+def test_timeout_stops_after_the_requests_in_flight(monkeypatch):
+    fake = FakeRequests(errors={'url10': TimeoutFifteen()})
+    monkeypatch.setattr(update, 'return_json', fake)
+    urls = ['url{}'.format(number) for number in range(100)]
+    received = []
+    with pytest.raises(TimeoutFifteen):
+        for url, json_obj in update.fetch_all(urls, {}, workers=4):
+            received.append(url)
+    # Everything requested except the failed url was yielded, and nothing queued after the timeout was requested
+    assert sorted(received) == sorted(url for url in fake.requested if url != 'url10')
+    assert len(fake.requested) < 10 + 4 * 2 + 1
+
+
+def test_daily_timeout_wins_over_fifteen(monkeypatch):
+    monkeypatch.setattr(update, 'return_json', FakeRequests(errors={'url0': TimeoutFifteen(), 'url1': TimeoutDaily()}, delay=0.05))
+    with pytest.raises(TimeoutDaily):
+        list(update.fetch_all(['url{}'.format(number) for number in range(10)], {}, workers=2))
+
+
+def test_http_errors_are_passed_on_and_skipped(monkeypatch):
+    error = requests.exceptions.HTTPError('404 Client Error')
+    monkeypatch.setattr(update, 'return_json', FakeRequests(errors={'url3': error, 'url7': error}))
+    failed = []
+    results = list(update.fetch_all(['url{}'.format(number) for number in range(10)], {}, workers=4,
+                                    on_error=lambda url, e: failed.append((url, e))))
+    assert len(results) == 8
+    assert sorted(failed, key=lambda item: item[0]) == [('url3', error), ('url7', error)]
+
+
+def test_details_fetched_from_the_mock(mock_strava):
+    urls = [update.API_URL + '/activities/{}'.format(FIRST_ID + number) for number in range(40)]
+    results = dict(update.fetch_all(urls, {'Authorization': 'Bearer test'}))
+    assert sorted(results) == sorted(urls)
+    assert all(results[url]['id'] == int(url.rsplit('/', 1)[1]) for url in urls)
+    assert mock_strava.requests_served['detail'] == 40
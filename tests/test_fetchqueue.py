@@ -0,0 +1,88 @@
+""" Tests of the persistent fetch queue and of resuming an interrupted fetch from it """
+from mock_strava import FIRST_ID
+from stravatracker import update, store
+from stravatracker.ratelimit import QuotaLimiter
+from stravatracker.fetchqueue import FetchQueue, MAX_ATTEMPTS, activity_priority
+
+from conftest import new_config, sync
+
+
+def test_queue_order_and_failures(workdir):
+    with FetchQueue() as queue:
+        queue.push([1, 2, 3], [100.0, 300.0, 200.0])
+        assert queue.ids() == [2, 3, 1]
+        assert queue.ids(limit=2) == [2, 3]
+        for _ in range(MAX_ATTEMPTS):
+            queue.failed(2, 'HTTP 500')
+        # Left out once it has failed MAX_ATTEMPTS times, kept for inspection
+        assert queue.ids() == [3, 1]
+        assert queue.failures() == {2: 'HTTP 500'}
+        # Pushed again, an activity keeps its attempts
+        queue.push([2], [400.0])
+        assert queue.ids() == [3, 1]
+        queue.done([3])
+        assert len(queue) == 1
+    # The queue survives the process
+    with FetchQueue() as queue:
+        assert queue.ids() == [1]
+
+
+def sync_with_quota(mock, quota):
+    """Runs one sync allowed quota requests, returns the config after it and the list and detail requests it made"""
+    before = dict(mock.requests_served)
+    update.rate_limiter = QuotaLimiter(update.RateLimiter(max_wait=0), quota)
+    config = sync()
+    return config, {key: mock.requests_served[key] - before[key] for key in ('list', 'detail')}
+
+
+def test_interrupted_fetch_resumes_from_queue(mock_strava, workdir):
+    mock_strava.add_activities(330)
+    update.rate_limiter = QuotaLimiter(update.RateLimiter(max_wait=0), 100)
+    config = sync(new_config())
+    assert config['remaining_updates'] is True
+    with FetchQueue() as queue:
+        queued = queue.ids()
+    stored = store.count_activities()
+    assert queued != [] and stored + len(queued) == 450
+    # The queue is fetched newest first
+    assert store.load_activities()['id'].min() > max(queued)
+    # An activity deleted on strava while queued is dropped, not retried
+    mock_strava.delete_activity(queued[0] - FIRST_ID)
+    runs = 0
+    while config['remaining_updates']:
+        config, requests = sync_with_quota(mock_strava, 100)
+        # Resumed without listing the activities again
+        assert requests['list'] <= 1
+        runs += 1
+        assert runs < 10
+    assert store.count_activities() == 449
+    with FetchQueue() as queue:
+        assert len(queue) == 0 and queue.failures() == {}
+    # Every detail was fetched once, plus the deleted activity's 404
+    assert mock_strava.requests_served['detail'] == 450
+
+
+def test_priority_by_type():
+    run = {'start_date': '2020-01-01T08:00:00Z', 'type': 'Run'}
+    newer_ride = {'start_date': '2023-01-01T08:00:00Z', 'type': 'Ride'}
+    newest_swim = {'start_date': '2024-01-01T08:00:00Z', 'type': 'Swim'}
+    # Newest first by default
+    assert activity_priority(newest_swim) > activity_priority(newer_ride) > activity_priority(run)
+    # Listed types first in their order, then the others
+    fetch_types = ['Run', 'Ride']
+    assert activity_priority(run, fetch_types) > activity_priority(newer_ride, fetch_types) > activity_priority(newest_swim, fetch_types)
+    assert activity_priority(newest_swim, fetch_types) == activity_priority(newest_swim)
+
+
+def test_listed_types_are_fetched_first(mock_strava, workdir):
+    mock_strava.add_activities(180)
+    update.rate_limiter = QuotaLimiter(update.RateLimiter(max_wait=0), 60)
+    sync(new_config(fetch_types=['Swim']))
+    with FetchQueue() as queue:
+        queued = queue.ids()
+    listed = {FIRST_ID + number: mock_strava.summary(number)['type'] for number in range(300)}
+    swims = [num for num, activity_type in listed.items() if activity_type == 'Swim']
+    # The budget ran out after every swim was fetched, the other activities wait in the queue
+    assert queued != [] and 0 < len(swims) < 50
+    assert (store.load_activities()['type'] == 'Swim').sum() == len(swims)
+    assert not any(listed[num] == 'Swim' for num in queued)
@@ -0,0 +1,90 @@
+""" Tests of the journal replayed after a sync is interrupted before the store is written """
+import os
+import json
+
+import pytest
+
+from mock_strava import FIRST_ID
+from stravatracker import journal, store, rawcache
+
+from conftest import new_config, sync
+
+
+def interrupted_sync(monkeypatch, config=None):
+    """Runs a sync which stops as the activities are written to the store, as a crash would"""
+    def crash(*args, **kwargs):
+        raise KeyboardInterrupt
+
+    with monkeypatch.context() as patch:
+        patch.setattr(store, 'save_activities', crash)
+        with pytest.raises(KeyboardInterrupt):
+            sync(config)
+
+
+def test_interrupted_sync_replays_the_journal(mock_strava, workdir, monkeypatch):
+    interrupted_sync(monkeypatch, new_config())
+    assert store.count_activities() == 0
+    assert len(journal.read_journal()) == 120
+    details = mock_strava.requests_served['detail']
+    sync()
+    assert store.count_activities() == 120
+    # Replayed, not requested again, and cleared once the store is written
+    assert mock_strava.requests_served['detail'] == details
+    assert not os.path.exists(journal.JOURNAL_PATH)
+
+
+def test_journal_replay_does_not_need_the_raw_cache(mock_strava, workdir, monkeypatch):
+    interrupted_sync(monkeypatch, new_config())
+    os.remove(rawcache.CACHE_PATH)
+    details = mock_strava.requests_served['detail']
+    sync()
+    assert store.count_activities() == 120
+    assert mock_strava.requests_served['detail'] == details
+
+
+def test_truncated_last_line_is_skipped(mock_strava, workdir, monkeypatch):
+    interrupted_sync(monkeypatch, new_config())
+    # The process died while writing the last entry
+    with open(journal.JOURNAL_PATH, 'rb+') as journalfile:
+        journalfile.truncate(os.path.getsize(journal.JOURNAL_PATH) - 40)
+    json_obj_ls = journal.read_journal()
+    assert len(json_obj_ls) == 119
+    # The next entry starts on its own line
+    journal.append_journal({'id': 1})
+    assert journal.read_journal() == json_obj_ls + [{'id': 1}]
+    journal.clear_journal([1])
+    sync()
+    assert store.count_activities() == 120
+    assert not os.path.exists(journal.JOURNAL_PATH)
+
+
+def test_clear_journal_keeps_unsaved_activities(workdir):
+    for number in range(5):
+        journal.append_journal({'id': FIRST_ID + number, 'name': 'Activity {}'.format(number)})
+    journal.clear_journal([FIRST_ID + 1, FIRST_ID + 3])
+    assert [json_obj['id'] for json_obj in journal.read_journal()] == [FIRST_ID, FIRST_ID + 2, FIRST_ID + 4]
+    assert not os.path.exists(journal.JOURNAL_PATH + '.tmp')
+
+
+def test_clear_journal_is_atomic(workdir, monkeypatch):
+    for number in range(5):
+        journal.append_journal({'id': FIRST_ID + number})
+    with open(journal.JOURNAL_PATH, 'rb') as journalfile:
+        before = journalfile.read()
+    dumps = json.dumps
+    written = []
+
+    def failing_dumps(obj, **kwargs):
+        # Fails part way through the rewrite
+        if len(written) == 2:
+            raise OSError("No space left on device")
+        written.append(obj)
+        return dumps(obj, **kwargs)
+
+    with monkeypatch.context() as patch:
+        patch.setattr(journal.json, 'dumps', failing_dumps)
+        with pytest.raises(OSError):
+            journal.clear_journal([FIRST_ID])
+    # The journal is as it was, not half rewritten
+    with open(journal.JOURNAL_PATH, 'rb') as journalfile:
+        assert journalfile.read() == before
@@ -0,0 +1,139 @@
+""" Tests of the run instrumentation, the records written for each run and the one run opened by each entry point """
+import io
+import json
+import threading
+import contextlib
+
+import pytest
+
+from stravatracker import metrics, stravatracker as st
+
+from conftest import new_config, sync
+
+
+def read_runs(path=metrics.METRICS_PATH):
+    """Returns every run written to the JSON lines file"""
+    with open(path, 'r') as metricsfile:
+        return [json.loads(line) for line in metricsfile]
+
+
+def prometheus_lines(path=metrics.PROM_PATH):
+    """Returns the sample lines of the Prometheus text file"""
+    with open(path, 'r') as promfile:
+        return [line.rstrip('\n') for line in promfile if not line.startswith('#')]
+
+
+def test_run_record(workdir):
+    with metrics.run('sync'):
+        with metrics.stage('outer') as record:
+            record['rows'] = 12
+            metrics.record_request(0.25, 200, (90, 900))
+            with metrics.stage('inner'):
+                metrics.record_request(0.5, 429, (80, 890))
+        metrics.record_request(0.125, 200)
+    record, = read_runs()
+    assert record['run'] == 'sync' and record['failed'] == 0 and record['error'] is None
+    assert record['requests'] == 3 and record['throttled'] == 1
+    assert record['request_seconds'] == 0.875 and record['max_request_seconds'] == 0.5
+    assert record['status'] == {'200': 2, '429': 1}
+    assert record['remaining_15min'] == 80 and record['min_remaining_15min'] == 80
+    outer, inner = record['stages']
+    assert (outer['stage'], outer['parent'], outer['rows'], outer['requests']) == ('outer', None, 12, 2)
+    assert (inner['stage'], inner['parent'], inner['requests'], inner['throttled']) == ('inner', 'outer', 1, 1)
+    assert all('_start' not in stage_record for stage_record in record['stages'])
+    # Stages outside a run are not recorded
+    with metrics.stage('alone') as record:
+        assert record == {}
+    assert len(read_runs()) == 1
+
+
+def test_failed_run_is_recorded(workdir):
+    with pytest.raises(KeyError):
+        with metrics.run('analysis'):
+            with metrics.stage('excel_clean'):
+                raise KeyError('type')
+    record, = read_runs()
+    assert record['failed'] == 1 and record['error'] == 'KeyError'
+    assert record['stages'][0]['seconds'] >= 0
+    assert 'stravatracker_run_failed{run="analysis"} 1' in prometheus_lines()
+
+
+def test_prometheus_keeps_other_runs(workdir):
+    with metrics.run('sync'):
+        with metrics.stage('strava_update'):
+            metrics.record_request(0.1, 200, (50, 500))
+    with metrics.run('analysis'):
+        with metrics.stage('excel_clean') as record:
+            record['rows'] = 7
+    with metrics.run('sync'):
+        with metrics.stage('save_activities'):
+            pass
+    lines = prometheus_lines()
+    # The second sync replaces the samples of the first, the analysis is kept
+    assert 'stravatracker_stage_rows{run="analysis",stage="excel_clean"} 7' in lines
+    assert not any('stage="strava_update"' in line for line in lines)
+    assert not any(line.startswith('stravatracker_ratelimit_remaining') for line in lines)
+    assert sum(line.startswith('stravatracker_run_seconds{') for line in lines) == 2
+    assert any(line.startswith('stravatracker_stage_seconds{run="sync",stage="save_activities"}') for line in lines)
+    with open(metrics.PROM_PATH, 'r') as promfile:
+        text = promfile.read()
+    # Every metric has one HELP and TYPE header
+    assert text.count('# TYPE stravatracker_run_seconds gauge') == 1
+    assert [run['run'] for run in read_runs()] == ['sync', 'analysis', 'sync']
+
+
+def test_nested_run_is_part_of_the_outer_run(workdir):
+    with metrics.run('sync') as outer:
+        with metrics.run('analysis') as inner:
+            assert inner is outer
+            with metrics.stage('excel_clean'):
+                pass
+    record, = read_runs()
+    assert record['run'] == 'sync'
+    assert [stage_record['stage'] for stage_record in record['stages']] == ['excel_clean']
+
+
+def test_run_from_another_thread_raises(workdir):
+    errors = []
+
+    def other_run():
+        try:
+            with metrics.run('analysis'):
+                pass
+        except RuntimeError as e:
+            errors.append(e)
+
+    with metrics.run('sync'):
+        thread = threading.Thread(target=other_run)
+        thread.start()
+        thread.join()
+        # Requests of other threads are counted against the open run
+        thread = threading.Thread(target=metrics.record_request, args=(0.1, 200))
+        thread.start()
+        thread.join()
+    assert len(errors) == 1
+    record, = read_runs()
+    assert record['run'] == 'sync' and record['requests'] == 1
+
+
+def test_sync_writes_one_run(mock_strava, workdir):
+    sync(new_config())
+    mock_strava.add_activities(5)
+    sync()
+    # The second sync loads the activities stored by the first
+    runs = read_runs()
+    assert [run['run'] for run in runs] == ['sync', 'sync']
+    record = runs[1]
+    stages = [stage_record['stage'] for stage_record in record['stages']]
+    assert stages[:2] == ['load_files', 'strava_update'] and 'save_activities' in stages
+    assert record['requests'] > 0 and record['requests'] == sum(stage_record['requests'] for stage_record in record['stages'] if stage_record['parent'] is None)
+
+
+def test_analyze_writes_one_run(mock_strava, workdir, tmp_path):
+    sync(new_config())
+    with contextlib.redirect_stdout(io.StringIO()):
+        st.analyze(output_dir=str(tmp_path / 'graphs'))
+    runs = read_runs()
+    assert [run['run'] for run in runs] == ['sync', 'analysis']
+    stages = [stage_record['stage'] for stage_record in runs[1]['stages']]
+    assert stages[:2] == ['load_files', 'excel_clean'] and 'save_graphs' in stages
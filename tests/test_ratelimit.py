@@ -0,0 +1,92 @@
+""" Tests of the rate limit scheduler and of how an update stops when the budget is spent """
+import pytest
+
+from stravatracker import ratelimit, update
+from stravatracker.ratelimit import RateLimiter, QuotaLimiter, TimeoutFifteen, TimeoutDaily, QuotaSpent
+
+from conftest import new_config, sync
+
+
+def rate_headers(limit, usage):
+    """Returns strava's rate limit headers for (15 minute, daily) limit and usage"""
+    return {'X-RateLimit-Limit': '{},{}'.format(*limit), 'X-RateLimit-Usage': '{},{}'.format(*usage)}
+
+
+def test_acquire_waits_for_the_15min_reset(monkeypatch):
+    limiter = RateLimiter(limit_15min=2, limit_daily=100, max_wait=16 * 60)
+    waits = []
+
+    def fake_sleep(seconds):
+        waits.append(seconds)
+        # The window resets while sleeping
+        limiter.usage_15min = 0
+
+    monkeypatch.setattr(ratelimit.time, 'sleep', fake_sleep)
+    monkeypatch.setattr(ratelimit, 'seconds_until_reset', lambda window, now=None: 300.0)
+    for _ in range(3):
+        limiter.acquire()
+    assert waits == [300.0 + ratelimit.RESET_MARGIN]
+    assert limiter.usage_daily == 3
+
+
+def test_acquire_raises_when_reset_is_too_far():
+    limiter = RateLimiter(limit_15min=1, limit_daily=100, max_wait=0)
+    limiter.acquire()
+    with pytest.raises(TimeoutFifteen):
+        limiter.acquire()
+    daily = RateLimiter(limit_15min=100, limit_daily=1, max_wait=0)
+    daily.acquire()
+    with pytest.raises(TimeoutDaily):
+        daily.acquire()
+
+
+def test_update_corrects_limits_and_usage_from_headers():
+    limiter = RateLimiter()
+    limiter.update(rate_headers((600, 30000), (42, 1000)))
+    assert (limiter.limit_15min, limiter.limit_daily) == (600, 30000)
+    assert limiter.remaining() == (558, 29000)
+    # Local usage counts requests still in flight and is never lowered
+    limiter.update(rate_headers((600, 30000), (10, 10)))
+    assert limiter.remaining() == (558, 29000)
+
+
+def test_throttled_tells_spent_windows_from_transient_429():
+    limiter = RateLimiter(max_wait=0)
+    assert limiter.throttled(rate_headers((100, 1000), (50, 50))) is False
+    assert limiter.throttled(rate_headers((100, 1000), (100, 150))) is True
+    with pytest.raises(TimeoutFifteen):
+        limiter.acquire()
+    assert limiter.throttled(rate_headers((100, 1000), (20, 1000))) is True
+    with pytest.raises(TimeoutDaily):
+        limiter.acquire()
+
+
+def test_quota_limiter_refuses_after_its_share():
+    shared = RateLimiter(limit_15min=100, limit_daily=1000)
+    share = QuotaLimiter(shared, 2)
+    share.acquire()
+    share.acquire()
+    with pytest.raises(QuotaSpent):
+        share.acquire()
+    assert share.used == 2 and share.refused
+    assert shared.remaining() == (98, 998)
+
+
+def test_sync_stops_at_the_15min_limit(mock_strava):
+    mock_strava.limit_15min = 40
+    config = sync(new_config())
+    served = mock_strava.requests_served
+    assert served['429'] == 0
+    assert served['list'] + served['detail'] <= 40
+    assert config['remaining_updates'] is True
+    assert config['last_timeout_15min'] != '2022_01_01_1200'
+    # The next run waits for the window to reset
+    assert not update.check_last_timeout(config)
+
+
+def test_persistent_429_stops_after_retries(mock_strava):
+    # 429 on every request while the headers still show budget
+    mock_strava.error_rate = 1.0
+    with pytest.raises(TimeoutFifteen):
+        update.return_json(update.API_URL + '/athlete/activities', {}, {'page': 1})
+    assert mock_strava.requests_served['429'] == update.MAX_THROTTLE_RETRIES + 1
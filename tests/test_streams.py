@@ -0,0 +1,133 @@
+""" Tests of the stream store, written and read back through the memory maps, and compacted after removals """
+import os
+
+import numpy as np
+
+from mock_strava import make_streams
+from stravatracker import streams
+from stravatracker.streams import StreamStore, STREAM_DTYPES
+
+
+def activity_streams(number):
+    """Returns the streams strava gives for mock activity number"""
+    return make_streams(number, spacing_days=3.0)
+
+
+def assert_stored(store, activity_id, streams_json):
+    """Checks the streams read back for activity_id are those put"""
+    stored = store.get(activity_id)
+    expected = {key: stream['data'] for key, stream in streams_json.items()}
+    if 'latlng' in expected:
+        latlng = np.asarray(expected.pop('latlng'))
+        expected['lat'], expected['lng'] = latlng[:, 0], latlng[:, 1]
+    assert sorted(stored) == sorted(expected)
+    for col, values in expected.items():
+        assert stored[col].dtype == np.dtype(STREAM_DTYPES[col])
+        np.testing.assert_array_equal(stored[col], np.asarray(values).astype(STREAM_DTYPES[col]))
+
+
+def test_round_trip(workdir):
+    with StreamStore() as store:
+        for number in range(6):
+            store.put(1000 + number, activity_streams(number))
+        assert store.ids() == set(range(1000, 1006))
+    # Read back from the files by another store
+    with StreamStore() as store:
+        for number in range(6):
+            assert_stored(store, 1000 + number, activity_streams(number))
+        assert isinstance(store.column('time'), np.memmap)
+        index = store.index()
+        assert list(index['offset']) == [0] + list(np.cumsum(index['length'])[:-1])
+        assert store.get(999) is None
+
+
+def test_missing_and_null_samples(workdir):
+    with StreamStore() as store:
+        store.put(1, {'time': {'data': [0, 1, 2]}, 'watts': {'data': [100, None, 300]}, 'altitude': {'data': [1.5, None, 2.5]}})
+        store.put(2, [])
+        stored = store.get(1)
+        assert sorted(stored) == ['altitude', 'time', 'watts']
+        np.testing.assert_array_equal(stored['watts'], [100, 0, 300])
+        np.testing.assert_array_equal(stored['altitude'], [1.5, np.nan, 2.5])
+        # Columns strava did not return are zeros in the files
+        np.testing.assert_array_equal(store.column('heartrate')[:3], [0, 0, 0])
+        assert store.get(2) == {}
+
+
+def test_replace_and_remove(workdir):
+    with StreamStore() as store:
+        for number in range(4):
+            store.put(number, activity_streams(number))
+        store.put(1, activity_streams(10))
+        assert_stored(store, 1, activity_streams(10))
+        store.remove([2])
+        assert store.get(2) is None and store.ids() == {0, 1, 3}
+        assert store.used == sum(len(activity_streams(number)['time']['data']) for number in [0, 10, 3])
+        assert store.size > store.used
+
+
+def test_unfinished_put_is_cut_off(workdir):
+    with StreamStore() as store:
+        store.put(1, activity_streams(1))
+        size = store.size
+    # Samples written to some files before a crash, without reaching the index
+    with open(os.path.join(streams.STREAMS_PATH, 'time.bin'), 'ab') as colfile:
+        colfile.write(np.arange(50, dtype='int32').tobytes())
+    with StreamStore() as store:
+        assert store.size == size
+        assert os.path.getsize(store.column_path('time')) == size * 4
+        store.put(2, activity_streams(2))
+        assert_stored(store, 1, activity_streams(1))
+        assert_stored(store, 2, activity_streams(2))
+
+
+def test_compact(workdir):
+    with StreamStore() as store:
+        for number in range(8):
+            store.put(number, activity_streams(number))
+        store.put(5, activity_streams(20))
+        store.remove([0, 3, 4])
+        used = store.used
+        assert store.compact() > 0
+        assert store.size == used and store.generation == 1
+        for col, dtype in STREAM_DTYPES.items():
+            assert os.path.getsize(store.column_path(col)) == used * np.dtype(dtype).itemsize
+        # The previous generation is removed
+        assert sorted(name for name in os.listdir(streams.STREAMS_PATH) if name.endswith('.bin')) == sorted(
+            os.path.basename(store.column_path(col)) for col in STREAM_DTYPES)
+        for number in [1, 2, 6, 7]:
+            assert_stored(store, number, activity_streams(number))
+        assert_stored(store, 5, activity_streams(20))
+    with StreamStore() as store:
+        assert store.generation == 1 and store.size == used
+        assert_stored(store, 7, activity_streams(7))
+        store.put(8, activity_streams(8))
+        assert_stored(store, 8, activity_streams(8))
+
+
+def test_remove_compacts_when_mostly_unused(workdir, monkeypatch):
+    monkeypatch.setattr(streams, 'COMPACT_MIN_SAMPLES', 1000)
+    with StreamStore() as store:
+        for number in range(6):
+            store.put(number, activity_streams(number))
+        store.remove([0])
+        assert store.generation == 0
+        store.remove([1, 2, 3])
+        assert store.generation == 1 and store.size == store.used
+        assert_stored(store, 4, activity_streams(4))
+
+
+def test_unfinished_compaction_keeps_the_previous_files(workdir):
+    with StreamStore() as store:
+        for number in range(3):
+            store.put(number, activity_streams(number))
+        store.remove([1])
+        size = store.size
+        # The next generation was being written when the process stopped
+        for col in STREAM_DTYPES:
+            with open(store.column_path(col, store.generation + 1), 'wb') as colfile:
+                colfile.write(b'\0' * 8)
+    with StreamStore() as store:
+        assert store.generation == 0 and store.size == size
+        assert not os.path.exists(store.column_path('time', 1))
+        assert_stored(store, 2, activity_streams(2))
@@ -0,0 +1,87 @@
+""" Tests of the re-sync of activities edited or deleted on strava """
+import pandas as pd
+import pytest
+
+from mock_strava import FIRST_ID
+from synthetic import make_activities
+from stravatracker import store, aggregates, rawcache
+
+from conftest import new_config, sync, force_full_sync
+
+
+def assert_aggregates_match_store(tmp_path):
+    tables = aggregates.load_table_ls(["Y", "M"])
+    aggregates.rebuild_aggregates(store.load_activities(store.LOAD_COLUMNS), str(tmp_path / 'rebuilt.db'))
+    for table, reference in zip(tables, aggregates.load_table_ls(["Y", "M"], str(tmp_path / 'rebuilt.db'))):
+        pd.testing.assert_frame_equal(table, reference)
+
+
+@pytest.mark.parametrize('ingest_mode', ['detail', 'summary'])
+def test_edits_and_deletions_are_resynced(mock_strava, workdir, ingest_mode):
+    sync(new_config(ingest_mode=ingest_mode))
+    types = store.load_activities().set_index('id')['type']
+    rides = [number for number in range(120) if types[FIRST_ID + number] in ('Ride', 'VirtualRide')]
+    mock_strava.edit_activity(119, name='Cropped', moving_time=600, elapsed_time=700)
+    mock_strava.edit_activity(rides[0], type='Run')
+    mock_strava.delete_activity(rides[1])
+    mock_strava.delete_activity(30)
+    force_full_sync()
+    sync()
+    df = store.load_activities().set_index('id')
+    assert df.loc[FIRST_ID + 119, 'name'] == 'Cropped'
+    assert df.loc[FIRST_ID + 119, 'moving_time'] == 600
+    assert df.loc[FIRST_ID + rides[0], 'type'] == 'Run'
+    assert FIRST_ID + rides[1] not in df.index and FIRST_ID + 30 not in df.index
+    assert len(df) == 118
+    with rawcache.RawCache() as cache:
+        assert cache.get(FIRST_ID + 30) is None
+    assert_aggregates_match_store(workdir)
+
+
+def test_recent_edit_found_by_incremental_sync(mock_strava, workdir):
+    sync(new_config())
+    # Activities are a month apart, only the newest is within EDIT_LOOKBACK_DAYS of the cursor
+    mock_strava.edit_activity(119, type='Hike', distance=5000.0)
+    sync()
+    df = store.load_activities().set_index('id')
+    assert df.loc[FIRST_ID + 119, 'type'] == 'Hike'
+    assert df.loc[FIRST_ID + 119, 'distance'] == 5000.0
+    assert_aggregates_match_store(workdir)
+
+
+def test_unchanged_activities_are_not_fetched_again(mock_strava, workdir):
+    sync(new_config())
+    details = mock_strava.requests_served['detail']
+    force_full_sync()
+    sync()
+    sync()
+    assert mock_strava.requests_served['detail'] == details
+
+
+@pytest.mark.parametrize('ingest_mode', ['detail', 'summary'])
+def test_edits_of_any_stored_column_are_written(mock_strava, workdir, ingest_mode):
+    sync(new_config(ingest_mode=ingest_mode))
+    # A new local start time and time zone, and a corrected speed, none of which the store compared before
+    mock_strava.edit_activity(40, start_date_local='2022-03-01T10:00:00Z', timezone='(GMT+09:00) Asia/Tokyo', average_speed=4.5)
+    force_full_sync()
+    sync()
+    df = store.load_activities().set_index('id')
+    assert df.loc[FIRST_ID + 40, 'start_date_local'] == pd.Timestamp('2022-03-01 10:00:00')
+    assert df.loc[FIRST_ID + 40, 'timezone'] == '(GMT+09:00) Asia/Tokyo'
+    assert df.loc[FIRST_ID + 40, 'average_speed'] == 4.5
+    assert_aggregates_match_store(workdir)
+
+
+def test_fetched_activities_are_written_in_full(workdir):
+    previous = make_activities(50, history_days=200, seed=4).assign(timezone='(GMT+00:00) Europe/London')
+    store.save_activities(previous)
+    stored = store.load_activities(store.LOAD_COLUMNS)
+    # A fetched activity whose time zone alone changed, the others carried over from the stored projection
+    fetched = store.load_activities().iloc[[3]].assign(timezone='(GMT+09:00) Asia/Tokyo')
+    df = pd.concat([stored.drop(index=3), fetched]).sort_values('id', ascending=False).reset_index(drop=True)
+    changed_id_list, deleted_id_list = store.save_activities(store.compact_dtypes(df), previous=stored)
+    assert changed_id_list == [stored['id'][3]] and deleted_id_list == []
+    df = store.load_activities().set_index('id')
+    assert df.loc[stored['id'][3], 'timezone'] == '(GMT+09:00) Asia/Tokyo'
+    # Carried over activities keep the columns left out of the projection
+    assert (df['timezone'].drop(index=stored['id'][3]) == '(GMT+00:00) Europe/London').all()
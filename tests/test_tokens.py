@@ -0,0 +1,98 @@
+""" Tests of the access token cache and of refresh tokens rotated by strava """
+import json
+import time
+import threading
+import multiprocessing
+
+import pytest
+import requests
+
+from stravatracker import update, tokens, stravatracker as st
+
+from conftest import new_config
+
+
+def write_config(**fields):
+    """Writes the config of an athlete with fields changed to the config file, and returns it"""
+    config = new_config(**fields)
+    st.write_json(config, st.CONFIG_PATH)
+    return config
+
+
+def test_cached_token_is_used(mock_strava):
+    config = write_config(access_token='cached', expires_at=int(time.time()) + tokens.REFRESH_MARGIN + 600)
+    assert tokens.access_token(config, requests.Session(), update.TOKEN_URL) == ('cached', False)
+    assert mock_strava.requests_served['token'] == 0
+
+
+def test_token_near_expiry_is_refreshed(mock_strava):
+    config = write_config(access_token='cached', expires_at=int(time.time()) + tokens.REFRESH_MARGIN - 60)
+    assert tokens.access_token(config, requests.Session(), update.TOKEN_URL) == ('mock_access_token_refresh', True)
+    assert mock_strava.requests_served['token'] == 1
+    assert config['expires_at'] - time.time() > tokens.REFRESH_MARGIN
+    # Used until it is near expiry again
+    assert tokens.access_token(config, requests.Session(), update.TOKEN_URL) == ('mock_access_token_refresh', False)
+    assert mock_strava.requests_served['token'] == 1
+
+
+def test_rotated_refresh_token_is_saved(mock_strava):
+    config = write_config()
+    stale = dict(config)
+    # A setting changed on disk since config was read is kept
+    with open(st.CONFIG_PATH) as jsonfile:
+        stored = json.load(jsonfile)
+    stored['full_sync_days'] = 3
+    with open(st.CONFIG_PATH, 'w') as jsonfile:
+        json.dump(stored, jsonfile)
+    tokens.access_token(config, requests.Session(), update.TOKEN_URL)
+    assert config['refresh_token'] == 'refresh.1'
+    stored = st.read_json(st.CONFIG_PATH)
+    assert stored['refresh_token'] == 'refresh.1' and stored['access_token'] == config['access_token']
+    assert stored['full_sync_days'] == 3
+    # A config read before the refresh takes the new tokens, so writing it back does not restore the old refresh token
+    tokens.merge_tokens(stale)
+    assert stale['refresh_token'] == 'refresh.1'
+    # The next refresh sends the rotated token
+    config['expires_at'] = 0
+    tokens.save_tokens(config, st.CONFIG_PATH)
+    tokens.access_token(config, requests.Session(), update.TOKEN_URL)
+    assert st.read_json(st.CONFIG_PATH)['refresh_token'] == 'refresh.2'
+
+
+def test_concurrent_threads_refresh_once(mock_strava):
+    write_config()
+    results = []
+
+    def caller():
+        # Each caller has its own copy of the config, as separate updates do
+        config = st.read_json(st.CONFIG_PATH)
+        results.append(tokens.access_token(config, requests.Session(), update.TOKEN_URL))
+
+    threads = [threading.Thread(target=caller) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert mock_strava.requests_served['token'] == 1
+    assert sorted(refreshed for token, refreshed in results) == [False] * 5 + [True]
+    assert {token for token, refreshed in results} == {'mock_access_token_refresh'}
+    assert st.read_json(st.CONFIG_PATH)['refresh_token'] == 'refresh.1'
+
+
+def process_caller(args):
+    """Returns the access token of a process reading the config file, see test_concurrent_processes_refresh_once()"""
+    path, token_url = args
+    config = st.read_json(path)
+    return tokens.access_token(config, requests.Session(), token_url, path)
+
+
+@pytest.mark.skipif('fork' not in multiprocessing.get_all_start_methods(), reason="needs fork to share the mock server")
+def test_concurrent_processes_refresh_once(mock_strava, workdir):
+    write_config()
+    path = str(workdir / st.CONFIG_PATH)
+    # Only the lock file serialises the processes
+    with multiprocessing.get_context('fork').Pool(4) as pool:
+        results = pool.map(process_caller, [(path, update.TOKEN_URL)] * 4, chunksize=1)
+    assert mock_strava.requests_served['token'] == 1
+    assert sum(refreshed for token, refreshed in results) == 1
+    assert st.read_json(path)['refresh_token'] == 'refresh.1'
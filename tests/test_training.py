@@ -0,0 +1,88 @@
+""" Tests of the training load, advanced incrementally against recomputed in full """
+import json
+import datetime as dt
+
+import pandas as pd
+
+from stravatracker import training, store
+
+from conftest import new_config, edited_history, sync
+
+# After the last synthetic activity, so the series has days without load
+TODAY = dt.date(2016, 6, 30)
+
+
+def full_training(df, config, path):
+    """Returns the training series recomputed from df"""
+    training.rebuild_training(df, config, path)
+    training.advance_training(TODAY, path)
+    return training.load_training(path)
+
+
+def test_update_matches_full_recompute(workdir):
+    config = new_config(load_metric='heartrate', threshold_hr=160)
+    previous, new_df, changed, deleted = edited_history()
+    training.rebuild_training(previous, config, 'data/incremental.db')
+    training.advance_training(TODAY, 'data/incremental.db')
+    training.update_training(new_df, previous, changed, deleted, config, 'data/incremental.db')
+    training.advance_training(TODAY, 'data/incremental.db')
+    pd.testing.assert_frame_equal(training.load_training('data/incremental.db'), full_training(new_df, config, 'data/full.db'))
+
+
+def test_new_activities_only_recompute_their_days(workdir):
+    config = new_config()
+    previous, new_df, changed, deleted = edited_history()
+    # Only the new activities, without the edits and deletions
+    new_df = pd.concat([new_df.iloc[:60], previous], ignore_index=True)
+    training.rebuild_training(previous, config, 'data/incremental.db')
+    training.advance_training(TODAY, 'data/incremental.db')
+    training.update_training(new_df, previous, changed[:60], [], config, 'data/incremental.db')
+    computed = training.advance_training(TODAY, 'data/incremental.db')
+    incremental = training.load_training('data/incremental.db')
+    first_new = new_df['start_date_local'].iloc[:60].min().normalize()
+    assert computed == (pd.Timestamp(TODAY) - first_new).days + 1
+    assert computed < incremental.shape[0] / 2
+    pd.testing.assert_frame_equal(incremental, full_training(new_df, config, 'data/full.db'))
+
+
+def test_advance_day_by_day_matches_one_advance(workdir):
+    config = new_config(load_metric='power', ftp=250, threshold_hr=160)
+    previous, new_df, changed, deleted = edited_history()
+    training.rebuild_training(new_df, config, 'data/daily.db')
+    training.advance_training(TODAY - dt.timedelta(days=30), 'data/daily.db')
+    for day in range(29, -1, -1):
+        assert training.advance_training(TODAY - dt.timedelta(days=day), 'data/daily.db') == 1
+    pd.testing.assert_frame_equal(training.load_training('data/daily.db'), full_training(new_df, config, 'data/full.db'))
+
+
+def test_settings_and_rules_changes_recompute(workdir):
+    config = new_config(load_metric='heartrate', threshold_hr=160)
+    previous, new_df, changed, deleted = edited_history()
+    training.rebuild_training(previous, config, 'data/incremental.db')
+    assert training.training_current(config, 'data/incremental.db')
+    config['threshold_hr'] = 170
+    assert not training.training_current(config, 'data/incremental.db')
+    training.update_training(new_df, previous, changed, deleted, config, 'data/incremental.db')
+    assert training.training_current(config, 'data/incremental.db')
+    # Swims timed on moving time instead of elapsed time change their loads
+    with open('data/activity_rules.json', 'w') as jsonfile:
+        json.dump({'Swim': {'time': 'moving_time'}}, jsonfile)
+    assert not training.training_current(config, 'data/incremental.db')
+    training.update_training(new_df, new_df, [], [], config, 'data/incremental.db')
+    training.advance_training(TODAY, 'data/incremental.db')
+    pd.testing.assert_frame_equal(training.load_training('data/incremental.db'), full_training(new_df, config, 'data/full.db'))
+
+
+def test_sync_advances_the_series(mock_strava, workdir):
+    sync(new_config())
+    # Current to today without an analysis, and the same as recomputed in full
+    training_df = training.load_training()
+    assert training_df.index[-1].date() == dt.date.today()
+    training.rebuild_training(store.load_activities(store.LOAD_COLUMNS), new_config(), 'data/full.db')
+    training.advance_training(path='data/full.db')
+    pd.testing.assert_frame_equal(training_df, training.load_training('data/full.db'))
+    mock_strava.add_activities(3)
+    sync()
+    assert training.load_training()['load'].sum() > training_df['load'].sum()
+    # Nothing is left to advance
+    assert training.advance_training() == 0